@@ -0,0 +1,21 @@
+# coding:utf-8
+"""
+Reproducible benchmarks for the hot paths of game.py.
+
+Run from the tank_battle directory:
+
+    $ python -m bench --size 26 --tanks 20 --bullets 40 -o result.json
+    $ python -m bench --baseline result.json --threshold 0.1
+"""
+import os
+
+# the benchmarks never open a window or play a sound
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+from bench.synthetic import build_map, build_world  # noqa: E402
+from bench.cases import CASES, run_case, run_suite  # noqa: E402
+from bench.report import dump, load, compare  # noqa: E402
+
+__all__ = ['build_map', 'build_world', 'CASES', 'run_case', 'run_suite',
+           'dump', 'load', 'compare']
@@ -0,0 +1,59 @@
+# coding:utf-8
+import argparse
+import sys
+
+from bench import CASES, build_world, run_suite, dump, load, compare
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m bench',
+                                     description='benchmark game.py hot paths')
+    parser.add_argument('--size', type=int, default=26,
+                        help='map width and height in cells')
+    parser.add_argument('--density', type=float, default=0.3,
+                        help='ratio of wall cells')
+    parser.add_argument('--soft-ratio', type=float, default=0.5,
+                        help='ratio of soft walls among walls')
+    parser.add_argument('--tanks', type=int, default=10)
+    parser.add_argument('--bullets', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--case', action='append', choices=list(CASES),
+                        help='only run the given case, can be repeated')
+    parser.add_argument('-o', '--output', default='bench_result.json')
+    parser.add_argument('--baseline', help='json result to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slow down before flagging regression')
+    args = parser.parse_args(argv)
+
+    params = {'size': args.size, 'density': args.density,
+              'soft_ratio': args.soft_ratio, 'tanks': args.tanks,
+              'bullets': args.bullets, 'seed': args.seed,
+              'repeat': args.repeat}
+    world = build_world(args.size, wall_density=args.density,
+                        soft_ratio=args.soft_ratio, tanks=args.tanks,
+                        bullets=args.bullets, seed=args.seed)
+    try:
+        results = run_suite(world, args.case, repeat=args.repeat)
+    finally:
+        world.close()
+    dump(results, params, args.output)
+
+    for name, stat in results.items():
+        print('{:<20} median {:10.3f} ms  min {:10.3f} ms'.format(
+            name, stat['median'] * 1000, stat['min'] * 1000))
+    print('result saved to {}'.format(args.output))
+
+    if not args.baseline:
+        return 0
+    rows = compare(results, load(args.baseline), threshold=args.threshold)
+    regressions = 0
+    for row in rows:
+        flag = 'REGRESSION' if row['regression'] else 'ok'
+        regressions += row['regression']
+        print('{:<20} {:8.2f}x  {}'.format(row['case'], row['ratio'], flag))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
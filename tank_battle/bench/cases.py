@@ -0,0 +1,159 @@
+# coding:utf-8
+import shelve
+import statistics
+import time
+from collections import OrderedDict
+from typing import Callable, Dict
+
+from pygame.surface import Surface
+
+from bots import Shooter
+from game import lane_collide, map_connect, RewindBuffer
+
+CASES = OrderedDict()
+
+
+def case(name: str) -> Callable:
+    """
+    注册一个测试用例, 用例接收 World, 返回一个无参数的待测函数,
+    准备工作不计入耗时
+    """
+    def wrapper(func):
+        CASES[name] = func
+        return func
+    return wrapper
+
+
+@case('map_connect')
+def bench_map_connect(world):
+    grid = world.data_map._map
+    return lambda: map_connect(m=grid)
+
+
+@case('load_level')
+def bench_load_level(world):
+    g = world.reset()
+    return g.load_level
+
+
+@case('compute_bullet_pos')
+def bench_compute_bullet_pos(world):
+    g = world.reset()
+    return g.compute_bullet_pos
+
+
+@case('bullet_collide')
+def bench_bullet_collide(world):
+    # 只算子弹互相抵消和打坦克, 不删精灵, 每次结果一样
+    g = world.reset()
+
+    def run():
+        lane_collide(g.npc_bullets, g.bullet_list, False, False,
+                     band=g.tank_size)
+        lane_collide(g.bullet_list, g.npc_tanks, False, False,
+                     band=g.tank_size)
+    return run
+
+
+@case('collision_detect')
+def bench_collision_detect(world):
+    g = world.reset()
+    return g.collision_detect
+
+
+@case('bot_game')
+def bench_bot_game(world):
+    # 机器人全速玩 50 帧, 子弹碰撞和 NPC 决策都在里面
+    g = world.reset()
+    bot = Shooter(seed=world.seed)
+
+    def run():
+        for _ in range(50):
+            g.step(bot(g))
+    return run
+
+
+@case('tank_move')
+def bench_tank_move(world):
+    g = world.reset()
+    tanks = g.npc_tanks.sprites()
+    battle_field = g.battle_field
+
+    def run():
+        for tank in tanks:
+            tank.move(battle_field)
+    return run
+
+
+@case('draw_edit_area')
+def bench_draw_edit_area(world):
+    g = world.game
+    surface = Surface(g.size)
+    return lambda: g.draw_edit_area(surface, world.data_map)
+
+
+@case('level_round_trip')
+def bench_level_round_trip(world):
+    g = world.session
+
+    def run():
+        with shelve.open(g.map_file, 'c') as db:
+            db['1'] = world.data_map
+        g.get_level_map(1)
+    return run
+
+
+@case('record_round_trip')
+def bench_record_round_trip(world):
+    world.reset()
+    g = world.game
+
+    def run():
+        g.write_record()
+        g.session.clear_all_sprites()
+        g.read_record()
+    return run
+
+
+@case('record_snapshot')
+def bench_record_snapshot(world):
+    # 存档时主线程的开销, 写文件在后台线程
+    g = world.reset()
+    return g.snapshot
+
+
+@case('rewind_record')
+def bench_rewind_record(world):
+    g = world.reset()
+    buffer = RewindBuffer()
+    buffer.record(g)
+
+    def run():
+        buffer.record(g)
+    return run
+
+
+def run_case(world, name: str, repeat: int = 20) -> Dict[str, float]:
+    setup = CASES[name]
+    # warm up, the first call pays for image conversion, file cache etc.
+    setup(world)()
+    samples = list()
+    for _ in range(repeat):
+        func = setup(world)
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {
+        'repeat': repeat,
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'stdev': statistics.stdev(samples) if repeat > 1 else 0.0,
+    }
+
+
+def run_suite(world, names=None, repeat: int = 20) -> Dict[str, Dict]:
+    results = OrderedDict()
+    for name in names or CASES:
+        results[name] = run_case(world, name, repeat=repeat)
+    return results
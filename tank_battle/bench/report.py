@@ -0,0 +1,46 @@
+# coding:utf-8
+import json
+import platform
+from typing import Dict, List
+
+import pygame
+
+
+def dump(results: Dict, params: Dict, path: str) -> Dict:
+    data = {
+        'meta': {
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'platform': platform.platform(),
+            'params': params,
+        },
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+    return data
+
+
+def load(path: str) -> Dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results: Dict, baseline: Dict, threshold: float = 0.1,
+            key: str = 'median') -> List[Dict]:
+    """
+    和基准结果对比, 返回每个用例的对比结果
+    耗时比基准慢 threshold 以上的用例标记为 regression
+    """
+    rows = list()
+    base_results = baseline.get('results', baseline)
+    for name, stat in results.items():
+        if name not in base_results:
+            continue
+        old = base_results[name][key]
+        new = stat[key]
+        ratio = new / old if old else float('inf')
+        rows.append({'case': name, 'baseline': old, 'current': new,
+                     'ratio': ratio,
+                     'regression': ratio > 1 + threshold})
+    return rows
@@ -0,0 +1,107 @@
+# coding:utf-8
+import os
+import shelve
+from copy import deepcopy
+import tempfile
+from random import Random
+
+import game
+from game import DataMap, MapItem, Direction, Bullet, Game, GameSession
+
+
+def build_map(size: int = 26, wall_density: float = 0.3,
+              soft_ratio: float = 0.5, green_ratio: float = 0.05,
+              tanks: int = 10, seed: int = 0) -> DataMap:
+    """
+    生成一张 size x size 的随机地图
+    wall_density 是墙占所有格子的比例, soft_ratio 是软墙占墙的比例,
+    tanks 个NPC坦克放在 2x2 的空白位置上
+    """
+    rng = Random(seed)
+    data_map = DataMap(size, size)
+    grid = data_map._map
+    for x in range(size):
+        for y in range(size):
+            roll = rng.random()
+            if roll < wall_density:
+                if rng.random() < soft_ratio:
+                    grid[x][y] = MapItem.soft_wall
+                else:
+                    grid[x][y] = MapItem.hard_wall
+            elif roll < wall_density + green_ratio:
+                grid[x][y] = MapItem.green_land
+
+    # npc tank takes a 2x2 block, keep the block empty
+    spots = [(x, y) for x in range(0, size - 1, 2)
+             for y in range(0, size - 3, 2)]
+    rng.shuffle(spots)
+    for x, y in spots[:tanks]:
+        for i, j in ((x, y), (x + 1, y), (x, y + 1), (x + 1, y + 1)):
+            grid[i][j] = MapItem.empty
+        grid[x][y] = MapItem.tank
+    return data_map
+
+
+class World(object):
+    """
+    一个没有窗口的 Game, 用来反复加载同一张合成地图
+    模拟相关的用例直接用 game.session
+    """
+
+    def __init__(self, data_map: DataMap, bullets: int = 0, seed: int = 0):
+        game.debug = True
+        self.data_map = data_map
+        self.bullets = bullets
+        self.seed = seed
+        # 对象被回收或者进程退出时临时目录会自动删掉, 也可以提前 close
+        self.tmp = tempfile.TemporaryDirectory(prefix='tank_bench_')
+        self.tmp_dir = self.tmp.name
+        self.game = Game()
+        self.session = self.game.session
+        self.session.map_file = os.path.join(self.tmp_dir, 'map')
+        self.game.record = os.path.join(self.tmp_dir, 'record')
+        with shelve.open(self.session.map_file, 'c') as db:
+            db['1'] = data_map
+        self.reset()
+
+    def reset(self) -> GameSession:
+        g = self.session
+        rng = Random(self.seed)
+        g.rng.seed(self.seed)
+        g.clear_all_sprites()
+        self.game.intro = False
+        g.score = 0
+        g.cur_level = 1
+        g.battle_field = deepcopy(self.data_map)
+        g.load_level()
+        g.init_player()
+
+        open_cells = [(x, y) for x in range(g.battle_field.width)
+                      for y in range(g.battle_field.height)
+                      if g.battle_field.get(x, y) == MapItem.empty]
+        for i in range(self.bullets):
+            x, y = rng.choice(open_cells)
+            bullet_type = 'user' if i % 2 else 'npc'
+            bullet = Bullet((x * g.min_unit_size, y * g.min_unit_size),
+                            Direction(rng.randint(0, 3)),
+                            bullet_type=bullet_type,
+                            max_w=g.world_width, max_h=g.world_height)
+            if bullet_type == 'user':
+                g.bullet_list.add(bullet)
+            else:
+                g.npc_bullets.add(bullet)
+        g.wake_npc_tanks()
+        return g
+
+    def close(self) -> None:
+        self.game.record_writer.flush()
+        self.session.clear_all_sprites()
+        self.tmp.cleanup()
+
+
+def build_world(size: int = 26, wall_density: float = 0.3,
+                soft_ratio: float = 0.5, tanks: int = 10, bullets: int = 20,
+                seed: int = 0) -> World:
+    data_map = build_map(size, wall_density=wall_density,
+                         soft_ratio=soft_ratio, tanks=tanks, seed=seed)
+    return World(data_map, bullets=bullets, seed=seed)
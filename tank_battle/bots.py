@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+代替键盘的机器人玩家, 给压测和基准测试提供可重复的操作
+
+    $ python bots.py --bot shooter --ticks 5000 --seed 1 --levels map.db
+    $ python bots.py --bot hugger --ticks 2000 --profile
+
+机器人和 game.Controller 一样, 每帧用当前的 GameSession 调用一次, 返回 KeyState,
+GameSession.step 再交给 handler_user_input; 同样的种子和关卡每次的操作都一样
+    walker    随机乱走, 每隔几帧换方向, 随机开火
+    hugger    右手扶着墙走, 边走边打
+    shooter   找最近的 NPC 坦克, 像 Tank.find_enemy 一样对齐到同一行或同一列再开火
+在游戏里看机器人玩:
+    $ python bots.py --play --bot shooter
+"""
+import argparse
+import cProfile
+import pstats
+import sys
+import tempfile
+import time
+from functools import wraps
+from random import Random
+from typing import Dict, Optional
+
+from pygame import Rect
+from pygame.sprite import Sprite
+
+from game import Controller, Direction, Game, GameSession, KeyState, noway
+import levelgen
+import levelpack
+
+# 方向对应的按键和每走一步的位移
+DIRECTION_KEYS = {Direction.right: 'd', Direction.down: 's',
+                  Direction.left: 'a', Direction.up: 'w'}
+OFFSETS = {Direction.right: (1, 0), Direction.down: (0, 1),
+           Direction.left: (-1, 0), Direction.up: (0, -1)}
+
+_key_states = dict()
+
+
+def key_state(text) -> KeyState:
+    # 机器人每帧都要返回按键, 同样的组合只建一次
+    state = _key_states.get(text)
+    if state is None:
+        state = _key_states[text] = KeyState(text)
+    return state
+
+
+def turn_right(direction) -> Direction:
+    return Direction((direction + 1) % 4)
+
+
+def turn_left(direction) -> Direction:
+    return Direction((direction + 3) % 4)
+
+
+def blocked(session: GameSession, rect: Rect, direction) -> bool:
+    """
+    往 direction 走一步会不会撞墙或者出界, 和 Player.turn_up 等一样检查前沿的三个点
+    """
+    scale = session.scale
+    dx, dy = OFFSETS[direction]
+    rect = rect.move(dx * scale, dy * scale)
+    if rect.left < 0 or rect.top < 0 or rect.right > session.world_width \
+            or rect.bottom > session.world_height:
+        return True
+    if direction == Direction.right:
+        points = ((rect.right - 1, rect.top), (rect.right - 1, rect.centery),
+                  (rect.right - 1, rect.bottom - 1))
+    elif direction == Direction.down:
+        points = ((rect.left + 1, rect.bottom - 1),
+                  (rect.centerx, rect.bottom - 1),
+                  (rect.right - 1, rect.bottom - 1))
+    elif direction == Direction.left:
+        points = ((rect.left, rect.top), (rect.left, rect.centery),
+                  (rect.left, rect.bottom - 1))
+    else:
+        points = ((rect.left + 1, rect.top), (rect.centerx, rect.top),
+                  (rect.right - 1, rect.top))
+    unit = session.min_unit_size
+    field = session.battle_field
+    return any(field.get(x // unit, y // unit) in noway for x, y in points)
+
+
+class RandomWalker(Controller):
+    """
+    随机乱走, 每 hold 帧换一次方向, 换方向时按 fire 的概率决定这一段开不开火
+    """
+
+    def __init__(self, seed=0, hold=5, fire=0.5):
+        self.rng = Random(seed)
+        self.hold = hold
+        self.fire = fire
+        self.keys = key_state('')
+        self.frames = 0
+
+    def __call__(self, session: GameSession) -> KeyState:
+        if self.frames % self.hold == 0:
+            text = self.rng.choice('wasd')
+            if self.rng.random() < self.fire:
+                text += 'j'
+            self.keys = key_state(text)
+        self.frames += 1
+        return self.keys
+
+
+class WallHugger(Controller):
+    """
+    右手扶墙: 右边的墙到头了就右转, 前面走不通就左转, 一直按着开火键
+    还没碰到墙的时候一直往前走, 免得在空地上原地打转
+    """
+
+    def __init__(self, seed=0, fire=True):
+        self.rng = Random(seed)
+        self.fire = 'j' if fire else ''
+        self.direction = None
+        self.wall_on_right = False
+
+    def __call__(self, session: GameSession) -> KeyState:
+        player = session.player
+        if not player:
+            return key_state('')
+        if self.direction is None:
+            self.direction = Direction(self.rng.randrange(4))
+        rect = player.rect
+        right = turn_right(self.direction)
+        if self.wall_on_right and not blocked(session, rect, right):
+            # 拐角, 跟着墙转过去
+            self.direction = right
+        else:
+            for _ in range(3):
+                if not blocked(session, rect, self.direction):
+                    break
+                self.direction = turn_left(self.direction)
+        self.wall_on_right = blocked(session, rect,
+                                     turn_right(self.direction))
+        return key_state(DIRECTION_KEYS[self.direction] + self.fire)
+
+
+class Shooter(Controller):
+    """
+    追最近的 NPC 坦克: 先沿差得少的那一轴靠过去, 和它在同一行或同一列时转过去开火,
+    和 Tank.find_enemy 比较中心点的方式一样; 被墙卡住时随机走几步再追,
+    对着一辆坦克打了 aim 帧还没加分 (多半隔着硬墙) 就先去追别的坦克
+    """
+
+    def __init__(self, seed=0, patience=5, detour=8, aim=30):
+        self.rng = Random(seed)
+        self.patience = patience
+        self.detour = detour
+        self.aim = aim
+        self.last_location = None
+        self.last_score = 0
+        self.firing = 0
+        self.target = None
+        self.ignore = None
+        self.stuck = 0
+        self.wander = 0
+        self.wander_keys = key_state('')
+
+    def nearest(self, session: GameSession, rect: Rect) -> Optional[Sprite]:
+        best, target = None, None
+        for tank in session.npc_tanks.sprites():
+            if tank is self.ignore:
+                continue
+            other = tank.rect
+            distance = abs(other.centerx - rect.centerx) + \
+                abs(other.centery - rect.centery)
+            if best is None or distance < best:
+                best, target = distance, tank
+        return target or self.ignore
+
+    def __call__(self, session: GameSession) -> KeyState:
+        player = session.player
+        if not player:
+            return key_state('')
+        location = tuple(player.location)
+        if location == self.last_location:
+            self.stuck += 1
+        else:
+            self.stuck = 0
+        self.last_location = location
+        if session.score != self.last_score:
+            self.last_score = session.score
+            self.firing = 0
+        if self.firing >= self.aim:
+            self.ignore = self.target
+        if self.stuck >= self.patience or self.firing >= self.aim:
+            self.stuck = 0
+            self.firing = 0
+            self.wander = self.detour
+            self.wander_keys = key_state(self.rng.choice('wasd') + 'j')
+        if self.wander:
+            self.wander -= 1
+            return self.wander_keys
+
+        rect = player.rect
+        self.target = self.nearest(session, rect)
+        if self.target is None:
+            return key_state('j')
+        target = self.target.rect
+        dx = target.centerx - rect.centerx
+        dy = target.centery - rect.centery
+        if dx == 0 or dy == 0:
+            if dx == 0:
+                want = Direction.down if dy > 0 else Direction.up
+            else:
+                want = Direction.left if dx < 0 else Direction.right
+            if player.direction == want:
+                # 原地开火, 不按方向键就不会往前挪
+                self.last_location = None
+                self.firing += 1
+                return key_state('j')
+            return key_state(DIRECTION_KEYS[want])
+        if abs(dx) <= abs(dy):
+            want = Direction.right if dx > 0 else Direction.left
+        else:
+            want = Direction.down if dy > 0 else Direction.up
+        return key_state(DIRECTION_KEYS[want] + 'j')
+
+
+BOTS = {'walker': RandomWalker, 'hugger': WallHugger, 'shooter': Shooter}
+
+
+def timed(func, totals, name):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            totals[name] += time.perf_counter() - start
+    return wrapper
+
+
+def play(session: GameSession, controller, ticks,
+         phases=('compute_bullet_pos', 'compute_npc_tank_pos')) -> Dict:
+    """
+    不画图全速跑 ticks 帧, 玩家死了或者通关就从第一关重来
+    phases 里的方法单独计时, 实例属性会盖住类上的方法, step 调到的就是计时的版本
+    """
+    levels = session.game_levels
+    totals = {name: 0.0 for name in phases}
+    for name in phases:
+        setattr(session, name, timed(getattr(session, name), totals, name))
+    stats = {'ticks': ticks, 'deaths': 0, 'clears': 0, 'score': 0,
+             'max_bullets': 0}
+    session.new_game(1)
+    start = time.perf_counter()
+    try:
+        for _ in range(ticks):
+            session.step(controller(session))
+            stats['max_bullets'] = max(
+                stats['max_bullets'],
+                len(session.bullet_list) + len(session.npc_bullets))
+            if session.player and session.cur_level <= levels:
+                continue
+            if session.cur_level > levels:
+                stats['clears'] += 1
+            else:
+                stats['deaths'] += 1
+            stats['score'] += session.score
+            session.new_game(1)
+    finally:
+        for name in phases:
+            delattr(session, name)
+    stats['seconds'] = time.perf_counter() - start
+    stats['score'] += session.score
+    stats['phases'] = totals
+    return stats
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='bot player, headless '
+                                                 'unless --play')
+    parser.add_argument('--bot', choices=sorted(BOTS), default='shooter')
+    parser.add_argument('--ticks', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seeds both the bot and the npc tanks')
+    parser.add_argument('--levels',
+                        help='level shelve, default generates 3 levels '
+                             '(the game\'s own levels with --play)')
+    parser.add_argument('--size', type=int, default=26,
+                        help='map size of the generated levels')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the 15 most expensive functions')
+    parser.add_argument('--play', action='store_true',
+                        help='open the game window and watch the bot play')
+    args = parser.parse_args(argv)
+
+    map_file = args.levels and levelpack.shelve_path(args.levels)
+    if args.play:
+        # game.py 直接运行时是 __main__, 从这里启动才只导入一份 game
+        game = Game()
+        if map_file:
+            game.session.map_file = map_file
+        game.session.rng.seed(args.seed)
+        game.controller = BOTS[args.bot](seed=args.seed)
+        game.start()
+        return 0
+    if map_file is None:
+        map_file = tempfile.mkdtemp() + '/map'
+        levelpack.write_shelve(map_file, levelgen.generate(
+            3, seed=args.seed, width=args.size, height=args.size,
+            tanks=max(args.size // 5, 1)), replace=True)
+    session = GameSession(map_file, seed=args.seed)
+    controller = BOTS[args.bot](seed=args.seed)
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+    stats = play(session, controller, args.ticks)
+    if profile:
+        profile.disable()
+    print('{bot}: {ticks} ticks in {seconds:.2f}s, {rate:.0f} ticks/s, '
+          '{deaths} deaths, {clears} clears, score {score}, '
+          'max {max_bullets} bullets'.format(
+              bot=args.bot, rate=stats['ticks'] / stats['seconds'], **stats))
+    for name, cost in stats['phases'].items():
+        print('  {:<24}{:8.3f} ms/tick'.format(
+            name, cost * 1000 / stats['ticks']))
+    if profile:
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(15)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
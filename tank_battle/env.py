@@ -0,0 +1,261 @@
+# coding:utf-8
+"""
+强化学习用的环境, 接口和 gym 一样, 不开窗口
+
+    env = TankEnv(seed=0)
+    obs = env.reset()
+    obs, reward, done, info = env.step(env.ACTIONS.index('wj'))
+
+动作是 ACTIONS 里的下标, 也可以直接给 'wj' 这样的按键字符串, 对应 handler_user_input
+里的 K_w/a/s/d/j
+观察是 (通道, 宽, 高) 的 uint8 数组, 和 DataMap 一样按 x, y 取格子, 每个通道是 0/1:
+    hard_wall, soft_wall, green_land    地图
+    npc_tank, npc_bullet, bullet, player    精灵盖住的格子
+数组只分配一次, 每帧原地更新, step() 返回的总是同一个数组, 要保留请自己 copy
+奖励是这一帧 score 的增加 (play_bomb 里打掉坦克加 10), 玩家死了再扣 death_penalty
+
+obs_type='pixels' 时观察换成画面: 用 draw_session 画到离屏 Surface 上, 和 game_loop
+里 draw_game_area 画的一样, 不开窗口. 像素通过 surfarray 直接读, 不先拷出整张图,
+downsample 隔 k 个像素取一个, grayscale 转成灰度, frames 把最近几帧叠在一起:
+    env = TankEnv(obs_type='pixels', downsample=4, grayscale=True, frames=4)
+    obs = env.reset()    # (4, 195, 195), 按 x, y 取像素
+多个环境要凑一批时, 把批数组的每一行交给 PixelObserver.frame(out=...)
+"""
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+from pygame import surfarray
+from pygame.surface import Surface
+
+from game import GameSession, KeyState, MapItem, draw_session
+
+MAP_CHANNELS = (MapItem.hard_wall, MapItem.soft_wall, MapItem.green_land)
+CHANNELS = ('hard_wall', 'soft_wall', 'green_land',
+            'npc_tank', 'npc_bullet', 'bullet', 'player')
+
+
+# 和 ITU-R 601 的 0.299, 0.587, 0.114 差不多, 加起来是 256, 右移 8 位就是灰度
+GRAY_WEIGHTS = (77, 150, 29)
+
+
+class FrameStack(object):
+    """
+    最近 frames 帧的环形缓冲, 内存只分配一次
+    每帧写两份 (i 和 i + frames), 这样从旧到新的 frames 帧总是连续的一段, 取出时不用拷贝
+    """
+
+    def __init__(self, frames, shape, dtype=np.uint8):
+        self.frames = frames
+        self.buffer = np.zeros((2 * frames,) + tuple(shape), dtype)
+        self.pos = 0
+
+    def push(self, frame) -> np.ndarray:
+        self.pos = (self.pos + 1) % self.frames
+        self.buffer[self.pos] = frame
+        self.buffer[self.pos + self.frames] = frame
+        return self.stacked()
+
+    def reset(self, frame) -> np.ndarray:
+        self.buffer[:] = frame
+        self.pos = 0
+        return self.stacked()
+
+    def stacked(self) -> np.ndarray:
+        return self.buffer[self.pos + 1:self.pos + 1 + self.frames]
+
+
+class PixelObserver(object):
+    """
+    把一局游戏的视口画到离屏 Surface 上, 再按 downsample, grayscale 处理成 uint8 数组
+    像素和 surfarray 一样按 (x, y, rgb) 排, 灰度时没有最后一维
+    """
+
+    def __init__(self, session: GameSession, downsample=1, grayscale=False):
+        self.session = session
+        self.downsample = downsample
+        self.grayscale = grayscale
+        # 不经过 display.set_mode, 深度固定 32 位, surfarray 才能直接引用像素
+        self.surface = Surface(session.size, 0, 32)
+        width, height = session.size
+        self.shape = ((width - 1) // downsample + 1,
+                      (height - 1) // downsample + 1)
+        if not grayscale:
+            self.shape += (3,)
+        self.out = np.zeros(self.shape, np.uint8)
+        if grayscale:
+            self.acc = np.zeros(self.shape, np.uint16)
+            self.tmp = np.zeros(self.shape, np.uint16)
+
+    def render(self) -> None:
+        # 和 draw_playing 一样先把战场涂黑
+        self.surface.fill((0, 0, 0))
+        draw_session(self.surface, self.session)
+
+    @contextmanager
+    def pixels(self) -> Iterator[np.ndarray]:
+        """
+        surface 像素的 (宽, 高, 3) 视图, 不拷贝
+        视图活着的时候 surface 是锁住的, 不能 blit, 所以只在 with 里面用
+        """
+        view = surfarray.pixels3d(self.surface)
+        try:
+            yield view
+        finally:
+            del view
+
+    def frame(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        画一帧并处理好, 结果写到 out 里 (默认是自己的缓冲), 返回 out
+        """
+        if out is None:
+            out = self.out
+        self.render()
+        k = self.downsample
+        with self.pixels() as view:
+            # 隔 k 取一个也只是视图, 子弹 9 像素, k 不超过 9 都不会丢
+            view = view[::k, ::k]
+            if self.grayscale:
+                acc, tmp = self.acc, self.tmp
+                np.multiply(view[..., 0], GRAY_WEIGHTS[0], out=acc,
+                            dtype=np.uint16)
+                for c in (1, 2):
+                    np.multiply(view[..., c], GRAY_WEIGHTS[c], out=tmp,
+                                dtype=np.uint16)
+                    acc += tmp
+                np.right_shift(acc, 8, out=acc)
+                np.copyto(out, acc, casting='unsafe')
+            else:
+                np.copyto(out, view)
+            del view
+        return out
+
+
+def observe_batch(observers: Sequence[PixelObserver],
+                  out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    多局一起取画面, 直接写进 (局数,) + shape 的批数组, 批数组可以反复传进来复用
+    """
+    if out is None:
+        out = np.zeros((len(observers),) + observers[0].shape, np.uint8)
+    for i, observer in enumerate(observers):
+        observer.frame(out[i])
+    return out
+
+
+class TankEnv(object):
+    ACTIONS = ('', 'w', 'a', 's', 'd', 'j', 'wj', 'aj', 'sj', 'dj')
+
+    def __init__(self, map_file=None, seed=None, death_penalty=100,
+                 max_steps=None, obs_type='grid', downsample=1,
+                 grayscale=False, frames=1):
+        if obs_type not in ('grid', 'pixels'):
+            raise ValueError('unknown obs_type {!r}'.format(obs_type))
+        self.session = GameSession(map_file, seed=seed)
+        self.obs_type = obs_type
+        self.pixel = None
+        self.stack = None
+        if obs_type == 'pixels':
+            self.pixel = PixelObserver(self.session, downsample, grayscale)
+            self.stack = FrameStack(frames, self.pixel.shape)
+        # game_levels 每次都要打开 shelve, 只在 reset 时读
+        self.levels = 0
+        self.death_penalty = death_penalty
+        self.max_steps = max_steps
+        self.steps = 0
+        self.score = 0
+        self.obs = None
+        self.field = None
+        self.keys = {action: KeyState(action) for action in self.ACTIONS}
+
+    @property
+    def observation_shape(self) -> Tuple[int, int, int]:
+        return self.obs.shape
+
+    def reset(self, seed=None) -> np.ndarray:
+        session = self.session
+        if seed is not None:
+            session.rng.seed(seed)
+        session.clear_all_sprites()
+        session.tick = 0
+        self.levels = session.game_levels
+        session.new_game(1)
+        self.steps = 0
+        self.score = session.score
+        self.field = None
+        if self.pixel:
+            self.obs = self.stack.reset(self.pixel.frame())
+        else:
+            self.observe()
+        return self.obs
+
+    def step(self, action) -> Tuple[np.ndarray, float, bool, Dict]:
+        session = self.session
+        if isinstance(action, str):
+            keys = self.keys.get(action) or KeyState(action)
+        else:
+            keys = self.keys[self.ACTIONS[action]]
+        session.step(keys)
+        self.steps += 1
+        reward = session.score - self.score
+        self.score = session.score
+        dead = not session.player and session.cur_level <= self.levels
+        if dead:
+            reward -= self.death_penalty
+        cleared = session.cur_level > self.levels
+        done = dead or cleared or (self.max_steps is not None and
+                                   self.steps >= self.max_steps)
+        if self.pixel:
+            self.obs = self.stack.push(self.pixel.frame())
+        else:
+            self.observe()
+        info = {'score': session.score, 'level': session.cur_level,
+                'tick': session.tick, 'dead': dead, 'cleared': cleared}
+        return self.obs, reward, done, info
+
+    def observe(self) -> None:
+        session = self.session
+        field = session.battle_field
+        if field is not self.field:
+            self.load_map(field)
+        else:
+            # 地图只有被打掉的软墙会变, 按 DataMap 的改动记录更新
+            obs = self.obs
+            for x, y, val in field.journal:
+                for c, item in enumerate(MAP_CHANNELS):
+                    obs[c, x, y] = val == item
+            field.journal.clear()
+        self.draw_sprites()
+
+    def load_map(self, field) -> None:
+        shape = (len(CHANNELS), field.width, field.height)
+        if self.obs is None or self.obs.shape != shape:
+            self.obs = np.zeros(shape, np.uint8)
+        grid = np.frombuffer(field.to_bytes(), np.uint8).reshape(
+            field.width, field.height)
+        for c, item in enumerate(MAP_CHANNELS):
+            np.equal(grid, int(item), out=self.obs[c], casting='unsafe')
+        field.journal = list()
+        self.field = field
+
+    def draw_sprites(self) -> None:
+        session = self.session
+        unit = session.min_unit_size
+        obs = self.obs
+        base = len(MAP_CHANNELS)
+        obs[base:].fill(0)
+        groups = (session.npc_tanks, session.npc_bullets, session.bullet_list,
+                  session.player_group)
+        for c, group in enumerate(groups, base):
+            channel = obs[c]
+            for sprite in group:
+                rect = sprite.rect
+                channel[max(rect.left, 0) // unit:(rect.right - 1) // unit + 1,
+                        max(rect.top, 0) // unit:
+                        (rect.bottom - 1) // unit + 1] = 1
+
+    def close(self) -> None:
+        field = self.session.battle_field
+        if field is not None and field.journal is not None:
+            field.journal = None
+        self.session.clear_all_sprites()
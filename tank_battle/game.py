@@ -3,12 +3,23 @@
 # Created at: 2020-02
 # Created by: Jiaming
 
+import argparse
 import sys
 
 from enum import IntEnum, unique
 from typing import Tuple, Optional, List, Any
-from random import randint
+import random
+from random import Random
+from time import perf_counter
+from queue import Queue, Empty
+from array import array
+from bisect import bisect_left
+from collections import deque
+from threading import Event, Lock, Thread
+import hashlib
 import shelve
+import shutil
+import tempfile
 import webbrowser
 import os
 
@@ -16,12 +27,59 @@ from pygame.locals import *
 from pygame.sprite import Sprite, Group, groupcollide, collide_mask, \
     collide_rect
 from pygame.surface import Surface
-from pygame.sysfont import SysFont
+from pygame.font import Font
+from pygame.sysfont import match_font
 from pygame import Rect, init as game_init, display, image, mixer, \
-    mixer_music, time as game_time, key, event, quit as game_quit, mouse
+    mixer_music, time as game_time, key, event, quit as game_quit, mouse, \
+    draw, transform, error as pygame_error
 
+# 坦克和子弹每帧默认移动的像素, GameSession 可以改
 SCALE = 10
 debug = False
+# 图片, 声音和关卡文件都相对于这个文件所在的目录, 和当前目录无关
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def asset_path(path) -> str:
+    # 绝对路径原样返回
+    return os.path.join(ASSET_DIR, path)
+
+
+class StartupTimer(object):
+    """
+    启动耗时统计, 运行 game.py --startup-report 时画出第一帧菜单后打印
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.done = False
+        self.phases = list()
+        self.begin = self.last = perf_counter()
+
+    def mark(self, name) -> None:
+        if self.done:
+            return
+        now = perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def first_frame(self) -> None:
+        if self.done:
+            return
+        self.mark('first frame')
+        self.done = True
+        if self.enabled:
+            print(self.report())
+
+    def report(self) -> str:
+        lines = ['{:<16} {:8.1f} ms'.format(name, cost * 1000)
+                 for name, cost in self.phases]
+        lines.append('{:<16} {:8.1f} ms'.format(
+            'total', (self.last - self.begin) * 1000))
+        return '\n'.join(lines)
+
+
+startup = StartupTimer()
 
 
 def pos2index(pos):
@@ -38,19 +96,28 @@ class Direction(IntEnum):
 
 class Disjoint(object):
     def __init__(self, length):
+        # 负数表示根, 绝对值是集合的大小
         self.array = [-1] * length
 
     def find(self, i):
-        while self.array[i] != -1:
-            i = self.array[i]
-        return i
+        root = i
+        while self.array[root] >= 0:
+            root = self.array[root]
+        # 路径压缩
+        while self.array[i] >= 0:
+            self.array[i], i = root, self.array[i]
+        return root
 
     def union(self, i, j):
         x = self.find(i)
         y = self.find(j)
-        if (x != y) or (x == -1 and y == -1):
+        if x != y:
+            # 按大小合并, 小的挂到大的下面
+            if self.array[x] < self.array[y]:
+                x, y = y, x
+            self.array[y] += self.array[x]
             self.array[x] = y
-        return self.find(i), self.find(j)
+        return y, y
 
     def roots(self):
         root_set = set()
@@ -72,26 +139,24 @@ class MapItem(IntEnum):
 
 
 def map_connect(m: List[List[MapItem]]):
-    h = len(m)
-    w = len(m[0])
+    # m[x][y], 第一维是x
+    w = len(m)
+    h = len(m[0])
     # 使用并查集算法 将不是硬墙的部分连接起来。根据root里empty的
     disj = Disjoint(w * h)
     for i in range(h * w):
-        x, y = i // w, i % w
+        x, y = i // h, i % h
         item = m[x][y]
         if item != MapItem.hard_wall:
-            down_pos = x, y + 1
-            right_pos = x + 1, y
-            left_pos = x - 1, y
-            up_pos = x, y - 1
-            for x_pos, y_pos in [down_pos, right_pos, left_pos, up_pos]:
-                if 0 <= x_pos < w and 0 <= y_pos < h and \
-                        m[x_pos][y_pos] != MapItem.hard_wall:
-                    disj.union(i, x_pos * w + y_pos)
+            # 合并是对称的, 只需要看下边和右边
+            if y + 1 < h and m[x][y + 1] != MapItem.hard_wall:
+                disj.union(i, i + 1)
+            if x + 1 < w and m[x + 1][y] != MapItem.hard_wall:
+                disj.union(i, i + h)
 
     count = 0
     for root in disj.roots():
-        i, j = root // w, root % w
+        i, j = root // h, root % h
         if m[i][j] != MapItem.hard_wall:
             count += 1
     if count == 1:
@@ -100,25 +165,291 @@ def map_connect(m: List[List[MapItem]]):
         return False
 
 
+def spiral_path(width, height) -> List[Tuple[int, int, Direction]]:
+    """
+    从左上角开始顺时针螺旋走遍所有格子, 返回 (x, y, 方向) 列表
+    """
+    step = {Direction.right: (1, 0), Direction.down: (0, 1),
+            Direction.left: (-1, 0), Direction.up: (0, -1)}
+    visited = [[False] * height for _ in range(width)]
+    x, y, direction = 0, 0, Direction.right
+    visited[x][y] = True
+    path = [(x, y, direction)]
+    for _ in range(width * height - 1):
+        dx, dy = step[direction]
+        if not (0 <= x + dx < width and 0 <= y + dy < height) or \
+                visited[x + dx][y + dy]:
+            direction = Direction((direction + 1) % 4)
+            dx, dy = step[direction]
+        x, y = x + dx, y + dy
+        visited[x][y] = True
+        path.append((x, y, direction))
+    return path
+
+
+def line_cells(x0, y0, x1, y1) -> List[Tuple[int, int]]:
+    """
+    Bresenham 直线经过的格子
+    """
+    cells = list()
+    dx, dy = abs(x1 - x0), -abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    err = dx + dy
+    while True:
+        cells.append((x0, y0))
+        if x0 == x1 and y0 == y1:
+            return cells
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x0 += sx
+        if e2 <= dx:
+            err += dx
+            y0 += sy
+
+
+def rect_cells(x0, y0, x1, y1, filled=True) -> List[Tuple[int, int]]:
+    left, right = min(x0, x1), max(x0, x1)
+    top, bottom = min(y0, y1), max(y0, y1)
+    return [(x, y) for x in range(left, right + 1)
+            for y in range(top, bottom + 1)
+            if filled or x in (left, right) or y in (top, bottom)]
+
+
 noway = (MapItem.hard_wall, MapItem.soft_wall)
 
 
+class NavGraph(object):
+    """
+    坦克导航图: 坦克占 2x2 格, 以左上角的格子 (x, y) 作为节点,
+    四个格子都不在 blocked 里时节点可用, 相邻的可用节点用并查集连成区域
+    格子由挡路变成可走 (比如软墙被打掉) 时只做增量合并
+    """
+
+    def __init__(self, data_map, blocked=noway):
+        self.width = data_map.width
+        self.height = data_map.height
+        self.blocked = blocked
+        h = self.height
+        self.free = bytearray(self.width * h)
+        self.regions = Disjoint(self.width * h)
+        m = data_map._map
+        for x in range(self.width - 1):
+            line, right = m[x], m[x + 1]
+            for y in range(h - 1):
+                if line[y] not in blocked and line[y + 1] not in blocked \
+                        and right[y] not in blocked \
+                        and right[y + 1] not in blocked:
+                    self.free[x * h + y] = 1
+        for i in range(self.width * h):
+            if self.free[i]:
+                # 合并是对称的, 只需要看下边和右边
+                if self.free[i + 1]:
+                    self.regions.union(i, i + 1)
+                if i + h < len(self.free) and self.free[i + h]:
+                    self.regions.union(i, i + h)
+
+    def is_free(self, x, y) -> bool:
+        return 0 <= x < self.width and 0 <= y < self.height and \
+            bool(self.free[x * self.height + y])
+
+    def node_at(self, pos) -> Tuple[int, int]:
+        # 像素坐标 (坦克的 location) 对应的节点
+        return pos2index(pos[0]), pos2index(pos[1])
+
+    def region(self, x, y) -> Optional[int]:
+        """
+        (x, y) 所在区域的编号, 坦克放不下时返回 None
+        """
+        if not self.is_free(x, y):
+            return None
+        return self.regions.find(x * self.height + y)
+
+    def region_size(self, x, y) -> int:
+        root = self.region(x, y)
+        return 0 if root is None else -self.regions.array[root]
+
+    def reachable(self, a, b) -> bool:
+        root = self.region(*a)
+        return root is not None and root == self.region(*b)
+
+    def spots(self, region=None) -> List[Tuple[int, int]]:
+        """
+        所有能放下坦克的节点, 给定 region 时只返回这个区域里的
+        """
+        h = self.height
+        return [(i // h, i % h) for i in range(len(self.free))
+                if self.free[i] and
+                (region is None or self.regions.find(i) == region)]
+
+    def open_cell(self, x, y, data_map) -> None:
+        """
+        格子 (x, y) 变成可走, 更新左上方四个节点
+        """
+        h = self.height
+        for nx in (x - 1, x):
+            for ny in (y - 1, y):
+                if not (0 <= nx < self.width - 1 and 0 <= ny < h - 1) or \
+                        self.free[nx * h + ny]:
+                    continue
+                if any(data_map.get(cx, cy) in self.blocked
+                       for cx in (nx, nx + 1) for cy in (ny, ny + 1)):
+                    continue
+                i = nx * h + ny
+                self.free[i] = 1
+                for j, ok in ((i - h, nx > 0), (i + h, True),
+                              (i - 1, ny > 0), (i + 1, True)):
+                    if ok and 0 <= j < len(self.free) and self.free[j]:
+                        self.regions.union(i, j)
+
+
 class DataMap(object):
+    # 导航图按 blocked 缓存, 旧的关卡里没有这个属性
+    _nav = None
+    # 不是 None 时记录每次改动 (x, y, 新值), 给 RewindBuffer 用
+    journal = None
+
     def __init__(self, x, y):
+        # self._map[x][y], 支持宽高不一样的地图
         self._map = list()
         self._width = x
         self._height = y
-        for i in range(y):
+        for i in range(x):
             line = list()
-            for j in range(x):
+            for j in range(y):
                 line.append(MapItem.empty)
             self._map.append(line)
 
-    def set(self, x, y, val):
+    def set(self, x, y, val) -> bool:
         assert isinstance(val, MapItem)
         # check if tank near position x,y
         if MapItem.tank not in self.get_left_up_set(x, y):
+            old = self._map[x][y]
+            self._map[x][y] = val
+            self.changed(x, y, old, val)
+            return True
+        return False
+
+    def set_many(self, cells, val) -> List[Tuple[int, int, MapItem]]:
+        """
+        批量写入, 和逐个调用 set 的结果一样
+        坦克的检查只扫描一次区域, 之后随写入增量更新
+        返回改动过的格子 (x, y, 旧值)
+        """
+        assert isinstance(val, MapItem)
+        cells = [(x, y) for x, y in cells
+                 if 0 <= x < self._width and 0 <= y < self._height]
+        if not cells:
+            return []
+        left = max(0, min(x for x, y in cells) - 1)
+        right = max(x for x, y in cells)
+        top = max(0, min(y for x, y in cells) - 1)
+        bottom = max(y for x, y in cells)
+        # 每个格子被左上方几个坦克挡住
+        blocked = dict()
+
+        def block(tx, ty, n):
+            for pos in ((tx + 1, ty), (tx, ty + 1), (tx + 1, ty + 1)):
+                blocked[pos] = blocked.get(pos, 0) + n
+
+        for x in range(left, right + 1):
+            line = self._map[x]
+            for y in range(top, bottom + 1):
+                if line[y] == MapItem.tank:
+                    block(x, y, 1)
+
+        changed = list()
+        for x, y in cells:
+            old = self._map[x][y]
+            if old == val or blocked.get((x, y)):
+                continue
             self._map[x][y] = val
+            self.changed(x, y, old, val)
+            changed.append((x, y, old))
+            if old == MapItem.tank:
+                block(x, y, -1)
+            if val == MapItem.tank:
+                block(x, y, 1)
+        return changed
+
+    def flood(self, x, y) -> List[Tuple[int, int]]:
+        """
+        和 (x, y) 相同且四连通的所有格子
+        """
+        target = self.get(x, y)
+        if target is None:
+            return []
+        seen = {(x, y)}
+        stack = [(x, y)]
+        cells = list()
+        while stack:
+            x, y = stack.pop()
+            cells.append((x, y))
+            for pos in ((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)):
+                if pos not in seen and self.get(*pos) == target:
+                    seen.add(pos)
+                    stack.append(pos)
+        # 按行列顺序写入, 和手工逐格画的结果一致
+        cells.sort()
+        return cells
+
+    def put(self, x, y, val) -> None:
+        # 不检查坦克, 直接写入, 用于撤销和重做
+        old = self._map[x][y]
+        self._map[x][y] = val
+        self.changed(x, y, old, val)
+
+    def nav(self, blocked=noway) -> NavGraph:
+        """
+        坦克导航图, 第一次用到时计算, 之后随地图改动更新
+        默认软墙也挡路, blocked=(MapItem.hard_wall,) 是软墙都被打掉的情况
+        """
+        if self._nav is None:
+            self._nav = dict()
+        if blocked not in self._nav:
+            self._nav[blocked] = NavGraph(self, blocked)
+        return self._nav[blocked]
+
+    def changed(self, x, y, old, val) -> None:
+        if old == val:
+            return
+        if self.journal is not None:
+            self.journal.append((x, y, val))
+        if not self._nav:
+            return
+        for blocked, graph in list(self._nav.items()):
+            if old in blocked and val not in blocked:
+                graph.open_cell(x, y, self)
+            elif old not in blocked and val in blocked:
+                # 挡路会拆开区域, 并查集拆不开, 下次用到时重算
+                del self._nav[blocked]
+
+    def spawn_cells(self) -> List[Tuple[int, int]]:
+        """
+        init_player 放玩家的位置覆盖的格子
+        """
+        unit = Tank.tank_size // 2
+        left = (self._width * unit - Tank.tank_size) // 2
+        top = self._height * unit - Tank.tank_size
+        return [(x, y)
+                for x in range(left // unit,
+                               (left + Tank.tank_size - 1) // unit + 1)
+                for y in range(top // unit,
+                               (top + Tank.tank_size - 1) // unit + 1)]
+
+    def to_bytes(self) -> bytes:
+        # 按 x, y 顺序每格一个字节
+        return b''.join(map(bytes, self._map))
+
+    @classmethod
+    def from_bytes(cls, width, height, data) -> 'DataMap':
+        items = list(MapItem)
+        data_map = cls(0, 0)
+        data_map._width, data_map._height = width, height
+        data_map._map = [[items[v] for v in data[x * height:(x + 1) * height]]
+                         for x in range(width)]
+        return data_map
 
     def get(self, x, y):
         if 0 <= x <= self.width - 1 and 0 <= y <= self.height - 1:
@@ -157,6 +488,872 @@ class DataMap(object):
         else:
             return False
 
+    def trapped_tanks(self) -> List[Tuple[int, int]]:
+        """
+        开不到玩家出生点的坦克, 软墙算作可以打掉
+        """
+        graph = self.nav((MapItem.hard_wall,))
+        spawn = self.spawn_cells()[0]
+        return [(x, y) for x in range(self._width)
+                for y in range(self._height)
+                if self._map[x][y] == MapItem.tank and
+                not graph.reachable((x, y), spawn)]
+
+
+class EditHistory(object):
+    """
+    编辑记录, 每一笔只保存改动过的格子 (x, y, 旧值, 新值)
+    撤销和重做的代价只和改动的格子数有关
+    """
+
+    def __init__(self, limit=500):
+        self.limit = limit
+        self.undo_stack = list()
+        self.redo_stack = list()
+        self.current = None
+
+    def begin(self) -> None:
+        self.current = list()
+
+    def record(self, x, y, old, new) -> None:
+        if self.current is None:
+            # 不在一笔之内, 单独成为一步
+            self.begin()
+            self.current.append((x, y, old, new))
+            self.end()
+        else:
+            self.current.append((x, y, old, new))
+
+    def end(self) -> None:
+        if self.current:
+            self.undo_stack.append(self.current)
+            if len(self.undo_stack) > self.limit:
+                del self.undo_stack[0]
+            self.redo_stack = list()
+        self.current = None
+
+    def undo(self, data_map: DataMap) -> List[Tuple[int, int]]:
+        if not self.undo_stack:
+            return []
+        diff = self.undo_stack.pop()
+        for x, y, old, new in reversed(diff):
+            data_map.put(x, y, old)
+        self.redo_stack.append(diff)
+        return [(x, y) for x, y, old, new in diff]
+
+    def redo(self, data_map: DataMap) -> List[Tuple[int, int]]:
+        if not self.redo_stack:
+            return []
+        diff = self.redo_stack.pop()
+        for x, y, old, new in diff:
+            data_map.put(x, y, new)
+        self.undo_stack.append(diff)
+        return [(x, y) for x, y, old, new in diff]
+
+
+class Camera(object):
+    """
+    视口, 负责世界坐标和屏幕坐标之间的转换
+    地图比窗口大时跟随玩家滚动, 只绘画视口内的格子和精灵
+    """
+
+    def __init__(self, width, height):
+        self.rect = Rect(0, 0, width, height)
+        self.world_rect = Rect(0, 0, width, height)
+
+    def set_world(self, width, height) -> None:
+        self.world_rect = Rect(0, 0, width, height)
+        self.rect.topleft = 0, 0
+        self.clamp()
+
+    def clamp(self) -> None:
+        # 地图比视口小时, 地图靠左上角
+        self.rect.left = max(0, min(self.rect.left,
+                                    self.world_rect.right - self.rect.width))
+        self.rect.top = max(0, min(self.rect.top,
+                                   self.world_rect.bottom - self.rect.height))
+
+    def follow(self, target: Rect) -> None:
+        self.rect.center = target.center
+        self.clamp()
+
+    def move(self, dx, dy) -> None:
+        self.rect.move_ip(dx, dy)
+        self.clamp()
+
+    def apply(self, rect: Rect) -> Rect:
+        return rect.move(-self.rect.left, -self.rect.top)
+
+    def to_world(self, pos) -> Tuple[int, int]:
+        return pos[0] + self.rect.left, pos[1] + self.rect.top
+
+    def visible(self, rect: Rect) -> bool:
+        return self.rect.colliderect(rect)
+
+    def visible_cells(self, cell_size, width, height) -> Tuple[range, range]:
+        """
+        视口覆盖的格子范围, width和height是地图的格子数
+        """
+        x_range = range(max(0, self.rect.left // cell_size),
+                        min(width, self.rect.right // cell_size + 1))
+        y_range = range(max(0, self.rect.top // cell_size),
+                        min(height, self.rect.bottom // cell_size + 1))
+        return x_range, y_range
+
+
+class LaneIndex(object):
+    """
+    按行分带的精灵索引, 每条带里按矩形左边排序
+    子弹只沿一条线飞, 带宽取坦克大小时子弹最多落在两条带里,
+    查询时在带里二分出 x 方向可能相交的一段, 不用和每个精灵都比一遍
+    """
+
+    def __init__(self, sprites, band):
+        self.band = band
+        self.width = 0
+        lanes = dict()
+        for order, sprite in enumerate(sprites):
+            rect = sprite.rect
+            self.width = max(self.width, rect.width)
+            for lane in range(rect.top // band, (rect.bottom - 1) // band + 1):
+                lanes.setdefault(lane, list()).append(
+                    (rect.left, order, sprite, rect))
+        self.lanes = dict()
+        for lane, items in lanes.items():
+            items.sort(key=lambda item: item[:2])
+            self.lanes[lane] = ([item[0] for item in items], items)
+
+    def query(self, rect) -> List[Sprite]:
+        """
+        和 rect 相交的精灵, 按建索引时的顺序
+        """
+        found = dict()
+        for lane in range(rect.top // self.band,
+                          (rect.bottom - 1) // self.band + 1):
+            entry = self.lanes.get(lane)
+            if entry is None:
+                continue
+            lefts, items = entry
+            lo = bisect_left(lefts, rect.left - self.width + 1)
+            hi = bisect_left(lefts, rect.right)
+            for _, order, sprite, other in items[lo:hi]:
+                if other.colliderect(rect):
+                    found[order] = sprite
+        return [found[order] for order in sorted(found)]
+
+
+# 两组精灵两两比较的次数少于这个数时直接用 groupcollide, 建索引不划算
+LANE_MIN_PAIRS = 64
+
+
+def lane_collide(groupa: Group, groupb: Group, dokilla: bool, dokillb: bool,
+                 collided=None, band=30) -> dict:
+    """
+    和 groupcollide 结果一样, collided 的调用顺序也一样, 但只和矩形相交的精灵比较,
+    所以 collided 只能在矩形相交时返回真 (collide_rect, play_bomb 都是)
+    """
+    if len(groupa) * len(groupb) < LANE_MIN_PAIRS:
+        return groupcollide(groupa, groupb, dokilla, dokillb, collided)
+    crashed = dict()
+    index = LaneIndex(groupb.sprites(), band)
+    size = len(groupb)
+    for sprite in groupa.sprites():
+        hits = list()
+        for other in index.query(sprite.rect):
+            # 前面的精灵已经撞掉了它
+            if other not in groupb:
+                continue
+            if collided is None or collided(sprite, other):
+                if dokillb:
+                    other.kill()
+                    size -= 1
+                hits.append(other)
+        if hits:
+            crashed[sprite] = hits
+            if dokilla:
+                sprite.kill()
+        if len(groupb) != size:
+            # collided 里换了关卡, groupb 整个换了, 和 groupcollide 一样继续比
+            index = LaneIndex(groupb.sprites(), band)
+            size = len(groupb)
+    return crashed
+
+
+class ChunkGrid(object):
+    """
+    把地图按 chunk_size x chunk_size 个格子分块, 记录每块里的NPC坦克
+    只有玩家附近几块里的坦克是醒着的, 其他坦克休眠或低频模拟
+    """
+
+    def __init__(self, width, height, cell_size, chunk_size=13):
+        self.chunk_px = cell_size * chunk_size
+        self.columns = (width + chunk_size - 1) // chunk_size
+        self.rows = (height + chunk_size - 1) // chunk_size
+        # 用dict当有序集合, 保证每次运行的更新顺序一样
+        self.chunks = dict()
+
+    def key(self, pos) -> Tuple[int, int]:
+        cx = min(max(0, pos[0] // self.chunk_px), self.columns - 1)
+        cy = min(max(0, pos[1] // self.chunk_px), self.rows - 1)
+        return cx, cy
+
+    def add(self, tank) -> None:
+        tank.chunk = self.key(tank.rect.center)
+        self.chunks.setdefault(tank.chunk, dict())[tank] = None
+
+    def remove(self, tank) -> None:
+        if tank.chunk in self.chunks:
+            self.chunks[tank.chunk].pop(tank, None)
+        tank.chunk = None
+
+    def move(self, tank) -> None:
+        chunk = self.key(tank.rect.center)
+        if chunk != tank.chunk:
+            self.chunks[tank.chunk].pop(tank, None)
+            tank.chunk = chunk
+            self.chunks.setdefault(chunk, dict())[tank] = None
+
+    def tanks_in(self, chunk) -> List[Sprite]:
+        tanks = self.chunks.get(chunk)
+        if not tanks:
+            return []
+        dead = [tank for tank in tanks if not tank.alive()]
+        for tank in dead:
+            del tanks[tank]
+        return list(tanks)
+
+    def near(self, center, radius) -> List[Tuple[int, int]]:
+        cx, cy = center
+        return [(x, y)
+                for y in range(max(0, cy - radius),
+                               min(self.rows, cy + radius + 1))
+                for x in range(max(0, cx - radius),
+                               min(self.columns, cx + radius + 1))]
+
+    def far(self, center, radius) -> List[Tuple[int, int]]:
+        cx, cy = center
+        return [chunk for chunk in self.chunks
+                if max(abs(chunk[0] - cx), abs(chunk[1] - cy)) > radius]
+
+
+class AIScheduler(object):
+    """
+    NPC坦克的决策调度器
+    移动每帧都做, 决策(find_enemy 和状态切换)按状态和离玩家的距离分散到不同帧:
+    攻击状态和视口内的坦克每帧决策, 离得越远间隔越长
+    新坦克和刚醒的坦克当帧就决策, 决策和移动按传进来的顺序交替, 和 Tank.update 一样
+    每帧决策最多花 budget 秒, 来不及的坦克下一帧先于其他坦克决策
+    """
+
+    def __init__(self, budget=0.004, intervals=(1, 2, 4)):
+        self.budget = budget
+        self.intervals = intervals
+        self.slot = 0
+        self.thought = 0
+
+    def interval(self, tank, view: Rect) -> int:
+        if tank.status == 'attack':
+            return self.intervals[0]
+        rect = tank.rect
+        if view.colliderect(rect):
+            return self.intervals[0]
+        if view.inflate(view.width, view.height).colliderect(rect):
+            return self.intervals[1]
+        return self.intervals[2]
+
+    def run(self, tanks, enemy_rect: Rect, view: Rect, battle_field,
+            tick, move) -> None:
+        """
+        轮到的坦克决策, 每辆坦克决策后调用 move(tank)
+        """
+        start = perf_counter()
+        self.thought = 0
+        # 上一帧超出预算没轮到的, 等得最久的先决策
+        late = [tank for tank in tanks
+                if tank.next_think is not None and tank.next_think < tick]
+        late.sort(key=lambda t: t.next_think)
+        for tank in late:
+            if not self.think(tank, enemy_rect, view, battle_field, tick,
+                              start):
+                break
+        for tank in tanks:
+            if tank.next_think is None or tank.next_think == tick:
+                self.think(tank, enemy_rect, view, battle_field, tick, start)
+            move(tank)
+
+    def think(self, tank, enemy_rect: Rect, view: Rect, battle_field, tick,
+              start) -> bool:
+        if self.thought and perf_counter() - start > self.budget:
+            return False
+        interval = self.interval(tank, view)
+        if tank.next_think is None:
+            # 新坦克的下一次决策轮流分到不同的帧, 远处的坦克不会挤在同一帧
+            self.slot += 1
+            interval = 1 + self.slot % interval
+        tank.think(enemy_rect, battle_field)
+        tank.next_think = tick + interval
+        self.thought += 1
+        return True
+
+
+class Assets(object):
+    """
+    图片和字体缓存, 第一次用到时才从磁盘加载, 同一个文件只加载一次
+    """
+    images = dict()
+    fonts = dict()
+    font_paths = dict()
+
+    @classmethod
+    def image(cls, path) -> Surface:
+        surface = cls.images.get(path)
+        if surface is None:
+            surface = cls.images[path] = image.load(asset_path(path))
+        return surface
+
+    @classmethod
+    def font(cls, size, name='Arial') -> Font:
+        # SysFont 每次都要查系统字体再打开字体文件, 这里每个名字只查一次
+        font = cls.fonts.get((name, size))
+        if font is None:
+            if name not in cls.font_paths:
+                cls.font_paths[name] = match_font(name)
+            font = cls.fonts[name, size] = Font(cls.font_paths[name], size)
+        return font
+
+
+class LazyImage(object):
+    """
+    类属性上的图片, 第一次访问时才加载, 开始菜单用不到的图片不拖慢启动
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner) -> Surface:
+        surface = Assets.image(self.path)
+        # 加载后换成普通的类属性, 之后访问没有额外开销
+        setattr(owner, self.name, surface)
+        return surface
+
+
+class AudioManager(object):
+    """
+    音效管理, 启动时把音效解码好, 播放只用预留的几个声道
+    同一个音效两次播放至少间隔 min_interval 秒, 同时最多 max_voices 个
+    声道都在用时抢占最早开始播放的那个 (优先抢同一个音效的)
+    """
+
+    def __init__(self, sounds, channels=4, min_interval=0.06, max_voices=2):
+        mixer.set_reserved(channels)
+        self.channels = [mixer.Channel(i) for i in range(channels)]
+        # 每个声道正在播的音效和开始的时间
+        self.playing = [(None, 0.0)] * channels
+        self.sounds = {name: mixer.Sound(asset_path(path))
+                       for name, path in sounds.items()}
+        self.min_interval = min_interval
+        self.max_voices = max_voices
+        self.last_played = dict()
+        self.music_on = False
+
+    def play(self, name) -> bool:
+        now = perf_counter()
+        if now - self.last_played.get(name, -self.min_interval) < \
+                self.min_interval:
+            return False
+        busy = [i for i, channel in enumerate(self.channels)
+                if channel.get_busy()]
+        same = [i for i in busy if self.playing[i][0] == name]
+        if len(same) >= self.max_voices:
+            candidates = same
+        elif len(busy) == len(self.channels):
+            candidates = busy
+        else:
+            candidates = [i for i in range(len(self.channels))
+                          if i not in busy]
+        i = min(candidates, key=lambda c: self.playing[c][1])
+        self.channels[i].play(self.sounds[name])
+        self.playing[i] = (name, now)
+        self.last_played[name] = now
+        return True
+
+    def play_music(self, path=None) -> None:
+        # 背景音乐一直循环, 记住状态就不用每帧问 mixer_music.get_busy
+        if path:
+            mixer_music.load(asset_path(path))
+            self.music_on = False
+        if not self.music_on:
+            mixer_music.play(-1)
+            self.music_on = True
+
+    def stop_music(self) -> None:
+        if self.music_on:
+            mixer_music.stop()
+            self.music_on = False
+
+
+class NullAudio(object):
+    """
+    没有声卡或者 debug (benchmark, 无窗口运行) 时用, 什么也不播
+    """
+    music_on = False
+
+    def play(self, name) -> bool:
+        return False
+
+    def play_music(self, path=None) -> None:
+        pass
+
+    def stop_music(self) -> None:
+        pass
+
+
+def fsync_dir(path) -> None:
+    # 换名要等目录刷到磁盘才算数; windows 打不开目录, 那里换名本身就会落盘
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def snapshot_path(path) -> str:
+    """
+    存档当前版本的 shelve 路径
+    指针文件 path.current 里记着版本目录名, 没有指针文件时是直接写在 path 上的旧存档
+    """
+    directory, base = os.path.split(os.path.abspath(path))
+    try:
+        with open(os.path.join(directory, base + '.current')) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return path
+    return os.path.join(directory, version, base)
+
+
+def snapshot_exists(path) -> bool:
+    directory, base = os.path.split(os.path.abspath(snapshot_path(path)))
+    return os.path.isdir(directory) and any(
+        name == base or name.startswith(base + '.')
+        for name in os.listdir(directory))
+
+
+def write_snapshot(path, snapshot) -> None:
+    """
+    把快照写成 shelve 存档, 写到一半崩溃时原来的存档不受影响
+    shelve 按后端不同是一个或几个文件 (dbm.dumb 有 .dat/.dir/.bak), 逐个换名不是原子的,
+    所以每次写进一个新的版本目录, 刷到磁盘后用一次换名把指针文件指过去
+    """
+    directory, base = os.path.split(os.path.abspath(path))
+    prefix = '.{}.'.format(base)
+    version = tempfile.mkdtemp(prefix=prefix, dir=directory)
+    with shelve.open(os.path.join(version, base), 'n') as db:
+        for k, v in snapshot.items():
+            if k == 'map':
+                v = DataMap.from_bytes(*v)
+            db[k] = v
+    for name in os.listdir(version):
+        with open(os.path.join(version, name), 'rb') as f:
+            os.fsync(f.fileno())
+    fsync_dir(version)
+    pointer = os.path.join(directory, base + '.current')
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(os.path.basename(version))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer + '.tmp', pointer)
+    fsync_dir(directory)
+    # 指针换过去以后, 旧版本, 崩溃留下的半截版本和旧格式的存档都用不到了
+    current = os.path.basename(version)
+    for name in os.listdir(directory):
+        target = os.path.join(directory, name)
+        if name.startswith(prefix) and name != current:
+            if os.path.isdir(target):
+                shutil.rmtree(target, ignore_errors=True)
+            else:
+                os.remove(target)
+        elif name == base or os.path.splitext(name) in (
+                (base, '.db'), (base, '.dat'), (base, '.dir'), (base, '.bak'),
+                (base, '.pag')):
+            os.remove(target)
+
+
+class RecordWriter(object):
+    """
+    后台写存档的线程, 主线程只交给它一份快照
+    连续交了多份还没写的快照时只写最新的一份
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = None
+        self.written = 0
+        # 最近一次写失败的异常, 写成功后清掉; failed 是失败的总次数
+        self.error = None
+        self.failed = 0
+
+    def submit(self, path, snapshot) -> None:
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name='record-writer',
+                                 daemon=True)
+            self.thread.start()
+        self.queue.put((path, snapshot))
+
+    def flush(self) -> None:
+        # 等所有交上来的快照写完
+        self.queue.join()
+
+    def run(self) -> None:
+        while True:
+            path, snapshot = self.queue.get()
+            while True:
+                try:
+                    newer = self.queue.get_nowait()
+                except Empty:
+                    break
+                self.queue.task_done()
+                path, snapshot = newer
+            try:
+                write_snapshot(path, snapshot)
+                self.written += 1
+                self.error = None
+            except Exception as e:
+                self.error = e
+                self.failed += 1
+            finally:
+                self.queue.task_done()
+
+
+# 关卡文件同一时间只打开一次, gdbm 后端打开时会锁文件, 缩略图线程也要读
+map_file_lock = Lock()
+
+
+class ThumbnailCache(object):
+    """
+    编辑器关卡浏览用的缩略图, 后台线程读关卡, 按格子画成每格一个像素的调色板图再缩放
+    画好的图按 DataMap.to_bytes() 的 sha1 存进 cache_dir, 关卡没改过就直接读盘,
+    只有改过的关卡才重画. 主线程每帧用 request 告诉它要看哪些关卡, 用 get 取画好的
+    """
+
+    def __init__(self, cache_dir, size=160):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.palette = None
+        # (关卡文件, 关卡号) -> Surface, 关卡不存在时是 None
+        self.ready = dict()
+        # invalidate 每次给关卡的代数加一, forget 给所有关卡的加一,
+        # 读的过程中代数变了说明读到的是旧关卡, 结果不要
+        self.generations = dict()
+        self.epoch = 0
+        self.lock = Lock()
+        self.wanted = list()
+        self.wake = Event()
+        self.thread = None
+        self.rendered = 0
+        self.loaded = 0
+        self.error = None
+
+    def request(self, map_file, levels) -> None:
+        """
+        按顺序要这些关卡的缩略图, 覆盖上一次没做完的请求
+        """
+        if self.palette is None:
+            # 调色板用格子图片的平均色, 第一次进编辑器才加载图片
+            palette = [(0, 0, 0)] * 256
+            for item, path in ((MapItem.hard_wall, 'img/map/hard_wall.png'),
+                               (MapItem.soft_wall, 'img/map/soft_wall.png'),
+                               (MapItem.green_land, 'img/map/green_land.png'),
+                               (MapItem.tank, 'img/tank-up.png')):
+                palette[item] = tuple(
+                    transform.average_color(Assets.image(path)))[:3]
+            self.palette = palette
+        self.wanted = [(map_file, level) for level in levels
+                       if (map_file, level) not in self.ready]
+        if not self.wanted:
+            return
+        if self.thread is None:
+            self.thread = Thread(target=self.run, name='thumbnails',
+                                 daemon=True)
+            self.thread.start()
+        self.wake.set()
+
+    def get(self, map_file, level) -> Optional[Surface]:
+        return self.ready.get((map_file, level))
+
+    def generation(self, job) -> Tuple[int, int]:
+        return self.epoch, self.generations.get(job, 0)
+
+    def invalidate(self, map_file, level) -> None:
+        job = (map_file, level)
+        with self.lock:
+            self.generations[job] = self.generations.get(job, 0) + 1
+            self.ready.pop(job, None)
+
+    def forget(self) -> None:
+        # 关卡文件可能在外面改过, 内存里的都不要了, 没改过的会从磁盘缓存读回来
+        with self.lock:
+            self.epoch += 1
+            self.ready = dict()
+
+    def run(self) -> None:
+        while True:
+            # 主线程随时会换掉 wanted, 每次重新找第一个还没做的
+            job = next((job for job in self.wanted if job not in self.ready),
+                       None)
+            if job is None:
+                self.wake.clear()
+                self.wake.wait()
+                continue
+            generation = self.generation(job)
+            try:
+                thumbnail = self.load(*job)
+            except Exception as e:
+                self.error = e
+                thumbnail = None
+            with self.lock:
+                # 读的时候关卡被存过, 丢掉这张, 还要的话下一圈重新读
+                if self.generation(job) == generation:
+                    self.ready[job] = thumbnail
+
+    def load(self, map_file, level) -> Optional[Surface]:
+        with map_file_lock, shelve.open(map_file, 'c') as db:
+            data_map = db.get(str(level))
+        if data_map is None:
+            return None
+        data = data_map.to_bytes()
+        # 内容一样大小不一样的地图字节也一样, 宽高放进文件名
+        path = os.path.join(self.cache_dir, '{}-{}x{}-{}.png'.format(
+            hashlib.sha1(data).hexdigest(), data_map.width, data_map.height,
+            self.size))
+        if os.path.exists(path):
+            try:
+                thumbnail = image.load(path)
+                self.loaded += 1
+                return thumbnail
+            except pygame_error:
+                # 半截或者坏掉的文件, 重画一张盖掉
+                pass
+        thumbnail = self.render(data_map.width, data_map.height, data)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = path[:-len('.png')] + '.tmp.png'
+        image.save(thumbnail, tmp)
+        os.replace(tmp, path)
+        self.rendered += 1
+        return thumbnail
+
+    def render(self, width, height, data) -> Surface:
+        # 坦克占 2x2 格, 地图里只记了左上角
+        cells = bytearray(data)
+        tank = int(MapItem.tank)
+        i = data.find(tank)
+        while i >= 0:
+            x, y = divmod(i, height)
+            for dx, dy in ((1, 0), (0, 1), (1, 1)):
+                if x + dx < width and y + dy < height:
+                    cells[(x + dx) * height + y + dy] = tank
+            i = data.find(tank, i + 1)
+        # 数据按 x, y 存, 当成 height 宽的图读进来是转置的, 转回来
+        grid = image.frombuffer(bytes(cells), (height, width), 'P')
+        grid.set_palette(self.palette)
+        grid = transform.flip(transform.rotate(grid, -90), True, False)
+        longest = max(width, height)
+        return transform.scale(grid, (self.size * width // longest,
+                                      self.size * height // longest))
+
+
+class RewindBuffer(object):
+    """
+    倒带用的环形缓冲区, 每帧一份紧凑的快照, 只存在内存里
+    地图分段保存: 每段开头存一份完整地图 (关键帧), 之后每帧只存改动的格子;
+    坦克, 子弹, 爆炸和玩家每帧存成一个 int 数组:
+        头部: tick, 分数, 关卡, 有没有玩家, 玩家 x, y, 方向, 射击冷却,
+              坦克数, 玩家子弹数, npc子弹数, 爆炸数, 改动格子数
+        坦克: x, y, 方向, 是否攻击, 剩余生命, 子弹在 npc 子弹里的序号 (-1 没有)
+        子弹: x, y, 方向    爆炸: x, y, 帧号    改动的格子: x, y, 新值
+    超过 seconds 秒或者 limit 字节时丢掉最老的帧, 并把它的改动合进关键帧
+    """
+    HEADER = 13
+
+    def __init__(self, seconds=30, fps=10, keyframe_interval=100,
+                 limit=8 * 1024 * 1024):
+        self.capacity = seconds * fps
+        self.fps = fps
+        self.keyframe_interval = keyframe_interval
+        self.limit = limit
+        # 每段是 [宽, 高, 关卡, 关键帧地图, deque(每帧的数组)]
+        self.segments = deque()
+        self.field = None
+        self.frames = 0
+        self.size = 0
+
+    def clear(self) -> None:
+        if self.field is not None:
+            self.field.journal = None
+        self.segments.clear()
+        self.field = None
+        self.frames = 0
+        self.size = 0
+
+    def memory(self) -> int:
+        return self.size
+
+    def report(self) -> str:
+        return 'rewind: {} frames ({:.1f}s), {} keyframes, {:.1f} KB'.format(
+            self.frames, self.frames / self.fps, len(self.segments),
+            self.size / 1024)
+
+    def record(self, session) -> None:
+        field = session.battle_field
+        if field is not self.field or \
+                len(self.segments[-1][4]) >= self.keyframe_interval:
+            # 换了地图或者这一段太长, 开始新的一段
+            if self.field is not None and self.field is not field:
+                self.field.journal = None
+            self.field = field
+            field.journal = list()
+            keyframe = bytearray(field.to_bytes())
+            self.segments.append([field.width, field.height, session.cur_level,
+                                  keyframe, deque()])
+            self.size += sys.getsizeof(keyframe)
+        changes = field.journal
+        field.journal = list()
+
+        player = session.player
+        tanks = session.npc_tanks.sprites()
+        bullets = session.bullet_list.sprites()
+        npc_bullets = session.npc_bullets.sprites()
+        bombs = session.bombs.sprites()
+        owner = {id(bullet): i for i, bullet in enumerate(npc_bullets)}
+        data = array('i', (session.tick, session.score, session.cur_level))
+        if player:
+            data.extend((1, player.location[0], player.location[1],
+                         player.direction, player.bullet_tick))
+        else:
+            data.extend((0, 0, 0, 0, 0))
+        data.extend((len(tanks), len(bullets), len(npc_bullets),
+                     len(bombs), len(changes)))
+        for tank in tanks:
+            data.extend((tank.location[0], tank.location[1], tank.direction,
+                         tank.status == 'attack', tank.rest_life,
+                         owner.get(id(tank.bullet), -1)))
+        for bullet in bullets + npc_bullets:
+            data.extend((bullet.location[0], bullet.location[1],
+                         bullet.direction))
+        for bomb in bombs:
+            data.extend((bomb.pos[0], bomb.pos[1], bomb.bomb_num))
+        for x, y, val in changes:
+            data.extend((x, y, val))
+        self.segments[-1][4].append(data)
+        self.frames += 1
+        self.size += sys.getsizeof(data)
+        while self.frames > self.capacity or \
+                (self.size > self.limit and self.frames > 1):
+            self.drop_oldest()
+
+    def drop_oldest(self) -> None:
+        width, height, level, keyframe, frames = self.segments[0]
+        data = frames.popleft()
+        self.frames -= 1
+        self.size -= sys.getsizeof(data)
+        if not frames and len(self.segments) > 1:
+            self.segments.popleft()
+            self.size -= sys.getsizeof(keyframe)
+            return
+        # 把最老一帧的改动合进关键帧
+        start = len(data) - data[self.HEADER - 1] * 3
+        for k in range(start, len(data), 3):
+            keyframe[data[k] * height + data[k + 1]] = data[k + 2]
+
+    def rewind(self, session, seconds) -> bool:
+        """
+        回到 seconds 秒前, 之后的帧全部丢掉, 缓冲区里不够时回到最老的一帧
+        """
+        if not self.frames:
+            return False
+        target = max(1, self.frames - int(seconds * self.fps))
+        while self.frames > target:
+            frames = self.segments[-1][4]
+            data = frames.pop()
+            self.frames -= 1
+            self.size -= sys.getsizeof(data)
+            if not frames:
+                keyframe = self.segments.pop()[3]
+                self.size -= sys.getsizeof(keyframe)
+        width, height, level, keyframe, frames = self.segments[-1]
+        grid = bytearray(keyframe)
+        for data in frames:
+            start = len(data) - data[self.HEADER - 1] * 3
+            for k in range(start, len(data), 3):
+                grid[data[k] * height + data[k + 1]] = data[k + 2]
+        self.restore(session, DataMap.from_bytes(width, height, grid),
+                     frames[-1])
+        # 恢复出来的是新的 DataMap, 下一帧会从这里开始新的一段
+        return True
+
+    @staticmethod
+    def restore(session, field, data) -> None:
+        session.tick, session.score, session.cur_level = data[:3]
+        session.battle_field = field
+        session.clear_all_sprites()
+        session.load_level()
+        # load_level 按地图放的坦克换成快照里的坦克
+        session.npc_tanks.empty()
+        session.init_player()
+        if data[3]:
+            session.player.location = [data[4], data[5]]
+            session.player.direction = Direction(data[6])
+            session.player.bullet_tick = data[7]
+        else:
+            session.player_group.empty()
+        n_tanks, n_bullets, n_npc_bullets, n_bombs = data[8:12]
+        k = RewindBuffer.HEADER
+        tanks = list()
+        for _ in range(n_tanks):
+            x, y, direction, attack, rest_life, bullet = data[k:k + 6]
+            k += 6
+            tank = Tank(session.surface, npc_bullet_list=session.npc_bullets,
+                        location=[x, y], direction=Direction(direction),
+                        max_w=session.world_width, max_h=session.world_height,
+                        scale=session.scale, rng=session.rng)
+            tank.status = 'attack' if attack else 'patrol'
+            tank.rest_life = rest_life
+            tanks.append((tank, bullet))
+            session.add_npc_tank(tank)
+        npc_bullets = list()
+        for i in range(n_bullets + n_npc_bullets):
+            x, y, direction = data[k:k + 3]
+            k += 3
+            bullet_type = 'user' if i < n_bullets else 'npc'
+            bullet = Bullet((x, y), Direction(direction),
+                            bullet_type=bullet_type,
+                            max_w=session.world_width,
+                            max_h=session.world_height, scale=session.scale)
+            bullet.location = (x, y)
+            if bullet_type == 'user':
+                session.bullet_list.add(bullet)
+            else:
+                session.npc_bullets.add(bullet)
+                npc_bullets.append(bullet)
+        for tank, bullet in tanks:
+            if bullet >= 0:
+                tank.bullet = npc_bullets[bullet]
+        for _ in range(n_bombs):
+            x, y, bomb_num = data[k:k + 3]
+            k += 3
+            bomb = Bomb((x, y), session.surface)
+            bomb.pos = [x, y]
+            bomb.bomb_num = bomb_num
+            session.bombs.add(bomb)
+
 
 class Button(object):
     def __init__(self, screen: Surface, **kwargs):
@@ -171,21 +1368,18 @@ class Button(object):
         self.hover = False
         self.x, self.y = kwargs.get('x', None), kwargs.get('y', None)
 
-        bg_image_path = kwargs.get('bg_image', None)
-        if bg_image_path:
-            self._bg_image = image.load(bg_image_path)
-        else:
-            self._bg_image = None
-            self._font = SysFont("Arial", self._font_size)
-            self._bigger_font = SysFont("Arial", self._font_size + 5)
+        self._bg_image_path = kwargs.get('bg_image', None)
+        if not self._bg_image_path:
+            self._font = Assets.font(self._font_size)
+            self._bigger_font = Assets.font(self._font_size + 5)
 
     def handler_event(self, evt):
         self._handler_event(evt)
 
     @property
     def render(self):
-        if self._bg_image:
-            return self._bg_image
+        if self._bg_image_path:
+            return Assets.image(self._bg_image_path)
         if self._hover:
             return self._bigger_font.render(self.text, True, self.fg, self.bg)
         else:
@@ -267,19 +1461,17 @@ class Button(object):
 
 
 class Bullet(Sprite):
-    player_bullet_up_image = image.load("img/player-bullet-up.png")
-    player_bullet_down_image = image.load("img/player-bullet-down.png")
-    player_bullet_left_image = image.load("img/player-bullet-left.png")
-    player_bullet_right_image = image.load("img/player-bullet-right.png")
-    npc_bullet_up_image = image.load("img/npc-bullet-up.png")
-    npc_bullet_down_image = image.load("img/npc-bullet-down.png")
-    npc_bullet_left_image = image.load("img/npc-bullet-left.png")
-    npc_bullet_right_image = image.load("img/npc-bullet-right.png")
-    bullet_size = npc_bullet_right_image.get_rect().width
+    player_bullet_up_image = LazyImage("img/player-bullet-up.png")
+    player_bullet_down_image = LazyImage("img/player-bullet-down.png")
+    player_bullet_left_image = LazyImage("img/player-bullet-left.png")
+    player_bullet_right_image = LazyImage("img/player-bullet-right.png")
+    npc_bullet_up_image = LazyImage("img/npc-bullet-up.png")
+    npc_bullet_down_image = LazyImage("img/npc-bullet-down.png")
+    npc_bullet_left_image = LazyImage("img/npc-bullet-left.png")
+    npc_bullet_right_image = LazyImage("img/npc-bullet-right.png")
 
     def __init__(self, location: Tuple, direction: Direction,
                  bullet_type: Optional[str] = 'user', **kwargs):
-        global SCALE
         Sprite.__init__(self)
         self.location = [location[0] + self.bullet_size // 2 + 2,
                          location[1] + self.bullet_size // 2 + 2]
@@ -287,8 +1479,13 @@ class Bullet(Sprite):
         self._bullet_type = bullet_type
         self.max_w = kwargs['max_w']
         self.max_h = kwargs['max_h']
+        self.scale = kwargs.get('scale', SCALE)
         self.status = 'alive'
 
+    @property
+    def bullet_size(self) -> int:
+        return self.npc_bullet_right_image.get_rect().width
+
     @property
     def image(self):
         if self._bullet_type == 'user':
@@ -308,16 +1505,18 @@ class Bullet(Sprite):
     def rect(self) -> Rect:
         return self.image.get_rect().move(self.location[0], self.location[1])
 
-    def update(self) -> None:
+    def update(self, distance=None) -> None:
+        if distance is None:
+            distance = self.scale
         x, y = self.location
         if self.direction == Direction.right:
-            x += SCALE
+            x += distance
         elif self.direction == Direction.down:
-            y += SCALE
+            y += distance
         elif self.direction == Direction.left:
-            x -= SCALE
+            x -= distance
         elif self.direction == Direction.up:
-            y -= SCALE
+            y -= distance
         else:
             raise Exception('no such direction {}'.format(self.direction))
 
@@ -345,24 +1544,29 @@ class Bomb(Sprite):
         self.pos = [pos[0] - 28, pos[1] - 28]
         self.surface = surface
 
+    @property
+    def bomb_size(self) -> int:
+        return Assets.image("img/bomb/bomb-1.png").get_rect().width
+
     @property
     def image(self) -> Surface:
-        return image.load(
-            "img/bomb/bomb-{}.png".format(self.bomb_num))
+        return Assets.image("img/bomb/bomb-{}.png".format(self.bomb_num))
+
+    @property
+    def rect(self) -> Rect:
+        return Rect(self.pos[0], self.pos[1], self.bomb_size, self.bomb_size)
 
     def update(self) -> None:
         self.bomb_num += 1
-        self.draw()
-
-    def draw(self) -> None:
         if self.bomb_num > 14:
             self.kill()
-            return
+
+    def draw(self) -> None:
         self.surface.blit(self.image, self.pos)
 
 
 class HardWall(Sprite):
-    _image = image.load("img/map/hard_wall.png")
+    _image = LazyImage("img/map/hard_wall.png")
 
     def __init__(self, location: Tuple, surface: Surface):
         super().__init__()
@@ -385,7 +1589,7 @@ class HardWall(Sprite):
 
 
 class SoftWall(Sprite):
-    _image = image.load("img/map/soft_wall.png")
+    _image = LazyImage("img/map/soft_wall.png")
 
     def __init__(self, location: Tuple, surface: Surface):
         super().__init__()
@@ -408,7 +1612,7 @@ class SoftWall(Sprite):
 
 
 class GreenLand(Sprite):
-    _image = image.load("img/map/green_land.png")
+    _image = LazyImage("img/map/green_land.png")
 
     def __init__(self, location: Tuple, surface: Surface):
         super().__init__()
@@ -431,15 +1635,18 @@ class GreenLand(Sprite):
 
 
 class Player(Sprite):
-    player_right = image.load("img/player-right.png")
-    player_down = image.load("img/player-down.png")
-    player_left = image.load("img/player-left.png")
-    player_up = image.load("img/player-up.png")
+    images = {Direction.right: "img/player-right.png",
+              Direction.down: "img/player-down.png",
+              Direction.left: "img/player-left.png",
+              Direction.up: "img/player-up.png"}
+    player_right = LazyImage(images[Direction.right])
+    player_down = LazyImage(images[Direction.down])
+    player_left = LazyImage(images[Direction.left])
+    player_up = LazyImage(images[Direction.up])
 
     def __init__(self, location: List, bullet_list: Group, surface: Surface,
                  **kwargs):
         super().__init__()
-        global SCALE
         direction = kwargs.get('direction', None)
         if direction is None:
             self.direction = Direction.up
@@ -450,7 +1657,7 @@ class Player(Sprite):
         self.bullet_interval = 5
         self.max_w = kwargs['max_w']
         self.max_h = kwargs['max_h']
-        self.scale = SCALE
+        self.scale = kwargs.get('scale', SCALE)
         self.bullet_list = bullet_list
         self.surface = surface
 
@@ -486,7 +1693,7 @@ class Player(Sprite):
         next_item2 = battle_field.get(*loc2)
         next_item3 = battle_field.get(*loc3)
         if (next_item1 in noway) or (next_item2 in noway) or \
-                (next_item3 in noway) or self.rect.bottom + 1 > self.max_w:
+                (next_item3 in noway) or self.rect.bottom + 1 > self.max_h:
             pass
         else:
             self.location[1] = self.location[1] + self.scale
@@ -540,7 +1747,7 @@ class Player(Sprite):
         return Player(next_pos, self.bullet_list, self.surface,
                       direction=self.direction,
                       max_h=self.max_h,
-                      max_w=self.max_w)
+                      max_w=self.max_w, scale=self.scale)
 
     def shot(self) -> None:
         """
@@ -565,7 +1772,8 @@ class Player(Sprite):
         else:
             raise Exception("no such direction {}".format(self.direction))
         self.bullet_list.add(Bullet(bullet_pos, self.direction,
-                                    max_h=self.max_h, max_w=self.max_w))
+                                    max_h=self.max_h, max_w=self.max_w,
+                                    scale=self.scale))
 
     @property
     def image(self) -> Surface:
@@ -582,33 +1790,46 @@ class Player(Sprite):
     def rect(self) -> Rect:
         return self.image.get_rect().move(self.location[0], self.location[1])
 
-    def draw(self) -> None:
+    def update(self, *args) -> None:
+        # 射击冷却
         if self.bullet_tick > 0:
             self.bullet_tick += 1
         if self.bullet_tick > self.bullet_interval:
             self.bullet_tick = 0
+
+    def draw(self) -> None:
         self.surface.blit(self.image, self.rect)
 
 
 class Tank(Sprite):
-    tank_right = image.load("img/tank-right.png")
-    tank_down = image.load("img/tank-down.png")
-    tank_left = image.load("img/tank-left.png")
-    tank_up = image.load("img/tank-up.png")
-    tank_size = tank_up.get_rect().width
+    tank_right = LazyImage("img/tank-right.png")
+    tank_down = LazyImage("img/tank-down.png")
+    tank_left = LazyImage("img/tank-left.png")
+    tank_up = LazyImage("img/tank-up.png")
+    # 窗口布局要用到坦克大小, 只有这一张图在启动时加载
+    tank_size = Assets.image("img/tank-up.png").get_rect().width
 
     def __init__(self, surface: Surface, npc_bullet_list: Group, **kwargs):
-        global SCALE
         super().__init__()
-        self.scale = SCALE
+        self.scale = kwargs.get('scale', SCALE)
+        # 没给随机数发生器时用 random 模块的
+        self.rng = kwargs.get('rng') or random
         self.bullet_tick = 0
         self.bullet_interval = 5
-        self.direction = kwargs.get('direction') or randint(0, 3)
-        self.location = kwargs.get('location') or [randint(0, 12) * self.scale,
-                                                   randint(0, 12) * self.scale]
+        # Direction.right 是 0, 不能用 or
+        self.direction = kwargs.get('direction')
+        if self.direction is None:
+            self.direction = self.rng.randint(0, 3)
+        self.location = kwargs.get('location') or [
+            self.rng.randint(0, 12) * self.scale,
+            self.rng.randint(0, 12) * self.scale]
 
         self.status = 'patrol'
         self.rest_life = 3
+        # ChunkGrid 里所在的块
+        self.chunk = None
+        # AIScheduler 安排的下一次决策的帧
+        self.next_think = None
         self.max_w = kwargs['max_w']
         self.max_h = kwargs['max_h']
         bullet = kwargs.get('bullet', None)
@@ -618,11 +1839,26 @@ class Tank(Sprite):
         else:
             self.bullet = Bullet(bullet['location'], bullet['direction'],
                                  max_h=self.max_h, max_w=self.max_w,
-                                 bullet_type='npc')
+                                 bullet_type='npc', scale=self.scale)
+            # 存档里是子弹自己的位置, 不用再按发射位置偏移
+            self.bullet.location = tuple(bullet['location'])
             self.npc_bullet_list.add(self.bullet)
 
         self.surface = surface
 
+    def recycle(self, location, direction) -> None:
+        """
+        从对象池里取出来重新用, 状态和刚建好的坦克一样
+        """
+        self.location = list(location)
+        self.direction = direction
+        self.status = 'patrol'
+        self.rest_life = 3
+        self.bullet_tick = 0
+        self.bullet = None
+        self.chunk = None
+        self.next_think = None
+
     def find_enemy(self, enemy_rect: Rect,
                    battle_field: List[List[Any]]) -> bool:
 
@@ -651,6 +1887,14 @@ class Tank(Sprite):
         else:
             return
 
+        self.think(enemy_rect, battle_field)
+        # 更新位置
+        self.move(battle_field)
+
+    def think(self, enemy_rect: Rect, battle_field: List[List[Any]]) -> None:
+        """
+        决策部分, 根据敌人位置切换状态
+        """
         if self.status == 'patrol':
             if not self.find_enemy(enemy_rect, battle_field):
                 # 没有情况继续巡逻
@@ -668,12 +1912,7 @@ class Tank(Sprite):
                 # 进入巡逻模式
                 self.status = 'patrol'
 
-        # 更新位置
-        self.move(battle_field)
-        # 绘画
-        self.draw()
-
-    def move(self, battle_field) -> None:
+    def move(self, battle_field, shoot=True) -> None:
         # 根据当前状态行动
         move_x, move_y = 0, 0
         x, y = self.location
@@ -710,7 +1949,7 @@ class Tank(Sprite):
                 next_item3 = battle_field.get(*loc3)
                 if (next_item1 in noway) or (next_item2 in noway) or \
                         (next_item3 in noway) or \
-                        self.rect.bottom + 1 > self.max_w:
+                        self.rect.bottom + 1 > self.max_h:
                     self.direction = Direction.up
                 else:
                     move_y += self.scale
@@ -751,9 +1990,9 @@ class Tank(Sprite):
             self.location[0] += move_x
             self.location[1] += move_y
             # random turn
-            if randint(1, 10) == 10:
+            if self.rng.randint(1, 10) == 10:
                 self.direction = Direction((self.direction + 1) % 4)
-            if randint(1, 15) == 15:
+            if self.rng.randint(1, 15) == 15 and shoot:
                 self.shot()
 
     @property
@@ -787,7 +2026,7 @@ class Tank(Sprite):
         return Tank(self.surface, self.npc_bullet_list, location=next_pos,
                     direction=self.direction,
                     max_h=self.max_h,
-                    max_w=self.max_w)
+                    max_w=self.max_w, scale=self.scale)
 
     def shot(self) -> None:
         """
@@ -813,65 +2052,199 @@ class Tank(Sprite):
         else:
             raise Exception("no such direction {}".format(self.direction))
         self.bullet = Bullet(bullet_pos, self.direction, max_h=self.max_h,
-                             max_w=self.max_w, bullet_type='npc')
+                             max_w=self.max_w, bullet_type='npc',
+                             scale=self.scale)
         self.npc_bullet_list.add(self.bullet)
 
     def draw(self) -> None:
         self.surface.blit(self.image, self.rect)
 
 
-# TODO 制作关卡编辑器
-
-
-class Game(object):
+class KeyState(object):
+    """
+    合成的按键状态, 和 key.get_pressed() 一样按键码取值
+    keys 是 w/a/s/d/j 组成的字符串, 服务器, 机器人和训练环境用它代替键盘
+    """
+    KEYS = {'w': K_w, 'a': K_a, 's': K_s, 'd': K_d, 'j': K_j}
+
+    def __init__(self, keys=''):
+        self.text = ''.join(sorted(set(keys) & set(self.KEYS)))
+        self.pressed = {self.KEYS[k] for k in self.text}
+
+    def __getitem__(self, k) -> bool:
+        return k in self.pressed
+
+
+class Controller(object):
+    """
+    玩家的输入来源, 每帧调用一次, 返回的按键状态交给 GameSession.step
+    默认读键盘, bots.py 里的机器人返回 KeyState
+    """
+
+    def __call__(self, session) -> Any:
+        return key.get_pressed()
+
+
+class LatencyHistogram(object):
+    """
+    按键到生效的延迟分布, 每格 bin_ms 毫秒, 超出的都算进最后一格
+    """
+
+    def __init__(self, bin_ms=10, bins=25):
+        self.bin_ms = bin_ms
+        self.counts = [0] * bins
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+        # 按了但是这一帧没有效果: 撞墙, 射击冷却, 玩家已经死了
+        self.missed = 0
+
+    def add(self, seconds) -> None:
+        ms = seconds * 1000
+        self.counts[min(int(ms // self.bin_ms), len(self.counts) - 1)] += 1
+        self.total += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p) -> float:
+        # 只知道落在哪一格, 返回那一格的上界
+        rank = p / 100 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return (i + 1) * self.bin_ms
+        return len(self.counts) * self.bin_ms
+
+    def report(self) -> str:
+        if not self.total:
+            return 'no input latency samples, {} missed'.format(self.missed)
+        lines = ['{} presses, mean {:.1f} ms, p50 {} ms, p95 {} ms, '
+                 'max {:.1f} ms, {} missed'.format(
+                     self.total, self.sum / self.total, self.percentile(50),
+                     self.percentile(95), self.max, self.missed)]
+        top = max(self.counts)
+        for i, count in enumerate(self.counts):
+            if not count:
+                continue
+            lines.append('{:>4}-{:<4} ms {:<40} {}'.format(
+                i * self.bin_ms, (i + 1) * self.bin_ms,
+                '#' * max(1, count * 40 // top), count))
+        return '\n'.join(lines)
+
+
+class InputBuffer(Controller):
+    """
+    事件驱动的键盘输入, 代替每帧读一次 key.get_pressed()
+    两帧之间也一直收事件并记下时间, 下一帧开始时按顺序重放 KEYDOWN/KEYUP:
+    这一帧的按键是帧开始时按着的键, 加上期间按下过的键, 按一下就松开也不会丢
+    画面更新后看玩家有没有移动或转向, 有没有开火, 把按键到生效的时间记进 latency
+    """
+    GAME_KEYS = (K_w, K_a, K_s, K_d, K_j)
 
     def __init__(self):
-        game_init()
-        display.set_caption('坦克大战')
-        mixer_music.load('music/bgm.mp3')
-        if not debug:
-            mixer_music.play(-1)
-        self.bomb_sound = mixer.Sound('music/bomb.ogg')
-        global SCALE
-        self.click_down_pos = None
-        self.black = 0, 0, 0
-        self.white = 255, 255, 255
-        self.fg = 250, 240, 230
-        self.bg = 5, 5, 5
-        self.wincolor = 40, 40, 90
-        self.font_size = 100
-        self.smaller_font_size = 60
-        self.edit_btn_font_size = 40
-        self.size = self.width, self.height, = 780, 780
+        self.queue = list()
+        self.held = set()
+        self.pressed = set()
+        # 这一帧要生效的按键 (时间, 键码)
+        self.pending = list()
+        self.before = None
+        self.latency = LatencyHistogram()
+
+    def poll(self) -> None:
+        now = perf_counter()
+        for evt in event.get():
+            self.queue.append((now, evt))
 
-        self.scale = 10
+    def events(self) -> List:
+        """
+        取出上一帧以来的所有事件, 同时算好这一帧的按键
+        """
+        self.poll()
+        queue, self.queue = self.queue, list()
+        self.pressed = set(self.held)
+        self.pending = list()
+        for when, evt in queue:
+            if evt.type == KEYDOWN:
+                self.held.add(evt.key)
+                self.pressed.add(evt.key)
+                if evt.key in self.GAME_KEYS:
+                    self.pending.append((when, evt.key))
+            elif evt.type == KEYUP:
+                self.held.discard(evt.key)
+        return [evt for when, evt in queue]
+
+    def __call__(self, session) -> Any:
+        player = session.player
+        if player:
+            self.before = (tuple(player.location), player.direction,
+                           player.bullet_tick)
+        return self
+
+    def __getitem__(self, k) -> bool:
+        return k in self.pressed
+
+    def effect(self, session) -> None:
+        """
+        画面更新之后调用, 记录这一帧重放的按键过了多久才看得到效果
+        """
+        before, self.before = self.before, None
+        pending, self.pending = self.pending, list()
+        if before is None:
+            return
+        player = session.player
+        now = perf_counter()
+        moved = fired = False
+        if player:
+            moved = (tuple(player.location), player.direction) != before[:2]
+            # shot() 把冷却从 0 开始计数
+            fired = before[2] == 0 and player.bullet_tick > 0
+        for when, k in pending:
+            done = fired if k == K_j else moved
+            if done:
+                self.latency.add(now - when)
+            else:
+                self.latency.missed += 1
+
+
+class GameSession(object):
+    """
+    一局游戏的全部可变状态: 地图, 精灵组, 分数, 关卡, 随机数, 以及推进一帧的模拟
+    不读模块的全局变量, 关卡文件默认放在游戏目录下, 和当前目录无关;
+    一个进程里可以同时跑很多局, 不画图, 画面由 Game 画它当前的 session
+    """
+
+    def __init__(self, map_file=None, seed=None, scale=SCALE, audio=None,
+                 view_size=(780, 780), surface=None, bullet_speed=None):
+        self.map_file = map_file or asset_path('map')
+        self.rng = Random(seed)
+        # 坦克和子弹每帧移动的像素
+        self.scale = scale
+        # 子弹每帧飞的像素, 降低帧率时调大, 碰撞检测按 scale 分小步做
+        self.bullet_speed = bullet_speed or scale
+        self.audio = audio or NullAudio()
+        # 精灵的 draw() 画到这里, 没有窗口时为 None
+        self.surface = surface
         self.tank_size = Tank.tank_size
+        self.size = view_size
+        # 地图可以比窗口大, size 是视口大小, world_size 是地图大小
+        self.world_size = view_size
+        self.camera = Camera(*view_size)
+        self.tiles = None
+        # 按块管理NPC坦克, 离玩家超过 wake_radius 块的坦克休眠
+        # dormant_interval 为0时完全休眠, 否则每隔这么多帧低频移动一次
+        self.chunks = None
+        self.wake_radius = 2
+        self.dormant_interval = 0
+        self.tick = 0
+        self.awake_tanks = list()
+        self.ai = AIScheduler()
+        # 生存模式打光坦克也不换关, survival.py 一波一波地补坦克
+        self.survival = False
 
-        self.playing_win_size = self.width + self.tank_size * 4, self.height
-        self.edit_win_size = self.width + self.tank_size * 7, self.height
-
-        self.replay_btn_left, self.replay_btn_top = None, 350
-        self.replay_btn_right, self.replay_btn_down = None, None
-
-        # game status
         self.score = None
-        self.intro = True
         self.cur_level = None
         self.battle_field = None
-        self.edit = False
-        self.drawing = False
-        self.playing_area = None
-
-        self.screen = display.set_mode(self.size)
-        # edit map relevant property
-        self.edit_area = None
-        self.editing_data_map = None
-        self._hard_wall = None
-        self._soft_wall = None
-        self._green_land = None
-        self._empty = None
-        self._tank = None
-        # game sprite etc
         self.bullet_list = Group()
         self.npc_tanks = Group()
         self.npc_bullets = Group()
@@ -879,92 +2252,620 @@ class Game(object):
         self.hard_wall_group = Group()
         self.soft_wall_group = Group()
         self.green_land_group = Group()
-        # main menu property
-        self.intro_button_list = list()
-        self.new_game_btn = None
-        self.load_game_btn = None
-        self.edit_level_btn = None
-        self.about_me_btn = None
-        self.screen.fill(self.wincolor)
-        self.init_intro_button()  # init menu button
-        # btn when playing
-        self.playing_btn = list()
-
-        self.edit_button_list = list()
-        self.map_file = 'map'
-        self.record = 'record'
-        self.status_btn = None
-        self.score_btn = None
-        self.save_progress_btn = None
-        self.back_btn = None
-
-        self.last_level_btn = None
-        self.next_level_btn = None
-        self.edit_old_level_btn = None
-        self.editing_level = None
-
-        self.new_level_btn = None
-        self.exit_edit_btn = None
-        self.hard_wall_btn = None
-        self.soft_wall_btn = None
-        self.green_land_btn = None
-        self.empty_btn = None
-        self.tank_btn = None
-        self.save_level_btn = None
-
-        self.init_edit_button()
-        self.editing_tool = None
-
         self.player_group = Group()
         self.init_player()
-        # property about draw stage over
-        self.draw_pos = 0, 0
-        self.draw_direction = Direction.right
-        self.clock = game_time.Clock()
 
     @property
     def min_unit_size(self):
         return self.tank_size // 2
 
+    @property
+    def world_width(self):
+        return self.world_size[0]
+
+    @property
+    def world_height(self):
+        return self.world_size[1]
+
     @property
     def player(self) -> Any:
         if len(self.player_group) > 0:
             return self.player_group.sprites()[0]
         return None
 
-    def init_intro_button(self) -> None:
-
-        self.new_game_btn = Button(self.screen, text=u' NEW GAME ',
-                                   inactive_color=self.wincolor,
-                                   active_color=self.wincolor,
-                                   handler_event=self.new_game_handler,
-                                   font_size=self.smaller_font_size,
-                                   fg=self.fg,
-                                   )
-        self.load_game_btn = Button(self.screen, text=u'LOAD GAME',
-                                    inactive_color=self.wincolor,
-                                    active_color=self.wincolor,
-                                    handler_event=self.load_game_handler,
-                                    font_size=self.smaller_font_size,
-                                    fg=self.fg)
-
-        self.edit_level_btn = Button(self.screen, text=u'EDIT  LEVEL',
-                                     inactive_color=self.wincolor,
-                                     active_color=self.wincolor,
-                                     handler_event=self.edit_level_handler,
-                                     font_size=self.smaller_font_size,
-                                     fg=self.fg)
+    @property
+    def nav(self) -> NavGraph:
+        return self.battle_field.nav()
 
-        self.about_me_btn = Button(self.screen, text=u'ABOUT ME',
-                                   inactive_color=self.wincolor,
-                                   active_color=self.wincolor,
-                                   handler_event=self.about_me_handler,
-                                   font_size=self.smaller_font_size,
-                                   fg=self.fg)
-        self.intro_button_list += [self.new_game_btn, self.load_game_btn,
-                                   self.edit_level_btn, self.about_me_btn]
+    @property
+    def game_levels(self):
+        with map_file_lock, shelve.open(self.map_file, 'c') as db:
+            level_list = [k for k in db.keys()]
+        return len(level_list)
 
-        # new_game, load game, Edit level, about me
+    def get_level_map(self, n):
+        with map_file_lock, shelve.open(self.map_file, 'c') as db:
+            return db.get(str(n))
+
+    def load_level(self):
+        self.hard_wall_group.empty()
+        self.soft_wall_group.empty()
+        self.green_land_group.empty()
+        self.npc_tanks.empty()
+        # 上一关的子弹和爆炸不能带到新地图上
+        self.bullet_list.empty()
+        self.npc_bullets.empty()
+        self.bombs.empty()
+        if self.cur_level > self.game_levels:
+            # stage clear
+            self.battle_field = DataMap(self.size[0] // self.tank_size,
+                                        self.size[1] // self.tank_size)
+            self.player_group.empty()
+            self.world_size = self.size
+            self.camera.set_world(*self.world_size)
+            self.tiles = None
+            self.chunks = None
+            return
+
+        self.init_world()
+        for x in range(self.battle_field.width):
+            for y in range(self.battle_field.height):
+                item = self.battle_field.get(x, y)
+                location = (x * self.min_unit_size, y * self.min_unit_size)
+                if item == MapItem.hard_wall:
+                    self.add_tile(self.hard_wall_group,
+                                  HardWall(location, self.surface))
+                elif item == MapItem.soft_wall:
+                    self.add_tile(self.soft_wall_group,
+                                  SoftWall(location, self.surface))
+                elif item == MapItem.green_land:
+                    self.add_tile(self.green_land_group,
+                                  GreenLand(location, self.surface))
+                elif item == MapItem.tank:
+                    self.add_npc_tank(
+                        Tank(self.surface, npc_bullet_list=self.npc_bullets,
+                             location=[x * self.min_unit_size,
+                                       y * self.min_unit_size],
+                             max_w=self.world_width,
+                             max_h=self.world_height,
+                             scale=self.scale, rng=self.rng))
+        # 导航图跟着关卡走, play_bomb 打掉软墙时 DataMap 会增量更新
+        self.battle_field.nav()
+
+    def init_world(self) -> None:
+        # 根据地图大小设置世界大小, 视口和格子索引
+        self.world_size = (self.battle_field.width * self.min_unit_size,
+                           self.battle_field.height * self.min_unit_size)
+        self.camera.set_world(*self.world_size)
+        self.tiles = [[None] * self.battle_field.height
+                      for _ in range(self.battle_field.width)]
+        self.chunks = ChunkGrid(self.battle_field.width,
+                                self.battle_field.height, self.min_unit_size)
+
+    def add_npc_tank(self, tank: Sprite) -> None:
+        self.npc_tanks.add(tank)
+        self.chunks.add(tank)
+
+    def add_tile(self, group: Group, sprite: Sprite) -> None:
+        group.add(sprite)
+        x = sprite.location[0] // self.min_unit_size
+        y = sprite.location[1] // self.min_unit_size
+        self.tiles[x][y] = sprite
+
+    def clear_all_sprites(self):
+        self.soft_wall_group.empty()
+        self.green_land_group.empty()
+        self.hard_wall_group.empty()
+        self.npc_tanks.empty()
+        self.npc_bullets.empty()
+        self.player_group.empty()
+        self.bullet_list.empty()
+        self.bombs.empty()
+
+    def init_player(self) -> None:
+        start_pos = [(self.world_width - self.tank_size) // 2,
+                     self.world_height - self.tank_size]
+        player = Player(start_pos, self.bullet_list, self.surface,
+                        max_w=self.world_width, max_h=self.world_height,
+                        scale=self.scale)
+        self.player_group.empty()
+        self.player_group.add(player)
+
+    def refresh_player(self) -> None:
+        start_pos = [(self.world_width - self.tank_size) // 2,
+                     self.world_height - self.tank_size]
+        player = Player(start_pos, self.bullet_list, self.surface,
+                        max_w=self.world_width, max_h=self.world_height,
+                        scale=self.scale)
+        self.player_group.add(player)
+
+    def snapshot(self) -> dict:
+        """
+        存档用的快照, 只复制数据, 和 shelve 里存的键一样
+        之后游戏继续运行也不会改到快照
+        """
+        npc = list()
+        for sprite in self.npc_tanks.sprites():
+            bullet = None
+            # 打中东西或者飞出地图的子弹已经不在了, 读档时不能复活
+            if sprite.bullet and sprite.bullet.alive():
+                bullet = {'location': tuple(sprite.bullet.location),
+                          'direction': sprite.bullet.direction}
+            npc.append({'location': list(sprite.location),
+                        'direction': sprite.direction,
+                        'bullet': bullet})
+        return {
+            'map': (self.battle_field.width, self.battle_field.height,
+                    self.battle_field.to_bytes()),
+            'level': self.cur_level,
+            'location': list(self.player.location),
+            'score': self.score,
+            # 墙的位置是元组, 不会变
+            'soft_wall': [sprite.location
+                          for sprite in self.soft_wall_group.sprites()],
+            'hard_wall': [sprite.location
+                          for sprite in self.hard_wall_group.sprites()],
+            'green_land': [sprite.location
+                           for sprite in self.green_land_group.sprites()],
+            'npc_tank': npc,
+            'bullet': [{'location': tuple(sprite.location),
+                        'direction': sprite.direction}
+                       for sprite in self.bullet_list.sprites()],
+            'bomb': [{'pos': list(sprite.pos), 'bomb_num': sprite.bomb_num}
+                     for sprite in self.bombs.sprites()],
+        }
+
+    def restore(self, record) -> None:
+        """
+        从存档恢复, record 是打开的 shelve 或者 snapshot() 的结果
+        """
+        field = record['map']
+        if isinstance(field, tuple):
+            field = DataMap.from_bytes(*field)
+        self.score = record['score']
+        self.battle_field = field
+        self.cur_level = record['level']
+        self.clear_all_sprites()
+        self.init_world()
+        self.init_player()
+        self.player.location = list(record['location'])
+        for item in record['soft_wall']:
+            self.add_tile(self.soft_wall_group, SoftWall(item, self.surface))
+        for item in record['hard_wall']:
+            self.add_tile(self.hard_wall_group, HardWall(item, self.surface))
+        for item in record['green_land']:
+            self.add_tile(self.green_land_group,
+                          GreenLand(item, self.surface))
+        for item in record['npc_tank']:
+            new_npc = Tank(self.surface,
+                           npc_bullet_list=self.npc_bullets,
+                           bullet=item['bullet'],
+                           location=list(item['location']),
+                           direction=item.get('direction'),
+                           max_w=self.world_width,
+                           max_h=self.world_height,
+                           scale=self.scale, rng=self.rng)
+
+            self.add_npc_tank(new_npc)
+        for item in record['bullet']:
+            new_bullet = Bullet(item['location'], item['direction'],
+                                bullet_type='user',
+                                max_h=self.world_height,
+                                max_w=self.world_width, scale=self.scale)
+            new_bullet.location = tuple(item['location'])
+            self.bullet_list.add(new_bullet)
+        for item in record['bomb']:
+            new_bomb = Bomb(item['pos'], self.surface)
+            new_bomb.pos = list(item['pos'])
+            new_bomb.bomb_num = item['bomb_num']
+            self.bombs.add(new_bomb)
+
+    def new_game(self, level=1) -> None:
+        self.score = 0
+        self.cur_level = level
+        self.battle_field = self.get_level_map(level)
+        self.load_level()
+        self.init_player()
+
+    def replay(self) -> None:
+        self.refresh_player()
+        self.bullet_list.empty()
+        self.npc_bullets.empty()
+        self.bombs.empty()
+
+    def step(self, keys) -> None:
+        """
+        推进一帧模拟, 不画图; Game.game_loop 和 server.py 的房间都调用这里
+        :param keys: 和 key.get_pressed() 一样按键码取值
+        """
+        self.handler_user_input(keys)
+        self.wake_npc_tanks()
+        self.compute_bullet_pos()
+
+        self.collision_detect()
+        self.compute_npc_tank_pos()
+        self.compute_player_tank_pos(keys)
+
+        self.bombs.update()
+        # 视口跟着玩家, AI 按视口安排决策的频率
+        if self.player:
+            self.camera.follow(self.player.rect)
+
+    def handler_user_input(self, keys) -> None:
+        if self.player:
+            if keys[K_j]:
+                bullet = self.player.shot()
+                if bullet:
+                    self.bullet_list.add(bullet)
+            if keys[K_w]:
+                self.player.turn_up(self.battle_field)
+            if keys[K_a]:
+                self.player.turn_left(self.battle_field)
+            if keys[K_s]:
+                self.player.turn_down(self.battle_field)
+            if keys[K_d]:
+                self.player.turn_right(self.battle_field)
+
+    def wake_npc_tanks(self) -> None:
+        """
+        找出玩家附近块里醒着的坦克
+        """
+        self.tick += 1
+        if not self.player:
+            self.awake_tanks = self.npc_tanks.sprites()
+            return
+        center = self.chunks.key(self.player.rect.center)
+        self.awake_tanks = list()
+        for chunk in self.chunks.near(center, self.wake_radius):
+            self.awake_tanks += self.chunks.tanks_in(chunk)
+        if len(self.awake_tanks) == len(self.npc_tanks):
+            # 全都醒着 (小地图上总是这样) 时按 Group 的顺序, 和不分块时一样
+            self.awake_tanks = self.npc_tanks.sprites()
+
+    def collision_detect(self) -> None:
+        # NPC坦克之间的碰撞检测, 只检查醒着的坦克
+        for i, tankA in enumerate(self.awake_tanks):
+            for j, tankB in enumerate(self.awake_tanks):
+                if i >= j:
+                    continue
+                else:
+                    # 碰撞逻辑， A的下一步会和B的下一步重合
+
+                    if collide_mask(tankA.next_tank,
+                                    tankB.next_tank):
+                        tankA.direction = (tankA.direction + 2) % 4
+                        tankB.direction = (tankA.direction + 2) % 4
+
+    def compute_player_tank_pos(self, keys) -> None:
+        """
+        更新玩家状态并绘画
+        :param keys:
+        :return:
+        """
+        if self.player:
+            self.player.update(keys)
+
+    def compute_bullet_pos(self) -> None:
+        """
+        更新子弹状态, 子弹这一帧飞 bullet_speed 像素
+        比 scale 快时分成几小步, 每一小步都先检查碰撞再前进, 撞上第一个东西就没了,
+        所以帧率再低也不会穿过一格的墙和坦克; bullet_speed 等于 scale 时只有一步
+        """
+        distance = self.bullet_speed
+        while distance > 0:
+            step = min(distance, self.scale)
+            self.move_bullets(step)
+            distance -= step
+
+    def wall_collide(self, bullets: Group, walls: Group,
+                     dokillb: bool) -> None:
+        """
+        子弹打墙, 结果和 groupcollide(bullets, walls, True, dokillb, play_bomb)
+        一样: 墙都对齐在格子上, 只看子弹盖住的那几格, 按 x, y 的顺序检查,
+        和 load_level 往墙组里加墙的顺序相同
+        """
+        unit = self.min_unit_size
+        width, height = self.battle_field.width, self.battle_field.height
+        for bullet in bullets.sprites():
+            rect = bullet.rect
+            hit = False
+            for x in range(max(rect.left // unit, 0),
+                           min((rect.right - 1) // unit, width - 1) + 1):
+                column = self.tiles[x]
+                for y in range(max(rect.top // unit, 0),
+                               min((rect.bottom - 1) // unit, height - 1) + 1):
+                    tile = column[y]
+                    if tile is not None and tile in walls and \
+                            self.play_bomb(bullet, tile):
+                        if dokillb:
+                            tile.kill()
+                        hit = True
+            if hit:
+                bullet.kill()
+
+    def move_bullets(self, step) -> None:
+        if self.tiles is not None:
+            # 墙用格子索引查, 不用和每一面墙比较
+            if len(self.bullet_list) and len(self.soft_wall_group):
+                # player bullet hit soft wall
+                self.wall_collide(self.bullet_list, self.soft_wall_group,
+                                  dokillb=True)
+            if len(self.bullet_list) and len(self.hard_wall_group):
+                # player bullet hit hard wall
+                self.wall_collide(self.bullet_list, self.hard_wall_group,
+                                  dokillb=False)
+            if len(self.npc_bullets) and len(self.soft_wall_group):
+                # npc bullet hit soft wall
+                self.wall_collide(self.npc_bullets, self.soft_wall_group,
+                                  dokillb=True)
+            if len(self.npc_bullets) and len(self.hard_wall_group):
+                # npc bullet hit hard wall
+                self.wall_collide(self.npc_bullets, self.hard_wall_group,
+                                  dokillb=False)
+        # 子弹之间和子弹打坦克按行分带索引, 子弹和坦克多的时候不用两两比较
+        if len(self.bullet_list) and len(self.npc_bullets):
+            # npc和玩家的子弹互相抵消
+            lane_collide(self.npc_bullets, self.bullet_list,
+                         dokilla=True, dokillb=True, band=self.tank_size)
+
+        if len(self.bullet_list) != 0:
+            # 玩家子弹和NPC坦克的碰撞检测
+            lane_collide(self.bullet_list, self.npc_tanks,
+                         dokilla=True, dokillb=True,
+                         collided=self.play_bomb, band=self.tank_size)
+            self.bullet_list.update(step)
+        if len(self.npc_bullets) != 0:
+            # npc子弹和玩家坦克的碰撞检测
+            lane_collide(self.npc_bullets, self.player_group,
+                         dokilla=True, dokillb=True,
+                         collided=self.play_bomb, band=self.tank_size)
+            self.npc_bullets.update(step)
+
+    def play_bomb(self, obj_a: Bullet, obj_b: Sprite) -> bool:
+        if collide_rect(obj_a, obj_b):
+            self.bombs.add(
+                Bomb((obj_a.rect.left, obj_a.rect.top), self.surface))
+            self.audio.play('bomb')
+            if isinstance(obj_b, SoftWall):
+                x, y = obj_b.location[0] // self.min_unit_size, obj_b.location[
+                    1] // self.min_unit_size
+                self.battle_field.set(x, y, MapItem.empty)
+                self.tiles[x][y] = None
+            if obj_a.type == 'user' and isinstance(obj_b, Tank):
+                self.score += 10
+                if len(self.npc_tanks) == 1 and not self.survival:
+                    self.cur_level += 1
+                    self.battle_field = self.get_level_map(self.cur_level)
+                    self.load_level()
+                    self.init_player()
+            return True
+        return False
+
+    def compute_npc_tank_pos(self) -> None:
+        if not self.player:
+            return
+        tanks = [tank for tank in self.awake_tanks if tank.alive()]
+        # 决策交给调度器, 移动每帧都做
+        self.ai.run(tanks, self.player.rect, self.camera.rect,
+                    self.battle_field, self.tick, self.move_npc_tank)
+        if self.dormant_interval:
+            self.simulate_dormant_tanks()
+
+    def move_npc_tank(self, tank) -> None:
+        tank.move(self.battle_field)
+        self.chunks.move(tank)
+
+    def simulate_dormant_tanks(self) -> None:
+        """
+        远处的坦克只巡逻不开火, 每个块每 dormant_interval 帧移动一次
+        """
+        center = self.chunks.key(self.player.rect.center)
+        phase = self.tick % self.dormant_interval
+        for chunk in self.chunks.far(center, self.wake_radius):
+            if (chunk[0] + chunk[1] * self.chunks.columns) % \
+                    self.dormant_interval != phase:
+                continue
+            for tank in self.chunks.tanks_in(chunk):
+                tank.status = 'patrol'
+                tank.move(self.battle_field, shoot=False)
+                self.chunks.move(tank)
+
+
+def draw_session(surface: Surface, session: GameSession,
+                 area: Optional[Rect] = None) -> None:
+    """
+    把一局游戏的视口画到 surface 上, 只绘画和视口相交的格子和精灵
+    """
+    camera = session.camera
+    surface.set_clip(area)
+    left, top = camera.rect.topleft
+    if session.tiles is not None:
+        x_range, y_range = camera.visible_cells(
+            session.min_unit_size, session.battle_field.width,
+            session.battle_field.height)
+        for x in x_range:
+            column = session.tiles[x]
+            for y in y_range:
+                tile = column[y]
+                if tile is not None and tile.alive():
+                    surface.blit(tile.image, (tile.location[0] - left,
+                                              tile.location[1] - top))
+    for group in (session.bullet_list, session.npc_bullets,
+                  session.npc_tanks, session.player_group, session.bombs):
+        for sprite in group.sprites():
+            rect = sprite.rect
+            if camera.visible(rect):
+                surface.blit(sprite.image, camera.apply(rect))
+    surface.set_clip(None)
+
+
+# TODO 制作关卡编辑器
+
+
+class Game(object):
+
+    def __init__(self):
+        game_init()
+        startup.mark('pygame init')
+        display.set_caption('坦克大战')
+        if debug or not mixer.get_init():
+            self.audio = NullAudio()
+        else:
+            self.audio = AudioManager({'bomb': 'music/bomb.ogg'})
+        self.audio.play_music('music/bgm.mp3')
+        startup.mark('audio')
+        self.click_down_pos = None
+        self.black = 0, 0, 0
+        self.white = 255, 255, 255
+        self.fg = 250, 240, 230
+        self.bg = 5, 5, 5
+        self.wincolor = 40, 40, 90
+        self.font_size = 100
+        self.smaller_font_size = 60
+        self.edit_btn_font_size = 40
+        self.size = self.width, self.height, = 780, 780
+
+        self.tank_size = Tank.tank_size
+        # 编辑器的视口, 地图比窗口大时用方向键滚动
+        self.edit_camera = Camera(*self.size)
+        self.map_sizes = [self.width // self.min_unit_size,
+                          self.width // self.min_unit_size * 2,
+                          self.width // self.min_unit_size * 4]
+        self.new_level_size = self.map_sizes[0]
+
+        self.playing_win_size = self.width + self.tank_size * 4, self.height
+        self.edit_win_size = self.width + self.tank_size * 7, self.height
+
+        self.replay_btn_left, self.replay_btn_top = None, 350
+        self.replay_btn_right, self.replay_btn_down = None, None
+
+        # game status
+        self.intro = True
+        self.edit = False
+        self.drawing = False
+        self.playing_area = None
+
+        self.screen = display.set_mode(self.size)
+        startup.mark('display')
+        # 地图, 精灵和分数都在 session 里, Game 只负责画它和处理输入
+        self.session = GameSession(audio=self.audio, view_size=self.size,
+                                   surface=self.screen)
+        # edit map relevant property
+        self.edit_area = None
+        self.editing_data_map = None
+        # 编辑区域的画布一直保留, 只重画改动过的格子
+        self.edit_canvas = Surface(self.size)
+        self.edit_canvas_view = None
+        self.edit_dirty = set()
+        self.edit_history = EditHistory()
+        self.edit_status_stale = True
+        # 画笔形状: 单格, 直线, 实心矩形, 空心矩形, 填充
+        self.edit_shapes = ['pen', 'line', 'rect', 'frame', 'fill']
+        self.edit_shape = 'pen'
+        self.edit_start = None
+        self.edit_last = None
+        # 没在编辑地图时编辑区域是关卡浏览, 一页 browser_columns x browser_rows 张缩略图
+        self.thumbnails = ThumbnailCache(asset_path('thumbs'))
+        self.browser_columns = 4
+        self.browser_rows = 4
+        # main menu property
+        self.intro_button_list = list()
+        self.new_game_btn = None
+        self.load_game_btn = None
+        self.edit_level_btn = None
+        self.about_me_btn = None
+        self.screen.fill(self.wincolor)
+        self.init_intro_button()  # init menu button
+        startup.mark('intro buttons')
+        # btn when playing
+        self.playing_btn = list()
+
+        self.edit_button_list = list()
+        self.record = asset_path('record')
+        self.record_writer = RecordWriter()
+        # 已经报告过的存档失败次数, 后台线程失败时主线程打印并显示在状态栏
+        self.save_failures = 0
+        # 按 R 倒退 rewind_step 秒, 游戏结束画面也可以倒回去
+        self.rewind = RewindBuffer()
+        self.rewind_step = 3
+        # 每隔这么多帧自动存档, 0 表示不自动存档
+        self.autosave_interval = 0
+        # 所有事件都经过 input, 操作玩家坦克的是它还是机器人, ESC 一直读键盘
+        self.input = InputBuffer()
+        self.controller = self.input
+        self.latency_report = False
+        self.status_btn = None
+        self.score_btn = None
+        self.save_progress_btn = None
+        self.back_btn = None
+
+        self.last_level_btn = None
+        self.next_level_btn = None
+        self.edit_old_level_btn = None
+        self.editing_level = None
+
+        self.new_level_btn = None
+        self.map_size_btn = None
+        self.exit_edit_btn = None
+        self.hard_wall_btn = None
+        self.soft_wall_btn = None
+        self.green_land_btn = None
+        self.empty_btn = None
+        self.tank_btn = None
+        self.save_level_btn = None
+        self.edit_shape_btn = None
+
+        self.init_edit_button()
+        startup.mark('edit buttons')
+        self.editing_tool = None
+
+        # property about draw stage over, 换了地图就重新开始动画
+        self.stage_clear_field = None
+        self.stage_clear_path = None
+        self.stage_clear_step = 0
+        self.stage_clear_canvas = None
+        # 主循环每秒10帧, 等下一帧时也在收事件
+        self.frame_time = 0.1
+        self.next_frame = perf_counter()
+        startup.mark('game init')
+
+    @property
+    def min_unit_size(self):
+        return self.tank_size // 2
+
+    def init_intro_button(self) -> None:
+
+        self.new_game_btn = Button(self.screen, text=u' NEW GAME ',
+                                   inactive_color=self.wincolor,
+                                   active_color=self.wincolor,
+                                   handler_event=self.new_game_handler,
+                                   font_size=self.smaller_font_size,
+                                   fg=self.fg,
+                                   )
+        self.load_game_btn = Button(self.screen, text=u'LOAD GAME',
+                                    inactive_color=self.wincolor,
+                                    active_color=self.wincolor,
+                                    handler_event=self.load_game_handler,
+                                    font_size=self.smaller_font_size,
+                                    fg=self.fg)
+
+        self.edit_level_btn = Button(self.screen, text=u'EDIT  LEVEL',
+                                     inactive_color=self.wincolor,
+                                     active_color=self.wincolor,
+                                     handler_event=self.edit_level_handler,
+                                     font_size=self.smaller_font_size,
+                                     fg=self.fg)
+
+        self.about_me_btn = Button(self.screen, text=u'ABOUT ME',
+                                   inactive_color=self.wincolor,
+                                   active_color=self.wincolor,
+                                   handler_event=self.about_me_handler,
+                                   font_size=self.smaller_font_size,
+                                   fg=self.fg)
+        self.intro_button_list += [self.new_game_btn, self.load_game_btn,
+                                   self.edit_level_btn, self.about_me_btn]
+
+        # new_game, load game, Edit level, about me
 
         screen_height = self.height
 
@@ -1026,6 +2927,12 @@ class Game(object):
                                     handler_event=self.new_level_handler,
                                     font_size=self.edit_btn_font_size,
                                     fg=self.fg)
+        self.map_size_btn = Button(self.screen, text=u"""size""",
+                                   inactive_color=self.wincolor,
+                                   active_color=self.wincolor,
+                                   handler_event=self.map_size_handler,
+                                   font_size=self.edit_btn_font_size,
+                                   fg=self.fg)
         self.exit_edit_btn = Button(self.screen, text=u"""quit edit""",
                                     inactive_color=self.wincolor,
                                     active_color=self.wincolor,
@@ -1049,6 +2956,12 @@ class Game(object):
                                bg_image='img/tank-up.png',
                                handler_event=self.tank_handler)
 
+        self.edit_shape_btn = Button(self.screen, text=u"""pen""",
+                                     inactive_color=self.wincolor,
+                                     active_color=self.wincolor,
+                                     handler_event=self.edit_shape_handler,
+                                     font_size=self.edit_btn_font_size,
+                                     fg=self.fg)
         self.save_level_btn = Button(self.screen, text=u"""save level""",
                                      inactive_color=self.wincolor,
                                      active_color=self.wincolor,
@@ -1059,105 +2972,33 @@ class Game(object):
     def new_game_handler(self, evt):
         if self.be_clicked(self.new_game_btn, evt):
             self.screen = display.set_mode(self.playing_win_size)
-            self.score = 0
             self.intro = False
-            self.cur_level = 1
-            self.battle_field = self.get_level_map(1)
-            self.load_level()
-            self.init_player()
+            self.rewind.clear()
             # load level 1
-
-    def load_level(self):
-        self.hard_wall_group.empty()
-        self.soft_wall_group.empty()
-        self.green_land_group.empty()
-        self.npc_tanks.empty()
-        if self.cur_level > self.game_levels:
-            # stage clear
-            self.battle_field = DataMap(self.width // Tank.tank_size,
-                                        self.height // Tank.tank_size)
-            self.player_group.empty()
-            return
-
-        for x in range(self.battle_field.width):
-            for y in range(self.battle_field.height):
-                item = self.battle_field.get(x, y)
-                location = (x * self.min_unit_size, y * self.min_unit_size)
-                if item == MapItem.hard_wall:
-                    self.hard_wall_group.add(HardWall(location, self.screen))
-                elif item == MapItem.soft_wall:
-                    self.soft_wall_group.add(SoftWall(location, self.screen))
-                elif item == MapItem.green_land:
-                    self.green_land_group.add(GreenLand(location, self.screen))
-                elif item == MapItem.tank:
-                    self.npc_tanks.add(
-                        Tank(self.screen, npc_bullet_list=self.npc_bullets,
-                             location=[x * self.min_unit_size,
-                                       y * self.min_unit_size],
-                             max_w=self.width,
-                             max_h=self.height))
-
-    def clear_all_sprites(self):
-        self.soft_wall_group.empty()
-        self.green_land_group.empty()
-        self.hard_wall_group.empty()
-        self.npc_tanks.empty()
-        self.npc_bullets.empty()
-        self.player_group.empty()
-        self.bullet_list.empty()
+            self.session.new_game(1)
 
     def load_game_handler(self, evt):
         if self.be_clicked(self.load_game_btn, evt):
             # load game record
-            if not os.path.exists(self.record + '.db'):
+            self.record_writer.flush()
+            if not snapshot_exists(self.record):
                 self.load_game_btn.text = 'no data to load!'
                 return
-            with shelve.open(self.record, 'c') as db:
-
-                self.score = db.get('score')
-                self.battle_field = db.get('map')
-                self.cur_level = db.get('level')
-                soft_wall = db['soft_wall']
-                hard_wall = db['hard_wall']
-                green_land = db['green_land']
-                location = db['location']
-                npc = db['npc_tank']
-                bullet = db['bullet']
-                bomb = db['bomb']
             self.intro = False
-
             self.screen = display.set_mode(self.playing_win_size)
-            self.init_player()
-            self.player.location = location
-            for item in soft_wall:
-                self.soft_wall_group.add(SoftWall(item, self.screen))
-            for item in hard_wall:
-                self.hard_wall_group.add(HardWall(item, self.screen))
-            for item in green_land:
-                self.green_land_group.add(GreenLand(item, self.screen))
-            for item in npc:
-                new_npc = Tank(self.screen,
-                               npc_bullet_list=self.npc_bullets,
-                               bullet=item['bullet'],
-                               location=item['location'], max_w=self.width,
-                               max_h=self.height)
-
-                self.npc_tanks.add(new_npc)
-            for item in bullet:
-                self.bullet_list.add(Bullet(item['location'],
-                                            item['direction'],
-                                            bullet_type='user',
-                                            max_h=self.height,
-                                            max_w=self.width))
-            for item in bomb:
-                new_bomb = Bomb(item['pos'], self.screen)
-                new_bomb.bomb_num = item['bomb_num']
-                self.bombs.add(new_bomb)
+            self.read_record()
+
+    def read_record(self) -> None:
+        self.record_writer.flush()
+        self.rewind.clear()
+        with shelve.open(snapshot_path(self.record), 'r') as db:
+            self.session.restore(db)
 
     def edit_level_handler(self, evt):
         if self.be_clicked(self.edit_level_btn, evt):
             self.intro = False
             self.edit = True
+            self.thumbnails.forget()
             self.screen = display.set_mode(self.edit_win_size)
             display.set_caption('地图编辑模式')
 
@@ -1175,52 +3016,24 @@ class Game(object):
 
     def save_game(self, evt):
         # save player's record
-        self.load_game_btn.text = 'LOAD GAME'
+        # 自动存档失败时 report_save_error 写的提示要留到回主菜单, 存成功了才换回来
+        if self.record_writer.error is None:
+            self.load_game_btn.text = 'LOAD GAME'
         if self.be_clicked(self.save_progress_btn, evt):
-            with shelve.open(self.record, 'c') as db:
-                db['map'] = self.battle_field
-                db['level'] = self.cur_level
-                db['location'] = self.player.location
-                db['score'] = self.score
-                # save map
-                soft_wall, hard_wall, green_land = list(), list(), list()
-                for sprite in self.soft_wall_group.sprites():
-                    soft_wall.append(sprite.location)
-                for sprite in self.hard_wall_group.sprites():
-                    hard_wall.append(sprite.location)
-                for sprite in self.green_land_group.sprites():
-                    green_land.append(sprite.location)
-                db['soft_wall'] = soft_wall
-                db['hard_wall'] = hard_wall
-                db['green_land'] = green_land
-                # save npc things
-                npc, bullet, bombs = list(), list(), list()
-                for sprite in self.npc_tanks.sprites():
-                    if sprite.bullet:
-                        npc.append({'location': sprite.location,
-                                    'direction': sprite.direction,
-                                    'bullet':
-                                        {'location': sprite.bullet.location,
-                                         'direction': sprite.bullet.direction,
-                                         }})
-                for sprite in self.bullet_list.sprites():
-                    bullet.append({'location': sprite.location,
-                                   'direction': sprite.direction})
-                for sprite in self.bombs.sprites():
-                    bombs.append({'pos': sprite.pos,
-                                  'bomb_num': sprite.bomb_num})
-                db['npc_tank'] = npc
-                db['bullet'] = bullet
-                db['bomb'] = bombs
+            self.write_record()
             self.intro = True
             self.screen = display.set_mode(self.size)
-            self.clear_all_sprites()
+            self.session.clear_all_sprites()
+
+    def write_record(self) -> None:
+        # 主线程只做快照, 写文件交给后台线程
+        self.record_writer.submit(self.record, self.session.snapshot())
 
     def back_intro(self, evt):
         if self.be_clicked(self.back_btn, evt):
             self.intro = True
             self.screen = display.set_mode(self.size)
-            self.clear_all_sprites()
+            self.session.clear_all_sprites()
 
     def record_hover(self, btn, evt):
         if evt.type == MOUSEMOTION:
@@ -1243,24 +3056,82 @@ class Game(object):
 
     def next_level_btn_handler(self, evt):
         if self.be_clicked(self.next_level_btn, evt):
-            if self.edit_old_level_btn.value < self.game_levels:
+            if self.edit_old_level_btn.value < self.session.game_levels:
                 self.edit_old_level_btn.value += 1
 
     def edit_old_level(self, evt):
         # handler edit old level
         if self.be_clicked(self.edit_old_level_btn, evt):
-            # load old map
-            level = self.edit_old_level_btn.value
-            self.editing_level = level
-            self.editing_data_map = self.get_level_map(level)
+            self.open_level(self.edit_old_level_btn.value)
+
+    def open_level(self, level) -> None:
+        # load old map
+        self.editing_level = level
+        self.open_editing_map(self.session.get_level_map(level))
+
+    def level_browser_handler_event(self, evt):
+        """
+        点缩略图选中关卡, 再点一次打开编辑; 滚轮一次翻一行
+        """
+        btn = self.edit_old_level_btn
+        if evt.type == MOUSEBUTTONUP and evt.button == 1:
+            level = self.browser_level_at(evt.pos)
+            if level is None or level > self.session.game_levels:
+                return
+            if level == btn.value:
+                self.open_level(level)
+            else:
+                btn.value = level
+        elif evt.type == MOUSEBUTTONDOWN and evt.button in (4, 5):
+            # 滚轮在 pygame 1.9 和 2 里都是按键 4 (上) 和 5 (下)
+            step = -1 if evt.button == 4 else 1
+            btn.value = min(max(btn.value + step * self.browser_columns, 1),
+                            max(self.session.game_levels, 1))
+
+    def browser_first(self) -> int:
+        # 选中的关卡所在的那一页的第一关
+        per_page = self.browser_columns * self.browser_rows
+        return (self.edit_old_level_btn.value - 1) // per_page * per_page + 1
+
+    def browser_page(self, levels) -> range:
+        first = self.browser_first()
+        per_page = self.browser_columns * self.browser_rows
+        return range(first, min(first + per_page - 1, levels) + 1)
+
+    def browser_cell(self, i) -> Rect:
+        width = self.width // self.browser_columns
+        height = self.height // self.browser_rows
+        return Rect(i % self.browser_columns * width,
+                    i // self.browser_columns * height, width, height)
+
+    def browser_level_at(self, pos) -> Optional[int]:
+        x, y = pos
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        column = x * self.browser_columns // self.width
+        row = y * self.browser_rows // self.height
+        return self.browser_first() + row * self.browser_columns + column
 
     def new_level_handler(self, evt):
         if self.be_clicked(self.new_level_btn, evt):
-            self.editing_level = self.game_levels + 1
+            self.editing_level = self.session.game_levels + 1
             self.editing_tool = None
-            self.editing_data_map = DataMap(
-                self.width // self.min_unit_size,
-                self.height // self.min_unit_size)
+            self.open_editing_map(DataMap(self.new_level_size,
+                                          self.new_level_size))
+
+    def open_editing_map(self, data_map: DataMap) -> None:
+        self.editing_data_map = data_map
+        self.edit_camera.set_world(data_map.width * self.min_unit_size,
+                                   data_map.height * self.min_unit_size)
+        self.edit_history = EditHistory()
+        self.edit_canvas_view = None
+        self.edit_status_stale = True
+
+    def map_size_handler(self, evt):
+        if self.be_clicked(self.map_size_btn, evt):
+            # 切换新地图的大小
+            i = self.map_sizes.index(self.new_level_size)
+            self.new_level_size = self.map_sizes[(i + 1) % len(self.map_sizes)]
 
     def exit_edit_handler(self, evt):
         if self.be_clicked(self.exit_edit_btn, evt):
@@ -1297,16 +3168,6 @@ class Game(object):
             if self.save():
                 self.editing_data_map = None
 
-    @property
-    def game_levels(self):
-        with shelve.open(self.map_file, 'c') as db:
-            level_list = [k for k in db.keys()]
-        return len(level_list)
-
-    def get_level_map(self, n):
-        with shelve.open(self.map_file, 'c') as db:
-            return db.get(str(n))
-
     def save(self):
         if self.editing_data_map.is_empty():
             return False
@@ -1314,9 +3175,13 @@ class Game(object):
         if not self.editing_data_map.is_connected():
             return False
 
-        with shelve.open(self.map_file, 'c') as db:
+        if self.editing_data_map.trapped_tanks():
+            return False
+
+        with map_file_lock, shelve.open(self.session.map_file, 'c') as db:
             db[str(self.editing_level)] = self.editing_data_map
         self.edit_old_level_btn.value = self.editing_level
+        self.thumbnails.invalidate(self.session.map_file, self.editing_level)
         return True
 
     def edit_area_handler_event(self, evt):
@@ -1327,56 +3192,116 @@ class Game(object):
                     y < self.height - self.min_unit_size and \
                     isinstance(self.editing_tool, MapItem):
                 self.drawing = True
-                x, y = x + self.min_unit_size // 2, y + self.min_unit_size // 2
-                x_index = x // self.min_unit_size
-                y_index = y // self.min_unit_size
-                self.editing_data_map.set(x_index, y_index,
-                                          self.editing_tool)
+                # 按下到松开算一次操作, 一起撤销
+                self.edit_history.begin()
+                self.edit_start = self.edit_last = self.cell_at(evt.pos)
+                if self.edit_shape == 'pen':
+                    self.apply_edit([self.edit_start])
+                elif self.edit_shape == 'fill':
+                    self.apply_edit(self.editing_data_map.flood(
+                        *self.edit_start))
 
         elif evt.type == MOUSEBUTTONUP:
+            if self.drawing:
+                end = self.cell_at(evt.pos)
+                if self.edit_shape == 'line':
+                    self.apply_edit(line_cells(*self.edit_start, *end))
+                elif self.edit_shape in ('rect', 'frame'):
+                    self.apply_edit(rect_cells(
+                        *self.edit_start, *end,
+                        filled=self.edit_shape == 'rect'))
+                self.edit_history.end()
+                # 每次操作结束检查一次连通性
+                self.edit_status_stale = True
             self.drawing = False
+            self.edit_start = None
+
+        elif evt.type == KEYDOWN and evt.mod & KMOD_CTRL and \
+                not self.drawing:
+            if evt.key == K_z and evt.mod & KMOD_SHIFT or evt.key == K_y:
+                cells = self.edit_history.redo(self.editing_data_map)
+            elif evt.key == K_z:
+                cells = self.edit_history.undo(self.editing_data_map)
+            else:
+                cells = []
+            if cells:
+                self.edit_dirty.update(cells)
+                self.edit_status_stale = True
 
         elif evt.type == MOUSEMOTION:
             x, y = evt.pos
-            if self.drawing and isinstance(self.editing_tool, MapItem):
+            if self.drawing and self.edit_shape == 'pen':
                 if x < self.width - self.min_unit_size and \
                         y < self.height - self.min_unit_size:
-                    x = x + self.min_unit_size // 2
-                    y = y + self.min_unit_size // 2
-                    x_index = x // (self.tank_size // 2)
-                    y_index = y // (self.tank_size // 2)
-                    self.editing_data_map.set(x_index, y_index,
-                                              self.editing_tool)
-
-    def init_player(self) -> None:
-        start_pos = [(self.width - self.tank_size) // 2,
-                     self.height - self.tank_size]
-        player = Player(start_pos, self.bullet_list, self.screen,
-                        max_w=self.width, max_h=self.height)
-        self.player_group.empty()
-        self.player_group.add(player)
-
-    def refresh_player(self) -> None:
-        start_pos = [(self.width - self.tank_size) // 2,
-                     self.height - self.tank_size]
-        player = Player(start_pos, self.bullet_list, self.screen,
-                        max_w=self.height, max_h=self.width)
-        self.player_group.add(player)
+                    # 鼠标移动快时两次采样之间连成线
+                    cell = self.cell_at(evt.pos)
+                    self.apply_edit(line_cells(*self.edit_last, *cell))
+                    self.edit_last = cell
+
+    def cell_at(self, pos) -> Tuple[int, int]:
+        # 屏幕坐标转换成地图格子, 超出地图的取边上的格子
+        x, y = self.edit_camera.to_world(pos)
+        x, y = x + self.min_unit_size // 2, y + self.min_unit_size // 2
+        x_index = min(max(0, x // self.min_unit_size),
+                      self.editing_data_map.width - 1)
+        y_index = min(max(0, y // self.min_unit_size),
+                      self.editing_data_map.height - 1)
+        return x_index, y_index
+
+    def apply_edit(self, cells) -> None:
+        changed = self.editing_data_map.set_many(cells, self.editing_tool)
+        for x, y, old in changed:
+            self.edit_history.record(x, y, old, self.editing_tool)
+            self.edit_dirty.add((x, y))
+
+    def edit_shape_handler(self, evt):
+        if self.be_clicked(self.edit_shape_btn, evt):
+            i = self.edit_shapes.index(self.edit_shape)
+            self.edit_shape = self.edit_shapes[(i + 1) % len(self.edit_shapes)]
+
+    def scroll_edit_area(self, keys) -> None:
+        # 方向键滚动编辑区域
+        dx, dy = 0, 0
+        if keys[K_LEFT]:
+            dx -= self.min_unit_size
+        if keys[K_RIGHT]:
+            dx += self.min_unit_size
+        if keys[K_UP]:
+            dy -= self.min_unit_size
+        if keys[K_DOWN]:
+            dy += self.min_unit_size
+        if dx or dy:
+            self.edit_camera.move(dx, dy)
 
     def start(self) -> None:
         while True:
             self.game_loop()
-            self.clock.tick(10)  # 每秒循环10次
-
-    @staticmethod
-    def end() -> None:
+            self.wait_next_frame()
+
+    def wait_next_frame(self) -> None:
+        now = perf_counter()
+        self.next_frame += self.frame_time
+        if self.next_frame < now:
+            # 落后了不追帧, 从现在重新算
+            self.next_frame = now
+        while now < self.next_frame:
+            self.input.poll()
+            game_time.wait(1)
+            now = perf_counter()
+
+    def end(self) -> None:
+        if self.latency_report:
+            print(self.input.latency.report())
+        # 等存档写完再退出
+        self.record_writer.flush()
         game_quit()
         sys.exit()
 
     def game_loop(self) -> None:
-
+        session = self.session
+        self.report_save_error()
         # 监听用户事件
-        for evt in event.get():
+        for evt in self.input.events():
             if evt.type == QUIT:
                 self.end()
             if self.intro:
@@ -1384,18 +3309,24 @@ class Game(object):
                 for btn in self.intro_button_list:
                     btn.handler_event(evt)
             elif self.edit:
-                self.edit_area_handler_event(evt)
+                if self.editing_data_map:
+                    self.edit_area_handler_event(evt)
+                else:
+                    self.level_browser_handler_event(evt)
                 for btn in self.edit_button_list:
                     btn.handler_event(evt)
 
-            elif not self.player_group and self.cur_level <= self.game_levels:
+            elif not session.player_group and \
+                    session.cur_level <= session.game_levels:
                 # game over
                 self.handler_click(evt)
-            elif self.cur_level <= self.game_levels and len(
-                    self.player_group) == 1:
+                self.handler_rewind(evt)
+            elif session.cur_level <= session.game_levels and len(
+                    session.player_group) == 1:
                 # playing
                 for btn in self.playing_btn:
                     btn.handler_event(evt)
+                self.handler_rewind(evt)
             else:
                 # stage clear
                 btns = [self.back_btn]
@@ -1405,183 +3336,79 @@ class Game(object):
         if self.intro:
             self.draw_intro()
         elif self.edit:
+            if self.editing_data_map:
+                self.scroll_edit_area(key.get_pressed())
             self.draw_edit()
-        elif len(
-                self.player_group) == 0 and self.cur_level <= self.game_levels:
+        elif len(session.player_group) == 0 and \
+                session.cur_level <= session.game_levels:
             self.draw_game_over()
-            mixer_music.stop()
+            self.audio.stop_music()
 
         else:
 
             keys = key.get_pressed()
-            self.handler_user_input(keys)
-            if not mixer_music.get_busy():
-                if not debug:
-                    mixer_music.play(-1)
+            self.audio.play_music()
             # draw map
 
-            if self.cur_level > self.game_levels:
-                finished = self.draw_stage_clear()
+            self.detect_if_quit(keys)
+            if session.cur_level > session.game_levels:
+                self.draw_stage_clear()
                 self.draw_level_clear_btn()
 
             else:
                 self.draw_playing()
+                session.step(self.controller(session))
                 self.draw_game_area()
-                self.compute_bullet_pos()
-
-                self.collision_detect()
-                self.compute_npc_tank_pos()
-                self.compute_player_tank_pos(keys)
-
-                self.bombs.update()
+                if self.autosave_interval and session.player and \
+                        session.tick % self.autosave_interval == 0:
+                    self.write_record()
+                self.rewind.record(session)
         self.finish()
+        self.input.effect(session)
+        startup.first_frame()
+
+    def report_save_error(self) -> None:
+        writer = self.record_writer
+        if writer.failed == self.save_failures:
+            return
+        self.save_failures = writer.failed
+        print('save record failed: {!r}'.format(writer.error),
+              file=sys.stderr)
+        self.load_game_btn.text = 'save failed!'
 
     @staticmethod
     def finish() -> None:
         display.update()
 
-    # def gen_tank(self) -> None:
-    #     if len(self.npc_tanks) == 0:
-    #         for i in range(5):
-    #             self.npc_tanks.add(
-    #                 Tank(self.screen, self.npc_bullets, max_w=self.width,
-    #                      max_h=self.height))
-
-    def collision_detect(self) -> None:
-        # NPC坦克之间的碰撞检测
-        for i, tankA in enumerate(self.npc_tanks):
-            for j, tankB in enumerate(self.npc_tanks):
-                if i >= j:
-                    continue
-                else:
-                    # 碰撞逻辑， A的下一步会和B的下一步重合
-
-                    if collide_mask(tankA.next_tank,
-                                    tankB.next_tank):
-                        tankA.direction = (tankA.direction + 2) % 4
-                        tankB.direction = (tankA.direction + 2) % 4
-
-    def compute_player_tank_pos(self, keys) -> None:
-        """
-        更新玩家状态并绘画
-        :param keys:
-        :return:
-        """
-        if self.player:
-            self.player.update(keys)
-            self.player.draw()
-
-    def compute_bullet_pos(self) -> None:
-        """
-        更新子弹状态并绘画
-        :return:
-        """
-        if len(self.bullet_list) and len(self.soft_wall_group):
-            # player bullet hit soft wall
-            groupcollide(self.bullet_list, self.soft_wall_group,
-                         dokilla=True, dokillb=True, collided=self.play_bomb)
-        if len(self.bullet_list) and len(self.hard_wall_group):
-            # player bullet hit hard wall
-            groupcollide(self.bullet_list, self.hard_wall_group,
-                         dokilla=True, dokillb=False, collided=self.play_bomb)
-        if len(self.npc_bullets) and len(self.soft_wall_group):
-            # npc bullet hit soft wall
-            groupcollide(self.npc_bullets, self.soft_wall_group,
-                         dokilla=True, dokillb=True, collided=self.play_bomb)
-        if len(self.npc_bullets) and len(self.hard_wall_group):
-            # npc bullet hit hard wall
-            groupcollide(self.npc_bullets, self.hard_wall_group,
-                         dokilla=True, dokillb=False, collided=self.play_bomb)
-        if len(self.bullet_list) and len(self.npc_bullets):
-            # npc和玩家的子弹互相抵消
-            groupcollide(self.npc_bullets, self.bullet_list,
-                         dokilla=True, dokillb=True)
-
-        if len(self.bullet_list) != 0:
-            # 玩家子弹和NPC坦克的碰撞检测
-            groupcollide(self.bullet_list, self.npc_tanks,
-                         dokilla=True, dokillb=True,
-                         collided=self.play_bomb)
-            self.bullet_list.update()
-            self.bullet_list.draw(self.screen)
-        if len(self.npc_bullets) != 0:
-            # npc子弹和玩家坦克的碰撞检测
-            groupcollide(self.npc_bullets, self.player_group,
-                         dokilla=True, dokillb=True,
-                         collided=self.play_bomb)
-            self.npc_bullets.update()
-            self.npc_bullets.draw(self.screen)
-
-    def play_bomb(self, obj_a: Bullet, obj_b: Sprite) -> bool:
-        if collide_rect(obj_a, obj_b):
-            self.bombs.add(
-                Bomb((obj_a.rect.left, obj_a.rect.top), self.screen))
-            if not debug:
-                self.bomb_sound.play()
-            if isinstance(obj_b, SoftWall):
-                x, y = obj_b.location[0] // self.min_unit_size, obj_b.location[
-                    1] // self.min_unit_size
-                self.battle_field.set(x, y, MapItem.empty)
-            if obj_a.type == 'user' and isinstance(obj_b, Tank):
-                self.score += 10
-                if len(self.npc_tanks) == 1:
-                    self.cur_level += 1
-                    self.battle_field = self.get_level_map(self.cur_level)
-                    self.load_level()
-                    self.init_player()
-            return True
-        return False
-
-    def compute_npc_tank_pos(self) -> None:
-        self.npc_tanks.update(self.player, self.battle_field)
-        self.npc_tanks.draw(self.screen)
-
     def detect_if_quit(self, keys) -> None:
 
         if keys[K_ESCAPE]:
             self.end()
 
-    def handler_user_input(self, keys) -> None:
-        self.detect_if_quit(keys)
-        if self.player:
-            if keys[K_j]:
-                bullet = self.player.shot()
-                if bullet:
-                    self.bullet_list.add(bullet)
-            if keys[K_w]:
-                self.player.turn_up(self.battle_field)
-            if keys[K_a]:
-                self.player.turn_left(self.battle_field)
-            if keys[K_s]:
-                self.player.turn_down(self.battle_field)
-            if keys[K_d]:
-                self.player.turn_right(self.battle_field)
-
-    def replay(self):
-        self.refresh_player()
-        self.bullet_list.empty()
-        self.npc_bullets.empty()
-        self.bombs.empty()
+    def handler_rewind(self, evt):
+        if evt.type == KEYDOWN and evt.key == K_r:
+            if self.rewind.rewind(self.session, self.rewind_step) and debug:
+                print(self.rewind.report())
 
     def handler_click(self, evt):
         if evt.type == MOUSEBUTTONDOWN:
             x, y = evt.pos
-            if self.player:
+            if self.session.player:
                 pass
             elif self.replay_btn_top <= y <= self.replay_btn_down \
                     and self.replay_btn_left <= x <= self.replay_btn_right:
-                self.replay()
+                self.session.replay()
 
     def draw_game_over(self):
         self.screen.fill(self.wincolor)
         # `game over`
-        font = SysFont("Arial", self.font_size)
+        font = Assets.font(self.font_size)
         text = ' Game Over '
         ren = font.render(text, 0, self.fg, self.bg)
         left = self.screen.get_rect().width / 2 - ren.get_rect().width / 2
         self.screen.blit(ren, (left, 200))
         # `play again`
-        font = SysFont("Arial", self.smaller_font_size)
+        font = Assets.font(self.smaller_font_size)
         text = 'play again?'
         ren = font.render(text, 0, self.fg, self.bg)
         self.replay_btn_left = (self.screen.get_width() - ren.get_width()) / 2
@@ -1597,13 +3424,13 @@ class Game(object):
 
     def draw_playing(self):
         self.screen.fill(self.wincolor)
-        self.playing_area = Surface(self.size)
-        self.playing_area.fill(self.black)
-
-        self.screen.blit(self.playing_area, (0, 0))
+        self.playing_area = Rect((0, 0), self.size)
+        self.screen.fill(self.black, self.playing_area)
         # button
-        self.score_btn.text = "Score: {}".format(self.score)
-        self.status_btn.text = "Level: {}".format(self.cur_level)
+        self.score_btn.text = "Score: {}".format(self.session.score)
+        self.status_btn.text = "Level: {}".format(self.session.cur_level)
+        if self.record_writer.error:
+            self.status_btn.text = "save failed!"
 
         self.playing_btn = [self.score_btn, self.status_btn,
                             self.save_progress_btn]
@@ -1630,45 +3457,59 @@ class Game(object):
     def draw_edit(self):
 
         self.screen.fill(self.wincolor)
-        self.edit_area = Surface(self.size)
-
-        self.edit_area.fill(self.black)
+        self.edit_area = self.edit_canvas
 
         if not self.editing_data_map:
-            if self.game_levels == 0:
+            self.edit_area.fill(self.black)
+            self.edit_canvas_view = None
+            self.map_size_btn.text = "size {0}x{0}".format(
+                self.new_level_size)
+            levels = self.session.game_levels
+            if levels == 0:
                 self.status_btn.text = "no level create one!"
                 self.edit_button_list = [self.status_btn, self.new_level_btn,
+                                         self.map_size_btn,
                                          self.exit_edit_btn]
             else:
-                self.status_btn.text = " total {} level".format(
-                    self.game_levels)
+                self.status_btn.text = " total {} level".format(levels)
                 self.edit_old_level_btn.text = "edit level {}".format(
                     self.edit_old_level_btn.value)
+                self.draw_level_browser(levels)
                 self.edit_button_list = [self.status_btn, self.last_level_btn,
                                          self.edit_old_level_btn,
                                          self.next_level_btn,
                                          self.new_level_btn,
+                                         self.map_size_btn,
                                          self.exit_edit_btn]
 
         else:
-            if self.editing_data_map.is_empty():
-                self.status_btn.text = 'map is empty!'
-            elif not self.editing_data_map.is_connected():
-                self.status_btn.text = 'empty is not connected!'
-            else:
-                self.status_btn.text = "editing level {}".format(
-                    self.editing_level)
+            if self.edit_status_stale:
+                # 地图改动后才重新检查
+                self.edit_status_stale = False
+                if self.editing_data_map.is_empty():
+                    self.status_btn.text = 'map is empty!'
+                elif not self.editing_data_map.is_connected():
+                    self.status_btn.text = 'empty is not connected!'
+                elif self.editing_data_map.trapped_tanks():
+                    self.status_btn.text = 'tank is trapped!'
+                else:
+                    self.status_btn.text = "editing level {}".format(
+                        self.editing_level)
 
+            self.edit_shape_btn.text = "tool: {}".format(self.edit_shape)
             self.edit_button_list = [self.status_btn, self.hard_wall_btn,
                                      self.soft_wall_btn,
                                      self.green_land_btn, self.empty_btn,
-                                     self.tank_btn, self.save_level_btn,
+                                     self.tank_btn, self.edit_shape_btn,
+                                     self.save_level_btn,
                                      self.exit_edit_btn]
             # draw map
-            self.draw_edit_area(self.edit_area, self.editing_data_map)
+            self.update_edit_canvas()
             # draw map on screen
 
         self.screen.blit(self.edit_area, (0, 0))
+        if self.drawing and self.edit_shape in ('line', 'rect', 'frame'):
+            self.draw_shape_preview()
 
         # draw cursor
         x, y = mouse.get_pos()
@@ -1706,10 +3547,101 @@ class Game(object):
             start_y += btn.rect.height + 10
             btn.draw()
 
-    def draw_edit_area(self, surface: Surface, data_map):
+    def draw_level_browser(self, levels) -> None:
+        """
+        当前页的缩略图画到编辑区域, 还没画好的只画个框; 顺便预取下一页
+        """
+        page = self.browser_page(levels)
+        per_page = self.browser_columns * self.browser_rows
+        following = range(page.stop, min(page.stop + per_page, levels + 1))
+        map_file = self.session.map_file
+        self.thumbnails.request(map_file, list(page) + list(following))
+        font = Assets.font(20)
+        for i, level in enumerate(page):
+            cell = self.browser_cell(i)
+            thumbnail = self.thumbnails.get(map_file, level)
+            if thumbnail is not None:
+                area = thumbnail.get_rect(center=cell.center)
+                self.edit_area.blit(thumbnail, area)
+            else:
+                area = Rect(0, 0, self.thumbnails.size, self.thumbnails.size)
+                area.center = cell.center
+                draw.rect(self.edit_area, self.wincolor, area, 1)
+            self.edit_area.blit(font.render(str(level), True, self.fg),
+                                (cell.left + 6, cell.top + 4))
+            if level == self.edit_old_level_btn.value:
+                draw.rect(self.edit_area, self.fg, cell.inflate(-6, -6), 2)
+
+    def draw_shape_preview(self) -> None:
+        # 拖动时预览直线和矩形的范围
+        unit = self.min_unit_size
+        left, top = self.edit_camera.rect.topleft
+        x0, y0 = self.edit_start
+        x1, y1 = self.cell_at(mouse.get_pos())
+        if self.edit_shape == 'line':
+            draw.line(self.screen, self.fg,
+                      (x0 * unit + unit // 2 - left,
+                       y0 * unit + unit // 2 - top),
+                      (x1 * unit + unit // 2 - left,
+                       y1 * unit + unit // 2 - top), 2)
+        else:
+            area = Rect(min(x0, x1) * unit - left, min(y0, y1) * unit - top,
+                        (abs(x1 - x0) + 1) * unit, (abs(y1 - y0) + 1) * unit)
+            draw.rect(self.screen, self.fg, area, 2)
 
-        for y_num in range(data_map.height):
-            for x_num in range(data_map.width):
+    def update_edit_canvas(self) -> None:
+        """
+        换了地图或者视口移动时整个重画, 否则只重画改动过的格子
+        """
+        view = self.editing_data_map, self.edit_camera.rect.topleft
+        if self.edit_canvas_view is None or \
+                self.edit_canvas_view[0] is not view[0] or \
+                self.edit_canvas_view[1] != view[1]:
+            self.edit_canvas_view = view
+            self.edit_canvas.fill(self.black)
+            self.draw_edit_area(self.edit_canvas, self.editing_data_map,
+                                self.edit_camera)
+        else:
+            for x, y in self.edit_dirty:
+                self.repaint_edit_cell(x, y)
+        self.edit_dirty.clear()
+
+    def repaint_edit_cell(self, x, y) -> None:
+        # 坦克占 2x2 格, 重画从 (x, y) 开始的 2x2 区域和压在上面的格子
+        unit = self.min_unit_size
+        left, top = self.edit_camera.rect.topleft
+        area = Rect(x * unit - left, y * unit - top, unit * 2, unit * 2)
+        self.edit_canvas.set_clip(area)
+        self.edit_canvas.fill(self.black)
+        images = {
+            MapItem.hard_wall: self.hard_wall,
+            MapItem.green_land: self.green_land,
+            MapItem.soft_wall: self.soft_wall,
+            MapItem.tank: self.tank
+        }
+        for y_num in range(y - 1, y + 2):
+            for x_num in range(x - 1, x + 2):
+                cur_img = images.get(self.editing_data_map.get(x_num, y_num))
+                if cur_img:
+                    self.edit_canvas.blit(cur_img, (x_num * unit - left,
+                                                    y_num * unit - top))
+        self.edit_canvas.set_clip(None)
+
+    def draw_edit_area(self, surface: Surface, data_map,
+                       camera: Optional[Camera] = None):
+        if camera:
+            # 只画视口内的格子, 坦克占2x2, 往左上多画一格
+            x_range, y_range = camera.visible_cells(
+                self.min_unit_size, data_map.width, data_map.height)
+            x_range = range(max(0, x_range.start - 1), x_range.stop)
+            y_range = range(max(0, y_range.start - 1), y_range.stop)
+            left, top = camera.rect.topleft
+        else:
+            x_range, y_range = range(data_map.width), range(data_map.height)
+            left, top = 0, 0
+
+        for y_num in y_range:
+            for x_num in x_range:
                 item = data_map.get(x_num, y_num)
                 cur_img = {
                     MapItem.hard_wall: self.hard_wall,
@@ -1719,116 +3651,72 @@ class Game(object):
                 }.get(item, None)
                 if cur_img:
                     surface.blit(source=cur_img, dest=(
-                        x_num * self.min_unit_size,
-                        y_num * self.min_unit_size))
+                        x_num * self.min_unit_size - left,
+                        y_num * self.min_unit_size - top))
 
         return
 
     def draw_stage_clear(self):
-
-        actually_pos = [self.draw_pos[0] * Tank.tank_size,
-                        self.draw_pos[1] * Tank.tank_size]
-        if self.draw_pos == (0, 0):
-            self.battle_field.set(x=self.draw_pos[0], y=self.draw_pos[1],
-                                  val=MapItem.dummy)
-            self.player_group.add(
-                Player(actually_pos, self.bullet_list, self.screen,
-                       max_w=self.width, max_h=self.height,
-                       direction=self.draw_direction))
-        full = True
-        for y in range(self.battle_field.height):
-            for x in range(self.battle_field.width):
-                item = self.battle_field.get(x, y)
-                if item == MapItem.empty:
-                    full = False
-                    break
-            if not full:
-                break
+        """
+        通关动画, 坦克沿螺旋路线铺满屏幕
+        路线只算一次, 已经铺好的格子留在 stage_clear_canvas 上, 每帧只画一个新格子
+        """
+        field = self.session.battle_field
+        if self.stage_clear_field is not field:
+            self.stage_clear_field = field
+            self.stage_clear_path = spiral_path(field.width, field.height)
+            self.stage_clear_step = 0
+            self.stage_clear_canvas = Surface(self.size)
+            self.stage_clear_canvas.fill(self.black)
+        full = self.stage_clear_step >= len(self.stage_clear_path)
         if not full:
-            x, y = self.draw_pos
-            direction = self.draw_direction
-            if direction == Direction.right:
-                next_pos = x + 1, y
-            elif direction == Direction.down:
-                next_pos = x, y + 1
-            elif direction == Direction.left:
-                next_pos = x - 1, y
-            else:
-                next_pos = x, y - 1
-
-            x1, y1 = next_pos
-
-            if 0 <= x1 < self.battle_field.width \
-                    and 0 <= y1 < self.battle_field.height \
-                    and self.battle_field.get(*next_pos) == MapItem.empty:
-                self.draw_pos = next_pos
-
-            else:
-                direction = Direction((direction + 1) % 4)
-                if direction == Direction.right:
-                    next_pos = x + 1, y
-                elif direction == Direction.down:
-                    next_pos = x, y + 1
-                elif direction == Direction.left:
-                    next_pos = x - 1, y
-                else:
-                    next_pos = x, y - 1
-                self.draw_pos = next_pos
-                self.draw_direction = direction
-            actually_pos = [self.draw_pos[0] * Tank.tank_size,
-                            self.draw_pos[1] * Tank.tank_size]
-            if self.draw_pos != (0, 0):
-                self.battle_field.set(x=self.draw_pos[0], y=self.draw_pos[1],
-                                      val=MapItem.dummy)
-                self.player_group.add(
-                    Player(actually_pos, self.bullet_list, self.screen,
-                           max_w=self.width, max_h=self.height,
-                           direction=self.draw_direction))
+            x, y, direction = self.stage_clear_path[self.stage_clear_step]
+            self.stage_clear_canvas.blit(
+                Assets.image(Player.images[direction]),
+                (x * Tank.tank_size, y * Tank.tank_size))
+            self.stage_clear_step += 1
         self.screen.fill(self.wincolor)
-        draw_area = Surface(self.size)
-
-        draw_area.fill(self.black)
-        self.screen.blit(draw_area, (0, 0))
-        for player in self.player_group.sprites():
-            player.draw()
+        self.screen.blit(self.stage_clear_canvas, (0, 0))
         return full
 
     def draw_game_area(self):
-        self.green_land_group.update()
-        self.soft_wall_group.update()
-        self.hard_wall_group.update()
+        draw_session(self.screen, self.session, self.playing_area)
 
     @property
     def hard_wall(self):
-        if not self._hard_wall:
-            self._hard_wall = image.load('img/map/hard_wall.png')
-        return self._hard_wall
+        return Assets.image('img/map/hard_wall.png')
 
     @property
     def soft_wall(self):
-        if not self._soft_wall:
-            self._soft_wall = image.load('img/map/soft_wall.png')
-        return self._soft_wall
+        return Assets.image('img/map/soft_wall.png')
 
     @property
     def green_land(self):
-        if not self._green_land:
-            self._green_land = image.load('img/map/green_land.png')
-        return self._green_land
+        return Assets.image('img/map/green_land.png')
 
     @property
     def empty(self):
-        if not self._empty:
-            self._empty = image.load('img/map/empty.png')
-        return self._empty
+        return Assets.image('img/map/empty.png')
 
     @property
     def tank(self):
-        if not self._tank:
-            self._tank = image.load('img/tank-up.png')
-        return self._tank
+        return Assets.image('img/tank-up.png')
+
+
+startup.mark('load classes')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tank battle')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='print how long each startup step takes')
+    parser.add_argument('--autosave', type=int, default=0, metavar='SECONDS',
+                        help='save the game every SECONDS while playing')
+    parser.add_argument('--latency-report', action='store_true',
+                        help='print the key to screen latency when quitting')
+    args = parser.parse_args()
+    startup.enabled = args.startup_report
     game = Game()
+    game.latency_report = args.latency_report
+    game.autosave_interval = int(args.autosave / game.frame_time)
     game.start()
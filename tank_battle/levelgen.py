@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+随机关卡生成器
+
+    $ python levelgen.py -n 10000 --seed 1 -o levels.tblp --jobs 4
+    $ python levelgen.py -n 20 --tanks 8 -o map.db
+
+生成的每一关都满足 DataMap.is_connected: 从玩家出生点出发标记所有连通的非硬墙格子,
+没有连上的格子直接填成硬墙, 不需要反复生成重试; 坦克只放在开得到出生点的位置,
+validate.py 检查不会报 tank trapped
+"""
+import argparse
+import sys
+import time
+from functools import lru_cache
+from multiprocessing import Pool
+from random import Random
+from typing import List, Optional
+
+from game import DataMap, MapItem
+import levelpack
+
+HARD = int(MapItem.hard_wall)
+SOFT = int(MapItem.soft_wall)
+EMPTY = int(MapItem.empty)
+GREEN = int(MapItem.green_land)
+TANK = int(MapItem.tank)
+
+
+PASSABLE = bytes(0 if i == HARD else 1 for i in range(256))
+
+
+@lru_cache(maxsize=None)
+def spawn_index(width, height) -> List[int]:
+    return [x * height + y for x, y in DataMap(width, height).spawn_cells()]
+
+
+@lru_cache(maxsize=None)
+def item_table(density, soft_ratio, green) -> bytes:
+    """
+    把 0-255 的随机字节按比例映射成地图元素, 配合 bytes.translate 使用
+    """
+    table = bytearray(256)
+    for b in range(256):
+        p = (b + 0.5) / 256
+        if p < density * (1 - soft_ratio):
+            table[b] = HARD
+        elif p < density:
+            table[b] = SOFT
+        elif p < density + green:
+            table[b] = GREEN
+        else:
+            table[b] = EMPTY
+    return bytes(table)
+
+
+def to_mask(flags, width, height) -> int:
+    """
+    每格一个字节 (0 或 1) 转成大整数, 每列后面补一个 0 字节防止上下越界
+    """
+    return int.from_bytes(b'\0'.join(
+        flags[x * height:(x + 1) * height] for x in range(width)), 'little')
+
+
+def from_mask(mask, width, height) -> bytes:
+    stride = height + 1
+    data = mask.to_bytes(width * stride, 'little')
+    return b''.join(data[x * stride:x * stride + height]
+                    for x in range(width))
+
+
+def grow(mask, width, height, start) -> int:
+    """
+    从 start 出发标记 mask 里所有连通的格子
+    每轮用移位把已到达的区域向四周扩一格, 直到不再变化
+    """
+    x, y = divmod(start, height)
+    step = 8 * (height + 1)
+    reached = 1 << 8 * (x * (height + 1) + y) & mask
+    while True:
+        grown = (reached | reached << 8 | reached >> 8
+                 | reached << step | reached >> step) & mask
+        if grown == reached:
+            return reached
+        reached = grown
+
+
+def generate_level(seed, width=26, height=26, density=0.3, soft_ratio=0.5,
+                   green=0.05, tanks=5, placement='top'
+                   ) -> Optional[bytearray]:
+    """
+    生成一关, 返回按 x, y 顺序每格一个字节的地图, 放不下坦克时返回 None
+    """
+    rng = Random(seed)
+    n = width * height
+    # 和 3.9 的 randbytes 一样, 旧版本也能用, 同样的种子生成同样的关卡
+    buf = bytearray(rng.getrandbits(8 * n).to_bytes(n, 'little').translate(
+        item_table(density, soft_ratio, green)))
+    spawn = spawn_index(width, height)
+    for i in spawn:
+        buf[i] = EMPTY
+
+    # 软墙可以被打掉, 也算连通; 没连上的格子填成硬墙 (HARD 是 0, 按位与即可)
+    passable = to_mask(buf.translate(PASSABLE), width, height)
+    keep = from_mask(grow(passable, width, height, spawn[0]), width, height)
+    buf = bytearray((int.from_bytes(buf, 'little')
+                     & int.from_bytes(keep, 'little') * 0xff
+                     ).to_bytes(n, 'little'))
+
+    # 坦克占 2x2 格, 和 NavGraph 一样以左上角为节点, 只放在开得到出生点的位置
+    step = 8 * (height + 1)
+    footprint = passable & (passable >> 8) & (passable >> step) & \
+        (passable >> (step + 8))
+    nav = from_mask(grow(footprint, width, height, spawn[0]), width, height)
+    # 脚下不能有墙, 互相不重叠, 也不压在出生点上
+    rows = height // 2 if placement == 'top' else height - 1
+    ground = (EMPTY, GREEN)
+    spots = [x * height + y for x in range(width - 1) for y in range(rows)
+             if nav[x * height + y] and buf[x * height + y] in ground
+             and buf[x * height + y + 1] in ground
+             and buf[(x + 1) * height + y] in ground
+             and buf[(x + 1) * height + y + 1] in ground]
+    rng.shuffle(spots)
+    used = set(spawn)
+    placed = 0
+    for i in spots:
+        if placed == tanks:
+            break
+        cells = (i, i + 1, i + height, i + height + 1)
+        if used.isdisjoint(cells):
+            used.update(cells)
+            buf[i] = TANK
+            placed += 1
+    if placed < tanks or buf.count(EMPTY) == n:
+        return None
+    return buf
+
+
+def generate_batch(job) -> List[bytes]:
+    start, count, seed, params = job
+    levels = list()
+    for index in range(start, start + count):
+        for attempt in range(16):
+            buf = generate_level((seed * 1000003 + index) * 16 + attempt,
+                                 **params)
+            if buf is not None:
+                levels.append(bytes(buf))
+                break
+    return levels
+
+
+def generate(count, seed=0, jobs=1, batch=256, **params):
+    """
+    按顺序生成 count 关, 结果和进程数无关
+    """
+    size = params['width'], params['height']
+    tasks = [(start, min(batch, count - start), seed, params)
+             for start in range(0, count, batch)]
+    if jobs > 1:
+        with Pool(jobs) as pool:
+            for levels in pool.imap(generate_batch, tasks):
+                for data in levels:
+                    yield size + (data,)
+    else:
+        for task in tasks:
+            for data in generate_batch(task):
+                yield size + (data,)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='generate tank battle levels')
+    parser.add_argument('-n', '--count', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, default=26,
+                        help='map width and height in cells')
+    parser.add_argument('--density', type=float, default=0.3,
+                        help='ratio of wall cells')
+    parser.add_argument('--soft-ratio', type=float, default=0.5,
+                        help='ratio of soft walls among walls')
+    parser.add_argument('--green', type=float, default=0.05,
+                        help='ratio of green land cells')
+    parser.add_argument('--tanks', type=int, default=5)
+    parser.add_argument('--placement', choices=['top', 'random'],
+                        default='top', help='where npc tanks start')
+    parser.add_argument('-o', '--output', default='levels.tblp')
+    parser.add_argument('--format', choices=['auto', 'pack', 'shelve'],
+                        default='auto',
+                        help='auto writes a shelve for *.db, else a pack')
+    parser.add_argument('--replace', action='store_true',
+                        help='replace the levels in a shelve')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--verify', action='store_true',
+                        help='check every level with DataMap.is_connected')
+    args = parser.parse_args(argv)
+
+    params = {'width': args.size, 'height': args.size,
+              'density': args.density, 'soft_ratio': args.soft_ratio,
+              'green': args.green, 'tanks': args.tanks,
+              'placement': args.placement}
+    start = time.perf_counter()
+    levels = generate(args.count, seed=args.seed, jobs=args.jobs, **params)
+    if args.verify:
+        levels = list(levels)
+        bad = sum(not DataMap.from_bytes(*level).is_connected()
+                  for level in levels)
+        print('{} levels not connected'.format(bad))
+    fmt = args.format
+    if fmt == 'auto':
+        fmt = 'shelve' if args.output.endswith('.db') else 'pack'
+    if fmt == 'shelve':
+        count = levelpack.write_shelve(args.output, levels,
+                                       replace=args.replace)
+    else:
+        count = levelpack.write_pack(args.output, levels)
+    cost = time.perf_counter() - start
+    print('{} levels written to {} in {:.2f}s, {:.0f} levels/s'.format(
+        count, args.output, cost, count / cost))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+# coding:utf-8
+"""
+关卡文件读写
+
+除了游戏用的 shelve (map.db), 还支持一种批量关卡文件:
+    b'TBLP' + 版本(u16) + 关卡数(u32)
+    每个关卡: 宽(u16) + 高(u16) + 宽 * 高 个字节, 按 x, y 顺序, 每格是 MapItem 的值
+"""
+import os
+import shelve
+import struct
+from typing import Iterable, Iterator, List, Tuple
+
+from game import DataMap
+
+MAGIC = b'TBLP'
+VERSION = 1
+HEADER = struct.Struct('<4sHI')
+LEVEL_HEADER = struct.Struct('<HH')
+
+
+def is_pack(path: str) -> bool:
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def shelve_path(path: str) -> str:
+    # 游戏里用 'map', 在 macOS 上生成的是 map.db
+    if path.endswith('.db'):
+        return path[:-3]
+    return path
+
+
+def write_pack(path: str, levels: Iterable[Tuple[int, int, bytes]]) -> int:
+    """
+    levels 是 (宽, 高, 数据) 的序列, 返回写入的关卡数
+    """
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0))
+        for width, height, data in levels:
+            f.write(LEVEL_HEADER.pack(width, height))
+            f.write(data)
+            count += 1
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, count))
+    return count
+
+
+def iter_pack(path: str) -> Iterator[Tuple[int, int, bytes]]:
+    with open(path, 'rb') as f:
+        magic, version, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a level pack'.format(path))
+        for _ in range(count):
+            width, height = LEVEL_HEADER.unpack(f.read(LEVEL_HEADER.size))
+            yield width, height, f.read(width * height)
+
+
+def write_shelve(path: str, levels: Iterable[Tuple[int, int, bytes]],
+                 replace: bool = False) -> int:
+    """
+    写到游戏的关卡库里, 默认接在已有关卡后面
+    """
+    count = 0
+    with shelve.open(shelve_path(path), 'n' if replace else 'c') as db:
+        start = len(db)
+        for width, height, data in levels:
+            count += 1
+            db[str(start + count)] = DataMap.from_bytes(width, height, data)
+    return count
+
+
+def level_order(name: str):
+    # 关卡名是数字字符串, 按数字排序
+    return (not name.isdigit(), int(name) if name.isdigit() else name)
+
+
+def iter_levels(path: str) -> Iterator[Tuple[str, int, int, bytes]]:
+    """
+    按关卡顺序读出 (关卡名, 宽, 高, 数据), 不构造 DataMap
+    """
+    if is_pack(path):
+        for i, (width, height, data) in enumerate(iter_pack(path)):
+            yield str(i + 1), width, height, data
+        return
+    with shelve.open(shelve_path(path), 'r') as db:
+        keys = sorted(db.keys(), key=level_order)
+        for k in keys:
+            data_map = db[k]
+            yield k, data_map.width, data_map.height, data_map.to_bytes()
+
+
+def read_levels(path: str) -> List[Tuple[str, DataMap]]:
+    """
+    读出所有关卡, 返回 (关卡名, DataMap), 按关卡顺序
+    """
+    if is_pack(path):
+        return [(name, DataMap.from_bytes(width, height, data))
+                for name, width, height, data in iter_levels(path)]
+    with shelve.open(shelve_path(path), 'r') as db:
+        keys = sorted(db.keys(), key=level_order)
+        return [(k, db[k]) for k in keys]
@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+多房间对战服务器, 一个进程里用 asyncio 跑很多个互不相干的房间
+
+    $ python server.py serve --port 8765 --levels map.db
+    $ python server.py client --port 8765 --room 3 --seconds 10
+    $ python server.py loadtest --rooms 50 --seconds 20
+
+每个房间是一局 GameSession, 不画图, 按自己的 tick_rate 推进; 第一个进房间的
+客户端控制玩家坦克, 后面进来的只能观战, 房间里没人了就关掉
+协议是一行一个 json:
+    客户端 -> 服务器
+        {"join": 房间号}                           房间号是字符串或整数
+        {"keys": "wj", "ack": 收到的最新 tick}      keys 是 w/a/s/d/j 的组合
+    服务器 -> 客户端
+        {"welcome": 房间号, "tick_rate": 10, "control": true}
+        {"error": "..."}                           进不了房间, 随后断开
+        {"tick": t, "base": b, ...}
+快照是相对于客户端确认过的 tick b 的差量:
+    tanks / bullets / bombs   {编号: [x, y, ...]} 变了的和新出现的
+    gone                      消失的编号
+    cells                     b 之后改动的格子 [x, y, 新值], 也就是被打掉的软墙
+    player / score / level    变了才有
+客户端还没确认过, 确认的 tick 太旧或者换了关卡时 base 为 null, 发完整状态和整张地图
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from game import GameSession, KeyState
+import levelgen
+import levelpack
+
+
+def encode(msg) -> bytes:
+    return json.dumps(msg, separators=(',', ':')).encode() + b'\n'
+
+
+def diff(old: Dict, new: Dict, gone: list) -> Dict:
+    changed = {k: v for k, v in new.items() if old.get(k) != v}
+    gone.extend(k for k in old if k not in new)
+    return changed
+
+
+class Room(object):
+    """
+    一个房间: 一局游戏, 最近几秒的状态历史, 和连进来的客户端
+    """
+
+    def __init__(self, room_id, map_file, tick_rate=10, history=64):
+        self.room_id = room_id
+        self.tick_rate = tick_rate
+        self.session = GameSession(map_file, seed=room_id)
+        # game_levels 每次都要打开 shelve, 房间里只读一次
+        self.levels = self.session.game_levels
+        self.clients = list()
+        self.controller = None
+        self.keys = KeyState()
+        self.tick = 0
+        # 每帧一项: (tick, 关卡序号, 状态, 这一帧改动的格子)
+        self.history = deque(maxlen=history)
+        self.epoch = 0
+        self.field = None
+        self.ids = dict()
+        self.next_id = 0
+        self.busy = 0.0
+        self.late = 0
+        self.task = None
+        # 新建这个房间的客户端地址
+        self.host = None
+        self.restart()
+
+    def restart(self) -> None:
+        self.session.new_game(1)
+
+    def entity_id(self, sprite, ids) -> str:
+        if sprite in self.ids:
+            ids[sprite] = self.ids[sprite]
+        else:
+            self.next_id += 1
+            ids[sprite] = str(self.next_id)
+        return ids[sprite]
+
+    def state(self) -> Dict:
+        g = self.session
+        ids = dict()
+        tanks = {self.entity_id(t, ids): [t.location[0], t.location[1],
+                                          int(t.direction)]
+                 for t in g.npc_tanks}
+        bullets = dict()
+        for group in (g.bullet_list, g.npc_bullets):
+            for b in group:
+                bullets[self.entity_id(b, ids)] = [
+                    b.location[0], b.location[1], int(b.direction),
+                    int(b.type == 'user')]
+        # 爆炸只发位置, 动画客户端自己放
+        bombs = {self.entity_id(b, ids): b.pos[:] for b in g.bombs}
+        self.ids = ids
+        player = g.player
+        return {'tanks': tanks, 'bullets': bullets, 'bombs': bombs,
+                'player': player and [player.location[0], player.location[1],
+                                      int(player.direction)],
+                'score': g.score, 'level': g.cur_level}
+
+    def step(self) -> None:
+        g = self.session
+        if not g.player or g.cur_level > self.levels:
+            self.restart()
+        if g.battle_field is not self.field:
+            # 换了关卡, 旧的差量都作废
+            self.field = g.battle_field
+            self.field.journal = list()
+            self.epoch += 1
+        g.step(self.keys)
+        self.tick += 1
+        if g.battle_field is not self.field:
+            self.field = g.battle_field
+            self.field.journal = list()
+            self.epoch += 1
+        cells = self.field.journal
+        self.field.journal = list()
+        self.history.append((self.tick, self.epoch, self.state(),
+                             [list(c) for c in cells]))
+
+    def full(self) -> Dict:
+        tick, epoch, state, _ = self.history[-1]
+        field = self.field
+        msg = {'tick': tick, 'base': None,
+               'map': [field.width, field.height,
+                       base64.b64encode(field.to_bytes()).decode()]}
+        msg.update(state)
+        return msg
+
+    def delta(self, ack: Optional[int]) -> Dict:
+        tick, epoch, state, _ = self.history[-1]
+        first = self.history[0][0]
+        if ack is None or not first <= ack < tick:
+            return self.full()
+        base_tick, base_epoch, base, _ = self.history[ack - first]
+        if base_epoch != epoch:
+            return self.full()
+        msg = {'tick': tick, 'base': ack}
+        gone = list()
+        for name in ('tanks', 'bullets', 'bombs'):
+            changed = diff(base[name], state[name], gone)
+            if changed:
+                msg[name] = changed
+        if gone:
+            msg['gone'] = gone
+        cells = [c for i in range(ack - first + 1, len(self.history))
+                 for c in self.history[i][3]]
+        if cells:
+            msg['cells'] = cells
+        for name in ('player', 'score', 'level'):
+            if base[name] != state[name]:
+                msg[name] = state[name]
+        return msg
+
+    def broadcast(self) -> None:
+        # 确认到同一帧的客户端共用一份编码好的差量
+        cache = dict()
+        for client in self.clients:
+            if client.writer.transport.get_write_buffer_size() > \
+                    client.buffer_limit:
+                # 客户端收得慢就先不发, 下一次差量会把这次的改动带上
+                continue
+            if client.ack not in cache:
+                cache[client.ack] = encode(self.delta(client.ack))
+            data = cache[client.ack]
+            client.writer.write(data)
+            client.sent += len(data)
+
+    async def run(self, offset=0.0) -> None:
+        loop = asyncio.get_running_loop()
+        period = 1 / self.tick_rate
+        deadline = loop.time() + offset
+        while True:
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            start = time.perf_counter()
+            self.step()
+            self.broadcast()
+            self.busy += time.perf_counter() - start
+            deadline += period
+            if deadline < loop.time():
+                # 跟不上就少跑几帧, 不补
+                self.late += 1
+                deadline = loop.time()
+
+    def join(self, client) -> bool:
+        self.clients.append(client)
+        if self.controller is None:
+            self.controller = client
+        return self.controller is client
+
+    def leave(self, client) -> None:
+        self.clients.remove(client)
+        if self.controller is client:
+            self.controller = None
+            self.keys = KeyState()
+
+
+class Connection(object):
+
+    def __init__(self, writer, buffer_limit=64 * 1024):
+        self.writer = writer
+        self.buffer_limit = buffer_limit
+        self.ack = None
+        self.sent = 0
+
+
+class Server(object):
+
+    def __init__(self, map_file, tick_rate=10, history=64, max_rooms=1000,
+                 rooms_per_host=8):
+        self.map_file = map_file
+        self.tick_rate = tick_rate
+        self.history = history
+        # 房间数的上限, 每个地址同时开着的由它新建的房间也有上限, None 不限
+        self.max_rooms = max_rooms
+        self.rooms_per_host = rooms_per_host
+        self.created = dict()
+        self.rooms = dict()
+        self.handlers = set()
+        self.server = None
+
+    def room(self, room_id, host=None) -> Optional[Room]:
+        """
+        进房间, 没有就新建; 超过房间上限时返回 None
+        """
+        if room_id not in self.rooms:
+            if self.max_rooms is not None and \
+                    len(self.rooms) >= self.max_rooms:
+                return None
+            if self.rooms_per_host is not None and \
+                    self.created.get(host, 0) >= self.rooms_per_host:
+                return None
+            self.created[host] = self.created.get(host, 0) + 1
+            room = Room(room_id, self.map_file, tick_rate=self.tick_rate,
+                        history=self.history)
+            room.host = host
+            # 房间错开启动, 每帧的计算分散开
+            offset = (len(self.rooms) % 16) / 16 / self.tick_rate
+            room.task = asyncio.get_running_loop().create_task(
+                room.run(offset))
+            self.rooms[room_id] = room
+        return self.rooms[room_id]
+
+    def close_room(self, room: Room) -> None:
+        if self.rooms.get(room.room_id) is room:
+            room.task.cancel()
+            del self.rooms[room.room_id]
+            self.created[room.host] -= 1
+            if not self.created[room.host]:
+                del self.created[room.host]
+
+    async def handle(self, reader, writer) -> None:
+        client = Connection(writer)
+        room = None
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            msg = json.loads(line)
+            room_id = msg.get('join') if isinstance(msg, dict) else None
+            # bool 也是 int, 列表和字典不能当 dict 的键
+            if not isinstance(room_id, (str, int)) or \
+                    isinstance(room_id, bool):
+                writer.write(encode({'error': 'bad join'}))
+                return
+            peer = writer.get_extra_info('peername')
+            host = peer[0] if isinstance(peer, tuple) else peer
+            room = self.room(room_id, host)
+            if room is None:
+                writer.write(encode({'error': 'too many rooms'}))
+                return
+            control = room.join(client)
+            writer.write(encode({'welcome': room.room_id,
+                                 'tick_rate': room.tick_rate,
+                                 'control': control}))
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                if not isinstance(msg, dict):
+                    continue
+                ack = msg.get('ack')
+                if isinstance(ack, int) and not isinstance(ack, bool) and \
+                        (client.ack is None or ack > client.ack):
+                    client.ack = ack
+                keys = msg.get('keys')
+                if room.controller is client and isinstance(keys, str):
+                    room.keys = KeyState(keys)
+        except (ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            if room is not None:
+                room.leave(client)
+                if not room.clients:
+                    self.close_room(room)
+            writer.close()
+            self.handlers.discard(task)
+
+    async def start(self, host='127.0.0.1', port=8765):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    def close(self) -> None:
+        for room in list(self.rooms.values()):
+            self.close_room(room)
+        self.server.close()
+
+
+class Mirror(object):
+    """
+    客户端这边按差量还原出来的状态, 每帧留一份, 差量总是基于确认过的那一帧
+    """
+    ENTITIES = ('tanks', 'bullets', 'bombs')
+
+    def __init__(self, keep=64):
+        self.states = dict()
+        self.keep = keep
+        self.tick = None
+        self.map = None
+        self.fulls = 0
+
+    def apply(self, msg) -> Dict:
+        if msg['base'] is None:
+            self.fulls += 1
+            width, height, data = msg['map']
+            self.map = [width, height, bytearray(base64.b64decode(data))]
+            state = {k: msg[k] for k in self.ENTITIES}
+            state.update({k: msg[k] for k in ('player', 'score', 'level')})
+        else:
+            base = self.states[msg['base']]
+            state = {k: dict(base[k]) for k in self.ENTITIES}
+            for k in ('player', 'score', 'level'):
+                state[k] = msg.get(k, base[k])
+            for name in self.ENTITIES:
+                state[name].update(msg.get(name, ()))
+            for k in msg.get('gone', ()):
+                for name in self.ENTITIES:
+                    state[name].pop(k, None)
+            height = self.map[1]
+            # 格子只会被打掉, 重复设置没有关系
+            for x, y, v in msg.get('cells', ()):
+                self.map[2][x * height + y] = v
+        self.tick = msg['tick']
+        self.states[self.tick] = state
+        # 跳过的 tick 不会有, 比 tick - keep 老的都丢掉
+        for tick in [t for t in self.states if t <= self.tick - self.keep]:
+            del self.states[tick]
+        return state
+
+
+class Bot(object):
+    """
+    随便乱走乱打, 每隔几帧换一次方向
+    """
+
+    def __init__(self, seed=0, hold=5):
+        self.rng = random.Random(seed)
+        self.hold = hold
+        self.keys = ''
+        self.frames = 0
+
+    def __call__(self, state) -> str:
+        if self.frames % self.hold == 0:
+            self.keys = self.rng.choice('wasd') + \
+                ('j' if self.rng.random() < 0.5 else '')
+        self.frames += 1
+        return self.keys
+
+
+async def run_client(room_id, host='127.0.0.1', port=8765, seconds=10.0,
+                     bot=None) -> Dict:
+    """
+    本机回环客户端: 进房间, 每收到一帧就回确认和按键, 返回收发统计
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(encode({'join': room_id}))
+    welcome = json.loads(await reader.readline())
+    if 'error' in welcome:
+        writer.close()
+        raise ConnectionError(welcome['error'])
+    mirror = Mirror()
+    bot = bot or Bot(seed=room_id if isinstance(room_id, int) else 0)
+    stats = {'room': room_id, 'control': welcome['control'], 'bytes': 0,
+             'messages': 0, 'mirror': mirror}
+    loop = asyncio.get_running_loop()
+    end = loop.time() + seconds
+    try:
+        while loop.time() < end:
+            try:
+                line = await asyncio.wait_for(reader.readline(),
+                                              end - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                break
+            stats['bytes'] += len(line)
+            stats['messages'] += 1
+            state = mirror.apply(json.loads(line))
+            writer.write(encode({'keys': bot(state), 'ack': mirror.tick}))
+    finally:
+        writer.close()
+    stats['fulls'] = mirror.fulls
+    return stats
+
+
+def prepare_levels(path=None, count=3, seed=0, size=26) -> str:
+    """
+    房间用的关卡库, 没给就用 levelgen 生成几关放到临时目录, 返回 shelve 路径
+    """
+    if path and not levelpack.is_pack(path):
+        return os.path.abspath(levelpack.shelve_path(path))
+    target = os.path.join(tempfile.mkdtemp(prefix='tank_server_'), 'map')
+    if path:
+        levels = levelpack.iter_pack(path)
+    else:
+        levels = levelgen.generate(count, seed=seed, width=size, height=size,
+                                   density=0.3, soft_ratio=0.5, green=0.05,
+                                   tanks=5, placement='top')
+    levelpack.write_shelve(target, levels, replace=True)
+    return target
+
+
+async def loadtest(rooms, seconds, tick_rate, map_file, port) -> Dict:
+    # 所有客户端都在本机, 不按地址限制
+    server = Server(map_file, tick_rate=tick_rate, max_rooms=None,
+                    rooms_per_host=None)
+    await server.start(port=port)
+    cpu = time.process_time()
+    clients = [asyncio.create_task(run_client(i, port=port, seconds=seconds))
+               for i in range(rooms)]
+    # 等所有房间都跑起来再开始统计
+    await asyncio.sleep(0.5)
+    # 客户端断开后房间会关掉, 先留下引用
+    opened = dict(server.rooms)
+    busy = sum(room.busy for room in opened.values())
+    wall = time.perf_counter()
+    results = await asyncio.gather(*clients)
+    wall = time.perf_counter() - wall
+    busy = sum(room.busy for room in opened.values()) - busy
+    # 检查客户端还原出来的最后一帧和服务器的一致
+    mismatch = 0
+    for stats in results:
+        room = opened.get(stats['room'])
+        mirror = stats['mirror']
+        if room is None or mirror.tick is None:
+            continue
+        for tick, epoch, state, _ in room.history:
+            if tick == mirror.tick:
+                mismatch += json.loads(json.dumps(state)) != \
+                    mirror.states[tick]
+    late = sum(room.late for room in opened.values())
+    # 等服务器这边的连接都收到断开
+    await asyncio.gather(*server.handlers, return_exceptions=True)
+    server.close()
+    cpu = time.process_time() - cpu
+    ticks = sum(stats['messages'] for stats in results)
+    received = sum(stats['bytes'] for stats in results)
+    return {'rooms': rooms, 'seconds': wall, 'ticks': ticks,
+            'tick_ms': busy / max(ticks, 1) * 1000,
+            'rooms_per_core': rooms * wall / busy if busy else 0.0,
+            'cpu': cpu / wall,
+            'bytes_per_client': received / rooms / wall,
+            'fulls': sum(stats['fulls'] for stats in results),
+            'late': late, 'mismatch': mismatch}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='tank battle room server')
+    parser.add_argument('mode', choices=['serve', 'client', 'loadtest'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--levels',
+                        help='map.db or a level pack, generated if missing')
+    parser.add_argument('--tick-rate', type=int, default=10)
+    parser.add_argument('--room', type=int, default=0,
+                        help='room to join in client mode')
+    parser.add_argument('--rooms', type=int, default=20,
+                        help='rooms (one client each) in loadtest mode')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--max-rooms', type=int, default=1000,
+                        help='rooms open at the same time in serve mode')
+    parser.add_argument('--rooms-per-host', type=int, default=8,
+                        help='open rooms one address may create in serve '
+                             'mode')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'client':
+        stats = asyncio.run(run_client(args.room, args.host, args.port,
+                                       args.seconds))
+        print('room {} control {}: {} ticks, {} full, {:.0f} B/s'.format(
+            stats['room'], stats['control'], stats['messages'],
+            stats['fulls'], stats['bytes'] / args.seconds))
+        return 0
+
+    map_file = prepare_levels(args.levels)
+    if args.mode == 'serve':
+        async def serve():
+            server = Server(map_file, tick_rate=args.tick_rate,
+                            max_rooms=args.max_rooms,
+                            rooms_per_host=args.rooms_per_host)
+            await server.start(args.host, args.port)
+            print('serving on {}:{}'.format(args.host, args.port))
+            await server.server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    result = asyncio.run(loadtest(args.rooms, args.seconds, args.tick_rate,
+                                  map_file, args.port))
+    print('{rooms} rooms, {ticks} ticks in {seconds:.1f}s, '
+          'tick {tick_ms:.2f} ms'.format(**result))
+    print('rooms per core {rooms_per_core:.0f}, process cpu {cpu:.0%}, '
+          '{bytes_per_client:.0f} B/s per client'.format(**result))
+    print('{fulls} full snapshots, {late} late ticks, '
+          '{mismatch} mirror mismatches'.format(**result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
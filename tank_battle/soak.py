@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+长时间挂机测试, 不开窗口让机器人一关一关地玩, 找内存泄漏和越跑越慢的地方
+
+    $ python soak.py --hours 4 --bot shooter --levels map.db -o soak.json
+    $ python soak.py --minutes 10 --no-draw
+
+默认走 Game.game_loop, 和展台上跑的一样画图, 存倒带记录; 死了按重玩, 通关动画
+放完从第一关重新开始. 每开始一关 (最长 sample_ticks 帧) 采样一次:
+    tracemalloc 当前和峰值, 进程 RSS, gc 跟踪的对象数, 每个 Group 的大小,
+    这一段平均每帧耗时
+最后 window 次采样一直不降而且比开头大的指标记为增长 (子弹和爆炸的组除外), 再和
+预热后的 tracemalloc 快照比较, 列出涨得最多的分配位置
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Dict, List
+
+from pygame import display
+from pygame.sprite import Group
+
+try:
+    import resource
+except ImportError:
+    # windows 没有 resource, 只能读 /proc 或者不报 RSS
+    resource = None
+
+from bots import BOTS
+from game import Game, GameSession
+import levelpack
+
+
+def rss_kb() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        # 只有峰值, 够看出是不是一直在涨
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return 0
+
+
+def monotonic_growth(values, window) -> bool:
+    tail = values[-window:]
+    if len(tail) < window:
+        return False
+    return tail[-1] > tail[0] and all(b >= a for a, b in zip(tail, tail[1:]))
+
+
+class Soak(object):
+    # 子弹和爆炸的多少跟着战斗起伏, 连着涨几次很正常, 只报告不算泄漏
+    TRANSIENT = ('bullet_list', 'npc_bullets', 'bombs')
+
+    def __init__(self, session: GameSession, controller, game=None,
+                 sample_ticks=3000, over_frames=10):
+        self.session = session
+        self.controller = controller
+        self.game = game
+        self.sample_ticks = sample_ticks
+        self.levels = session.game_levels
+        self.ticks = 0
+        self.played = 0
+        self.deaths = 0
+        self.clears = 0
+        self.samples = list()
+        self.baseline = None
+        self.over_frames = over_frames
+        self.last_tick = 0
+        self.last_time = 0.0
+
+    def groups(self) -> Dict[str, int]:
+        # Group 的属性都算上, 以后新加的组也不会漏
+        sizes = OrderedDict()
+        owners = [self.session] if self.game is None else \
+            [self.session, self.game]
+        for owner in owners:
+            for name, value in sorted(vars(owner).items()):
+                if isinstance(value, Group):
+                    sizes[name] = len(value)
+        return sizes
+
+    def sample(self) -> None:
+        now = time.perf_counter()
+        current, peak = tracemalloc.get_traced_memory()
+        ticks = self.ticks - self.last_tick
+        row = OrderedDict([
+            ('ticks', self.ticks),
+            ('levels', self.played),
+            ('traced_kb', current // 1024),
+            ('traced_peak_kb', peak // 1024),
+            ('rss_kb', rss_kb()),
+            ('objects', len(gc.get_objects())),
+            ('ms_per_tick', (now - self.last_time) * 1000 / ticks
+             if ticks else 0.0),
+        ])
+        row.update(self.groups())
+        self.samples.append(row)
+        if hasattr(tracemalloc, 'reset_peak'):
+            # 3.9 以后峰值可以清零, 每段单独看峰值
+            tracemalloc.reset_peak()
+        self.last_tick = self.ticks
+        self.last_time = now
+
+    def restart(self) -> None:
+        session = self.session
+        if session.cur_level > self.levels:
+            self.clears += 1
+            if self.game:
+                # 和按 BACK 再按 NEW GAME 一样
+                self.game.rewind.clear()
+            session.new_game(1)
+        else:
+            self.deaths += 1
+            # 和游戏结束画面的重玩一样, 留在这一关
+            session.replay()
+
+    def step(self) -> None:
+        session = self.session
+        game = self.game
+        if game:
+            game.game_loop()
+        elif session.player and session.cur_level <= self.levels:
+            session.step(self.controller(session))
+        self.ticks += 1
+        if session.cur_level > self.levels:
+            # 通关动画放完再重来, 不画图时直接重来
+            if game is None or (
+                    game.stage_clear_field is session.battle_field and
+                    game.stage_clear_step >= len(game.stage_clear_path)):
+                self.restart()
+        elif not session.player:
+            if game:
+                # 让游戏结束画面也画几帧
+                for _ in range(self.over_frames):
+                    game.game_loop()
+            self.restart()
+
+    def run(self, seconds, warmup=1) -> None:
+        session = self.session
+        if self.game:
+            # 和按 NEW GAME 一样换成游戏窗口的大小
+            self.game.screen = display.set_mode(self.game.playing_win_size)
+            self.game.intro = False
+            self.game.controller = self.controller
+        session.new_game(1)
+        self.last_time = time.perf_counter()
+        end = time.monotonic() + seconds
+        level = (session.cur_level, self.deaths, self.clears)
+        while time.monotonic() < end:
+            self.step()
+            now = (session.cur_level, self.deaths, self.clears)
+            if now != level or self.ticks - self.last_tick >= \
+                    self.sample_ticks:
+                if now != level:
+                    level = now
+                    self.played += 1
+                self.sample()
+                if self.baseline is None and len(self.samples) >= warmup:
+                    # 图片缓存, 字体这些第一次用到才加载, 预热之后再做基准
+                    self.baseline = tracemalloc.take_snapshot()
+        self.sample()
+
+    def growth(self, window) -> List[str]:
+        if not self.samples:
+            return list()
+        skip = ('ticks', 'levels') + self.TRANSIENT
+        if not hasattr(tracemalloc, 'reset_peak'):
+            # 峰值清不掉, 本来就只增不减
+            skip += ('traced_peak_kb',)
+        names = [name for name in self.samples[0] if name not in skip]
+        return [name for name in names
+                if monotonic_growth([row.get(name, 0) for row in self.samples],
+                                    window)]
+
+    def top_allocations(self, limit=10) -> List[str]:
+        if self.baseline is None:
+            return list()
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),
+                  tracemalloc.Filter(False, __file__))
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+        stats = snapshot.compare_to(self.baseline.filter_traces(ignore),
+                                    'lineno')
+        return [str(stat) for stat in stats[:limit] if stat.size_diff > 0]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='soak test tank battle')
+    parser.add_argument('--hours', type=float, default=0)
+    parser.add_argument('--minutes', type=float, default=0)
+    parser.add_argument('--bot', choices=sorted(BOTS), default='shooter')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--levels', help='level shelve, default is the '
+                                         'levels of the game')
+    parser.add_argument('--no-draw', action='store_true',
+                        help='only run the GameSession, skip Game drawing')
+    parser.add_argument('--sample-ticks', type=int, default=3000,
+                        help='sample at least every SAMPLE_TICKS ticks')
+    parser.add_argument('--window', type=int, default=8,
+                        help='samples in a row that must not go down')
+    parser.add_argument('--frames', type=int, default=1,
+                        help='tracemalloc frames kept per allocation, more '
+                             'frames cost a lot more time per tick')
+    parser.add_argument('-o', '--output', help='write the samples as json')
+    args = parser.parse_args(argv)
+    seconds = args.hours * 3600 + args.minutes * 60 or 60
+
+    # 和 levelpack, validate 一样, map.db 这种写法去掉后缀再交给 shelve
+    map_file = args.levels and levelpack.shelve_path(args.levels)
+    tracemalloc.start(args.frames)
+    if args.no_draw:
+        game = None
+        session = GameSession(map_file, seed=args.seed)
+    else:
+        # 展台上的机器没有显示器也能跑
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        game = Game()
+        session = game.session
+        if map_file:
+            session.map_file = map_file
+        session.rng.seed(args.seed)
+    soak = Soak(session, BOTS[args.bot](seed=args.seed), game,
+                sample_ticks=args.sample_ticks)
+    soak.run(seconds)
+
+    first, last = soak.samples[0], soak.samples[-1]
+    print('{} ticks, {} levels, {} deaths, {} clears, {} samples'.format(
+        soak.ticks, soak.played, soak.deaths, soak.clears,
+        len(soak.samples)))
+    for name in first:
+        if name in ('ticks', 'levels'):
+            continue
+        print('  {:<18}{:>12}{:>12}'.format(
+            name, round(first[name], 3), round(last.get(name, 0), 3)))
+    growing = soak.growth(args.window)
+    print('growing: {}'.format(', '.join(growing) or 'none'))
+    top = soak.top_allocations()
+    if top:
+        print('top allocation sites since warm up:')
+        for line in top:
+            print('  ' + line)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'samples': soak.samples, 'growing': growing,
+                       'top_allocations': top}, f, indent=1)
+    return 1 if growing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
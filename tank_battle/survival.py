@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+生存模式压测: 不开窗口, 机器人守着一关, NPC 坦克一波比一波多, 看引擎撑到多少辆
+
+    $ python survival.py --bot shooter --base 5 --growth 5 --wave-ticks 100
+    $ python survival.py --levels map.db --level 2 --min-rate 30 -o waves.json
+
+GameSession.survival 打开后打光坦克也不换关; 每 wave_ticks 帧来一波, 第 n 波补
+base + growth * (n - 1) 辆, 加在还活着的坦克上面. 玩家死了就地复活 (和重玩一样)
+    出生点    关卡载入时按 NavGraph.spots 把和玩家出生点连通, 能放下坦克的节点
+              打乱存一份, 刷坦克时只跳过被坦克或玩家压着的和离玩家太近的
+    坦克      被打掉的放回 TankPool, 下一波用 Tank.recycle 复位再用, 不重新构造
+每一波报告存活的坦克数, 这一波的 ticks/s 和每帧毫秒数; 低于 min_rate (默认是游戏的
+10 帧每秒) 时停下, 这时的坦克数就是当前引擎能撑住的上限, 改动引擎前后各跑一次比较
+"""
+import argparse
+import dbm
+import json
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from random import Random
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bots import BOTS
+from game import Direction, GameSession, MapItem, Tank
+import levelgen
+import levelpack
+
+
+class TankPool(object):
+    """
+    NPC 坦克的对象池, 死掉的坦克 (不在任何 Group 里) 回收后再发出去
+    """
+
+    def __init__(self, session: GameSession):
+        self.session = session
+        self.active = list()
+        self.free = list()
+        self.created = 0
+        self.reused = 0
+
+    def adopt(self, tanks) -> None:
+        # 关卡自带的坦克也归池子管, 打掉以后一样回收
+        self.active.extend(tanks)
+
+    def reclaim(self) -> int:
+        chunks = self.session.chunks
+        alive = list()
+        for tank in self.active:
+            if tank.alive():
+                alive.append(tank)
+            else:
+                # tanks_in 只在被查到时才清理死坦克, 复用前先从块里拿掉
+                chunks.remove(tank)
+                self.free.append(tank)
+        reclaimed = len(self.active) - len(alive)
+        self.active = alive
+        return reclaimed
+
+    def acquire(self, location, direction) -> Tank:
+        session = self.session
+        if self.free:
+            tank = self.free.pop()
+            tank.recycle(location, direction)
+            self.reused += 1
+        else:
+            tank = Tank(session.surface, npc_bullet_list=session.npc_bullets,
+                        location=list(location), direction=direction,
+                        max_w=session.world_width, max_h=session.world_height,
+                        scale=session.scale, rng=session.rng)
+            self.created += 1
+        session.add_npc_tank(tank)
+        self.active.append(tank)
+        return tank
+
+    def clear(self) -> None:
+        self.active = list()
+        self.free = list()
+
+
+class SpawnIndex(object):
+    """
+    预先算好的出生点, 一关只算一次
+    软墙被打掉只会让能走的节点变多, 所以算好的点一直能放坦克, 只是不一定全
+    """
+
+    def __init__(self, session: GameSession, seed=0, clearance=4):
+        self.session = session
+        self.field = session.battle_field
+        self.clearance = clearance
+        nav = session.nav
+        # 软墙打得掉, 按只有硬墙挡路的导航图找和玩家出生点连通的区域,
+        # 再去掉现在脚下有软墙的节点
+        reach = session.battle_field.nav(blocked=(MapItem.hard_wall,))
+        home = reach.node_at(session.player.location) if session.player \
+            else None
+        region = reach.region(*home) if home else None
+        self.spots = [spot for spot in reach.spots(region)
+                      if nav.is_free(*spot)]
+        Random(seed).shuffle(self.spots)
+        self.cursor = 0
+
+    def occupied(self) -> set:
+        """
+        坦克和玩家压着的格子, 坦克不一定对齐格子, 最多压 3x3 格
+        """
+        session = self.session
+        unit = session.min_unit_size
+        cells = set()
+        for group in (session.npc_tanks, session.player_group):
+            for sprite in group:
+                rect = sprite.rect
+                right = (rect.right - 1) // unit + 1
+                bottom = (rect.bottom - 1) // unit + 1
+                for x in range(rect.left // unit, right):
+                    for y in range(rect.top // unit, bottom):
+                        cells.add((x, y))
+        return cells
+
+    def take(self, count) -> List[Tuple[int, int]]:
+        """
+        最多取 count 个空着的出生点 (像素坐标), 从上次停下的地方接着找, 找满一圈为止
+        """
+        session = self.session
+        unit = session.min_unit_size
+        cells = self.occupied()
+        player = session.player
+        near = None
+        if player:
+            near = (player.rect.centerx // unit, player.rect.centery // unit)
+        taken = list()
+        for _ in range(len(self.spots)):
+            if len(taken) >= count:
+                break
+            x, y = self.spots[self.cursor]
+            self.cursor = (self.cursor + 1) % len(self.spots)
+            footprint = ((x, y), (x + 1, y), (x, y + 1), (x + 1, y + 1))
+            if any(cell in cells for cell in footprint):
+                continue
+            if near and max(abs(x + 1 - near[0]),
+                            abs(y + 1 - near[1])) <= self.clearance:
+                continue
+            cells.update(footprint)
+            taken.append((x * unit, y * unit))
+        return taken
+
+
+class Survival(object):
+    def __init__(self, session: GameSession, controller, base=5, growth=5,
+                 wave_ticks=100, seed=0):
+        self.session = session
+        self.controller = controller
+        self.base = base
+        self.growth = growth
+        self.wave_ticks = wave_ticks
+        self.rng = Random(seed)
+        self.pool = TankPool(session)
+        self.spawns = None
+        self.wave = 0
+        self.ticks = 0
+        self.deaths = 0
+        self.waves = list()
+
+    def start(self, level=1) -> None:
+        session = self.session
+        session.survival = True
+        session.new_game(level)
+        self.pool.clear()
+        self.pool.adopt(session.npc_tanks.sprites())
+        self.spawns = SpawnIndex(session, self.rng.randrange(1 << 30))
+
+    def spawn(self) -> Dict:
+        """
+        来一波坦克, 返回这一波要了多少辆, 放下了多少辆
+        """
+        self.wave += 1
+        want = self.base + self.growth * (self.wave - 1)
+        start = time.perf_counter()
+        self.pool.reclaim()
+        spots = self.spawns.take(want)
+        for location in spots:
+            self.pool.acquire(location, Direction(self.rng.randrange(4)))
+        return {'wanted': want, 'spawned': len(spots),
+                'spawn_ms': (time.perf_counter() - start) * 1000}
+
+    def step(self) -> None:
+        session = self.session
+        session.step(self.controller(session))
+        self.ticks += 1
+        if not session.player:
+            self.deaths += 1
+            session.replay()
+
+    def run(self, max_waves=50, min_rate=10.0,
+            seconds=None) -> Iterator[Dict]:
+        """
+        一波一波地跑, 每跑完一波产出一行报告
+        帧率掉到 min_rate 以下, 放不下新坦克或者超时就停
+        """
+        end = time.monotonic() + seconds if seconds else None
+        while self.wave < max_waves:
+            row = OrderedDict([('wave', self.wave + 1)])
+            row.update(self.spawn())
+            score, deaths = self.session.score, self.deaths
+            start = time.perf_counter()
+            for _ in range(self.wave_ticks):
+                self.step()
+            elapsed = time.perf_counter() - start
+            row['tanks'] = len(self.session.npc_tanks)
+            row['ticks_per_s'] = self.wave_ticks / elapsed
+            row['ms_per_tick'] = elapsed * 1000 / self.wave_ticks
+            row['kills'] = (self.session.score - score) // 10
+            row['deaths'] = self.deaths - deaths
+            row['created'] = self.pool.created
+            row['reused'] = self.pool.reused
+            self.waves.append(row)
+            yield row
+            if row['ticks_per_s'] < min_rate or row['spawned'] == 0 or \
+                    (end and time.monotonic() > end):
+                return
+
+    def limit(self, min_rate) -> Optional[int]:
+        """
+        最后一波还跑得动 min_rate 时的坦克数, 一直没掉下来时返回 None
+        """
+        last = 0
+        for row in self.waves:
+            if row['ticks_per_s'] < min_rate:
+                return last
+            last = row['tanks']
+        return None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='survival stress test with growing waves of npc tanks')
+    parser.add_argument('--bot', choices=sorted(BOTS), default='shooter')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seeds the bot, the npc tanks and the spawns')
+    parser.add_argument('--levels',
+                        help='level shelve, default generates one level')
+    parser.add_argument('--level', type=int, default=1)
+    parser.add_argument('--size', type=int, default=26,
+                        help='map size of the generated level')
+    parser.add_argument('--base', type=int, default=5,
+                        help='tanks in the first wave')
+    parser.add_argument('--growth', type=int, default=5,
+                        help='extra tanks in each following wave')
+    parser.add_argument('--wave-ticks', type=int, default=100)
+    parser.add_argument('--waves', type=int, default=50,
+                        help='stop after this many waves')
+    parser.add_argument('--min-rate', type=float, default=10.0,
+                        help='stop when a wave runs slower than MIN_RATE '
+                             'ticks/s, the game runs at 10')
+    parser.add_argument('--minutes', type=float, default=0,
+                        help='stop after the wave running at this time')
+    parser.add_argument('--dormant-interval', type=int, default=0,
+                        help='move far tanks every N ticks, 0 keeps them '
+                             'asleep')
+    parser.add_argument('-o', '--output', help='write the waves as json')
+    args = parser.parse_args(argv)
+
+    # 和 bots, soak 一样, map.db 这种写法去掉后缀再交给 shelve
+    map_file = args.levels and levelpack.shelve_path(args.levels)
+    if map_file and not dbm.whichdb(map_file):
+        # game_levels 按 'c' 打开, 路径写错时会新建一个空的关卡库
+        print('{}: no level shelve'.format(args.levels), file=sys.stderr)
+        return 1
+    if map_file is None:
+        map_file = tempfile.mkdtemp() + '/map'
+        levelpack.write_shelve(map_file, levelgen.generate(
+            args.level, seed=args.seed, width=args.size, height=args.size,
+            tanks=max(args.size // 5, 1)), replace=True)
+    session = GameSession(map_file, seed=args.seed)
+    session.dormant_interval = args.dormant_interval
+    levels = session.game_levels
+    if not 1 <= args.level <= levels:
+        print('level {} not in {} ({} levels)'.format(
+            args.level, map_file, levels), file=sys.stderr)
+        return 1
+    survival = Survival(session, BOTS[args.bot](seed=args.seed),
+                        base=args.base, growth=args.growth,
+                        wave_ticks=args.wave_ticks, seed=args.seed)
+    survival.start(args.level)
+    print('{} spawn spots'.format(len(survival.spawns.spots)))
+    print('{:>5}{:>7}{:>8}{:>10}{:>10}{:>7}{:>8}{:>9}{:>8}'.format(
+        'wave', 'tanks', 'spawned', 'ticks/s', 'ms/tick', 'kills', 'deaths',
+        'created', 'reused'))
+    for row in survival.run(args.waves, args.min_rate, args.minutes * 60):
+        print('{wave:>5}{tanks:>7}{spawned:>8}{ticks_per_s:>10.1f}'
+              '{ms_per_tick:>10.2f}{kills:>7}{deaths:>8}{created:>9}'
+              '{reused:>8}'.format(**row))
+    limit = survival.limit(args.min_rate)
+    if limit is None:
+        print('still above {} ticks/s'.format(args.min_rate))
+    else:
+        print('limit: {} tanks at {} ticks/s'.format(limit, args.min_rate))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'waves': survival.waves, 'limit': limit}, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
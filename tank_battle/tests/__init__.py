@@ -0,0 +1,26 @@
+# coding:utf-8
+"""
+纯逻辑部分的行为测试, 不开窗口也不放声音
+
+    $ cd tank_battle && python -m unittest
+"""
+import os
+import sys
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+# 和其他脚本一样按 tank_battle 目录下的模块名导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import levelgen  # noqa: E402
+import levelpack  # noqa: E402
+
+
+def level_file(directory, count=1, seed=0, size=26, tanks=5) -> str:
+    """
+    在 directory 下生成 count 关, 返回游戏用的 shelve 路径
+    """
+    path = os.path.join(directory, 'map')
+    levelpack.write_shelve(path, levelgen.generate(
+        count, seed=seed, width=size, height=size, tanks=tanks), replace=True)
+    return path
@@ -0,0 +1,67 @@
+# coding:utf-8
+import unittest
+from random import Random
+
+from pygame import Rect
+from pygame.sprite import Group, Sprite, groupcollide
+
+from game import LaneIndex, lane_collide
+
+
+class Box(Sprite):
+    def __init__(self, index, rect):
+        Sprite.__init__(self)
+        self.index = index
+        self.rect = Rect(rect)
+
+
+def boxes(rng, count, size):
+    return [(rng.randrange(0, 600), rng.randrange(0, 600)) + size
+            for _ in range(count)]
+
+
+class LaneCollideTest(unittest.TestCase):
+    def collide(self, collide, rects_a, rects_b, dokilla, dokillb):
+        groupa = Group([Box(i, r) for i, r in enumerate(rects_a)])
+        groupb = Group([Box(i, r) for i, r in enumerate(rects_b)])
+        calls = list()
+
+        def collided(a, b):
+            calls.append((a.index, b.index))
+            return a.rect.colliderect(b.rect)
+        crashed = collide(groupa, groupb, dokilla, dokillb, collided)
+        hits = {a.index: [b.index for b in bs] for a, bs in crashed.items()}
+        return (hits, calls, sorted(s.index for s in groupa),
+                sorted(s.index for s in groupb))
+
+    def test_same_as_groupcollide(self):
+        rng = Random(5)
+        for _ in range(20):
+            # 子弹和坦克大小的精灵, 对数超过 LANE_MIN_PAIRS 才会建索引
+            bullets = boxes(rng, 40, (6, 6))
+            tanks = boxes(rng, 30, (30, 30))
+            for kills in ((False, False), (True, False), (False, True),
+                          (True, True)):
+                expect = self.collide(groupcollide, bullets, tanks, *kills)
+                got = self.collide(lane_collide, bullets, tanks, *kills)
+                self.assertEqual(got[0], expect[0])
+                self.assertEqual(got[2:], expect[2:])
+                # collided 只在矩形相交时调用, 顺序和 groupcollide 一样
+                overlapping = [pair for pair in expect[1]
+                               if Rect(bullets[pair[0]]).colliderect(
+                                   tanks[pair[1]])]
+                self.assertEqual(got[1], overlapping)
+
+    def test_index_query(self):
+        rng = Random(8)
+        rects = boxes(rng, 200, (30, 30))
+        sprites = [Box(i, r) for i, r in enumerate(rects)]
+        index = LaneIndex(sprites, 30)
+        for rect in boxes(rng, 100, (6, 40)):
+            rect = Rect(rect)
+            self.assertEqual(index.query(rect),
+                             [s for s in sprites if s.rect.colliderect(rect)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# coding:utf-8
+import unittest
+
+from pygame import display, event
+from pygame.locals import KEYDOWN, KEYUP, K_d, K_j, K_w
+
+from game import InputBuffer
+
+
+def key(type_, k):
+    return event.Event(type_, key=k, mod=0)
+
+
+class InputBufferTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # event.get() 要先初始化显示, 测试里用的是 dummy 驱动
+        display.init()
+
+    def setUp(self):
+        event.clear()
+        self.keys = InputBuffer()
+
+    def post(self, *events):
+        for evt in events:
+            event.post(evt)
+
+    def test_tap_within_frame_counts(self):
+        self.post(key(KEYDOWN, K_j), key(KEYUP, K_j))
+        self.keys.events()
+        self.assertTrue(self.keys[K_j])
+        self.assertEqual(self.keys.held, set())
+        self.assertEqual([k for _, k in self.keys.pending], [K_j])
+        # 下一帧就松开了
+        self.keys.events()
+        self.assertFalse(self.keys[K_j])
+
+    def test_held_keys_carry_over(self):
+        self.post(key(KEYDOWN, K_w))
+        self.keys.events()
+        self.assertTrue(self.keys[K_w])
+        self.keys.events()
+        self.assertTrue(self.keys[K_w])
+        # 只有新按下的键算进这一帧的延迟统计
+        self.assertEqual(self.keys.pending, [])
+        self.post(key(KEYUP, K_w), key(KEYDOWN, K_d))
+        returned = self.keys.events()
+        self.assertEqual([evt.type for evt in returned], [KEYUP, KEYDOWN])
+        # 这一帧开始时还按着 w
+        self.assertTrue(self.keys[K_w])
+        self.assertTrue(self.keys[K_d])
+        self.keys.events()
+        self.assertFalse(self.keys[K_w])
+        self.assertTrue(self.keys[K_d])
+
+
+if __name__ == '__main__':
+    unittest.main()
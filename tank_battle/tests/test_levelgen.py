@@ -0,0 +1,55 @@
+# coding:utf-8
+import os
+import tempfile
+import unittest
+
+import levelgen
+import levelpack
+
+
+class LevelPackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.levels = list(levelgen.generate(5, seed=3, width=26, height=20,
+                                             tanks=4))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pack_round_trip(self):
+        path = os.path.join(self.tmp.name, 'levels.tblp')
+        self.assertEqual(levelpack.write_pack(path, self.levels), 5)
+        self.assertTrue(levelpack.is_pack(path))
+        self.assertEqual(list(levelpack.iter_pack(path)), self.levels)
+
+    def test_shelve_round_trip(self):
+        path = os.path.join(self.tmp.name, 'map')
+        levelpack.write_shelve(path, self.levels[:3], replace=True)
+        # 默认接在已有关卡后面
+        levelpack.write_shelve(path + '.db', self.levels[3:])
+        self.assertFalse(levelpack.is_pack(path))
+        read = levelpack.read_levels(path)
+        self.assertEqual([name for name, _ in read],
+                         ['1', '2', '3', '4', '5'])
+        for (name, data_map), level in zip(read, self.levels):
+            self.assertEqual((data_map.width, data_map.height,
+                              data_map.to_bytes()), level)
+
+    def test_shelve_path(self):
+        self.assertEqual(levelpack.shelve_path('a/map.db'), 'a/map')
+        self.assertEqual(levelpack.shelve_path('a/map'), 'a/map')
+
+
+class LevelGenTest(unittest.TestCase):
+    def test_same_seed_same_levels(self):
+        params = dict(width=30, height=24, tanks=6)
+        first = list(levelgen.generate(4, seed=9, **params))
+        self.assertEqual(first, list(levelgen.generate(4, seed=9, **params)))
+        self.assertNotEqual(first,
+                            list(levelgen.generate(4, seed=10, **params)))
+        for width, height, data in first:
+            self.assertEqual((width, height, len(data)), (30, 24, 30 * 24))
+
+
+if __name__ == '__main__':
+    unittest.main()
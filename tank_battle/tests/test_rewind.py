@@ -0,0 +1,76 @@
+# coding:utf-8
+import tempfile
+import unittest
+
+from bots import BOTS
+from game import GameSession, RewindBuffer
+from tests import level_file
+
+
+def state(session):
+    tanks = sorted((tank.location[0], tank.location[1], int(tank.direction),
+                    tank.status, tank.rest_life)
+                   for tank in session.npc_tanks)
+    bullets = sorted((bullet.location[0], bullet.location[1],
+                      int(bullet.direction), bullet.type)
+                     for group in (session.bullet_list, session.npc_bullets)
+                     for bullet in group)
+    bombs = sorted((bomb.pos[0], bomb.pos[1], bomb.bomb_num)
+                   for bomb in session.bombs)
+    player = session.player
+    return (session.tick, session.score, session.cur_level,
+            session.battle_field.to_bytes(), tanks, bullets, bombs,
+            player and (tuple(player.location), int(player.direction),
+                        player.bullet_tick))
+
+
+class RewindTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        map_file = level_file(self.tmp.name, count=2, seed=4, tanks=6)
+        self.session = GameSession(map_file, seed=1)
+        self.session.new_game(1)
+        self.bot = BOTS['shooter'](seed=2)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def play(self, rewind, ticks):
+        states = list()
+        for _ in range(ticks):
+            self.session.step(self.bot(self.session))
+            rewind.record(self.session)
+            states.append(state(self.session))
+        return states
+
+    def test_seek_across_keyframes(self):
+        # 每 7 帧一个关键帧, 倒回去要跨过好几段把改动的格子重放出来
+        rewind = RewindBuffer(seconds=30, fps=10, keyframe_interval=7)
+        states = self.play(rewind, 120)
+        self.assertGreater(len(rewind.segments), 10)
+        # 跑过的这些帧里打掉过软墙, 地图确实变过
+        self.assertNotEqual(states[0][3], states[-1][3])
+        self.assertTrue(rewind.rewind(self.session, 3.5))
+        self.assertEqual(rewind.frames, 120 - 35)
+        self.assertEqual(state(self.session), states[rewind.frames - 1])
+        # 倒回去以后接着录, 再倒一次
+        states = states[:rewind.frames] + self.play(rewind, 20)
+        self.assertTrue(rewind.rewind(self.session, 6))
+        self.assertEqual(state(self.session), states[rewind.frames - 1])
+
+    def test_dropped_frames_merge_into_keyframe(self):
+        # 只留 5 秒, 最老的帧丢掉时改动合进关键帧
+        rewind = RewindBuffer(seconds=5, fps=10, keyframe_interval=20)
+        states = self.play(rewind, 130)
+        self.assertEqual(rewind.frames, 50)
+        # 不够 10 秒时回到最老的一帧
+        self.assertTrue(rewind.rewind(self.session, 10))
+        self.assertEqual(rewind.frames, 1)
+        self.assertEqual(state(self.session), states[130 - 50])
+
+    def test_empty_buffer(self):
+        self.assertFalse(RewindBuffer().rewind(self.session, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
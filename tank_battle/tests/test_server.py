@@ -0,0 +1,76 @@
+# coding:utf-8
+import base64
+import json
+import tempfile
+import unittest
+
+from game import KeyState
+from server import Mirror, Room
+from tests import level_file
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.map_file = level_file(self.tmp.name, count=2, seed=6, tanks=8)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check(self, room, mirror, msg):
+        state = mirror.apply(json.loads(json.dumps(msg)))
+        tick, epoch, expect, _ = room.history[-1]
+        self.assertEqual(mirror.tick, tick)
+        self.assertEqual(state, json.loads(json.dumps(expect)))
+        field = room.field
+        self.assertEqual(mirror.map[:2], [field.width, field.height])
+        self.assertEqual(bytes(mirror.map[2]), field.to_bytes())
+
+    def test_delta_apply_equals_full(self):
+        room = Room(1, self.map_file, history=16)
+        room.keys = KeyState('j')
+        mirror = Mirror()
+        fulls = cells = 0
+        for step in range(300):
+            room.step()
+            # 隔几帧才确认一次, 差量要把中间几帧的改动都带上
+            ack = mirror.tick if step % 4 else None
+            msg = room.delta(ack)
+            fulls += msg['base'] is None
+            cells += 'cells' in msg
+            self.check(room, mirror, msg)
+            # 差量和完整状态还原出来的一样
+            full = Mirror()
+            self.check(room, full, room.full())
+        self.assertLess(mirror.fulls, 300)
+        self.assertEqual(mirror.fulls, fulls)
+        # 差量里带过被打掉的墙
+        self.assertGreater(cells, 0)
+
+    def test_stale_ack_gets_full(self):
+        room = Room(2, self.map_file, history=8)
+        mirror = Mirror()
+        room.step()
+        self.check(room, mirror, room.delta(None))
+        for _ in range(10):
+            room.step()
+        msg = room.delta(mirror.tick)
+        self.assertIsNone(msg['base'])
+        self.check(room, mirror, msg)
+        room.step()
+        msg = room.delta(mirror.tick)
+        self.assertEqual(msg['base'], mirror.tick)
+        self.check(room, mirror, msg)
+
+    def test_mirror_keeps_recent_ticks(self):
+        room = Room(3, self.map_file)
+        mirror = Mirror(keep=5)
+        for _ in range(20):
+            room.step()
+            self.check(room, mirror, room.delta(mirror.tick))
+        self.assertEqual(sorted(mirror.states),
+                         list(range(mirror.tick - 4, mirror.tick + 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# coding:utf-8
+import tempfile
+import unittest
+
+from bots import BOTS
+from game import Direction, GameSession
+from survival import Survival
+from tests import level_file
+
+
+class TankPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        map_file = level_file(self.tmp.name, size=52, tanks=6, seed=2)
+        self.session = GameSession(map_file, seed=3)
+        self.survival = Survival(self.session, BOTS['shooter'](seed=1),
+                                 base=6, growth=0, seed=4)
+        self.survival.start(1)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_killed_tanks_come_back_fresh(self):
+        session = self.session
+        pool = self.survival.pool
+        # 跑几帧让坦克有了决策时间, 再弄乱状态后全部打掉
+        for _ in range(5):
+            self.survival.step()
+        killed = dict()
+        for tank in list(session.npc_tanks):
+            tank.status = 'attack'
+            tank.rest_life = 1
+            tank.bullet_tick = 3
+            tank.next_think = session.tick + 7
+            self.assertIsNotNone(tank.chunk)
+            killed[tank] = tank.chunk
+            tank.kill()
+        self.assertEqual(pool.reclaim(), len(killed))
+        for tank, chunk in killed.items():
+            self.assertIsNone(tank.chunk)
+            self.assertNotIn(tank, session.chunks.chunks.get(chunk, ()))
+
+        spots = self.survival.spawns.take(len(killed))
+        self.assertEqual(len(spots), len(killed))
+        for location in spots:
+            tank = pool.acquire(location, Direction.left)
+            self.assertIn(tank, killed)
+            self.assertEqual(tank.location, list(location))
+            self.assertEqual(tank.direction, Direction.left)
+            self.assertEqual(tank.status, 'patrol')
+            self.assertEqual(tank.rest_life, 3)
+            self.assertEqual(tank.bullet_tick, 0)
+            self.assertIsNone(tank.bullet)
+            self.assertIsNone(tank.next_think)
+            # 按新位置重新登记到块里
+            self.assertIn(tank, session.npc_tanks)
+            self.assertEqual(tank.chunk,
+                             session.chunks.key(tank.rect.center))
+            self.assertIn(tank, session.chunks.chunks[tank.chunk])
+            for chunk, tanks in session.chunks.chunks.items():
+                if chunk != tank.chunk:
+                    self.assertNotIn(tank, tanks)
+        self.assertEqual(pool.reused, len(killed))
+        self.assertEqual(pool.created, 0)
+        self.assertEqual(len(pool.active), len(killed))
+
+        # 之后移动时块跟着更新
+        for _ in range(10):
+            self.survival.step()
+        for tank in session.npc_tanks:
+            self.assertEqual(tank.chunk,
+                             session.chunks.key(tank.rect.center))
+            self.assertIn(tank, session.chunks.chunks[tank.chunk])
+
+    def test_pool_builds_tanks_when_empty(self):
+        pool = self.survival.pool
+        before = len(self.session.npc_tanks)
+        row = self.survival.spawn()
+        self.assertEqual(pool.reused, 0)
+        self.assertEqual(pool.created, row['spawned'])
+        self.assertEqual(len(self.session.npc_tanks), before + row['spawned'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# coding:utf-8
+import tempfile
+import time
+import unittest
+from threading import Thread
+
+from game import ThumbnailCache
+from tests import level_file
+
+
+class ThumbnailCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.map_file = level_file(self.tmp.name, count=2, seed=5)
+        self.cache = ThumbnailCache(self.tmp.name + '/thumbs', size=32)
+        self.cache.palette = [(i, i, i) for i in range(256)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def wait(self, job):
+        # request 会加载格子图片算调色板, 这里直接把要做的活交给后台线程
+        cache = self.cache
+        cache.wanted = [job]
+        if cache.thread is None:
+            cache.thread = Thread(target=cache.run, daemon=True)
+            cache.thread.start()
+        cache.wake.set()
+        deadline = time.monotonic() + 10
+        while job not in cache.ready:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        return cache.ready[job]
+
+    def test_invalidate_while_loading_drops_stale(self):
+        cache = self.cache
+        load = cache.load
+        calls = list()
+
+        def slow_load(map_file, level):
+            thumbnail = load(map_file, level)
+            calls.append(level)
+            if len(calls) == 1:
+                # 读完关卡还没放进 ready 时编辑器存了这一关
+                cache.invalidate(map_file, level)
+            return thumbnail
+        cache.load = slow_load
+        thumbnail = self.wait((self.map_file, 1))
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(thumbnail.get_size(), (32, 32))
+
+    def test_forget_while_loading_drops_stale(self):
+        cache = self.cache
+        load = cache.load
+        calls = list()
+
+        def slow_load(map_file, level):
+            calls.append(level)
+            if len(calls) == 1:
+                cache.forget()
+            return load(map_file, level)
+        cache.load = slow_load
+        self.wait((self.map_file, 2))
+        self.assertEqual(calls, [2, 2])
+        self.assertEqual(cache.rendered + cache.loaded, 2)
+
+    def test_missing_level(self):
+        self.assertIsNone(self.wait((self.map_file, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# coding:utf-8
+import os
+import tempfile
+import unittest
+
+from game import DataMap
+from tests import level_file
+import levelgen
+import levelpack
+from validate import validate_level
+
+
+class ValidateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_iter_levels_in_order(self):
+        levels = list(levelgen.generate(12, seed=3, width=26, height=20,
+                                        tanks=4))
+        pack = os.path.join(self.tmp.name, 'levels.tblp')
+        levelpack.write_pack(pack, levels)
+        shelf = os.path.join(self.tmp.name, 'map')
+        levelpack.write_shelve(shelf, levels, replace=True)
+        names = [str(i + 1) for i in range(12)]
+        for path in (pack, shelf + '.db'):
+            read = list(levelpack.iter_levels(path))
+            # 关卡名按数字排, 10 在 9 后面
+            self.assertEqual([level[0] for level in read], names)
+            self.assertEqual([level[1:] for level in read], levels)
+
+    def test_generated_levels_validate(self):
+        path = level_file(self.tmp.name, count=20, seed=1)
+        for level in levelpack.iter_levels(path):
+            row = validate_level(level)
+            self.assertEqual(row['errors'], '', row['level'])
+            self.assertEqual(row['ok'], 1)
+
+    def test_reports_errors(self):
+        width, height, data = next(levelgen.generate(1, seed=2, width=26,
+                                                     height=26, tanks=3))
+        empty = bytes([levelgen.EMPTY]) * len(data)
+        self.assertIn('empty', validate_level(('1', 26, 26, empty))['errors'])
+        # 出生点填上硬墙
+        blocked = bytearray(data)
+        for x, y in DataMap(width, height).spawn_cells():
+            blocked[x * height + y] = levelgen.HARD
+        row = validate_level(('1', width, height, bytes(blocked)))
+        self.assertEqual(row['ok'], 0)
+        self.assertIn('spawn blocked', row['errors'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+关卡检查工具, 多进程检查关卡库里的每一关, 输出每关的统计 (csv)
+
+    $ python validate.py map.db
+    $ python validate.py levels.tblp --jobs 4 -o stats.csv
+
+检查项:
+    empty           地图是空的
+    not connected   map_connect 不通过
+    spawn blocked   玩家出生点 (init_player 的位置) 被墙或坦克挡住
+    tank unreachable    坦克所在的格子和出生点不连通
+    tank out of bounds  坦克放在最后一行或最后一列
+    tank trapped    坦克 (2x2 格) 开不到出生点, 软墙算作可以打掉
+有问题的关卡返回码为 1
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
+
+from game import DataMap, MapItem
+import levelpack
+
+HARD = int(MapItem.hard_wall)
+SOFT = int(MapItem.soft_wall)
+EMPTY = int(MapItem.empty)
+GREEN = int(MapItem.green_land)
+TANK = int(MapItem.tank)
+
+FIELDS = ['level', 'width', 'height', 'hard_wall', 'soft_wall',
+          'green_land', 'empty', 'tank', 'reachable_cells',
+          'footprint_cells', 'footprint_reachable', 'ok', 'errors']
+
+
+def flood(start, passable, width, height) -> bytearray:
+    """
+    从 start 出发四连通的格子, passable 和返回值都是按 x, y 顺序每格一个字节
+    """
+    seen = bytearray(width * height)
+    if not passable[start]:
+        return seen
+    seen[start] = 1
+    stack = [start]
+    n = width * height
+    while stack:
+        i = stack.pop()
+        y = i % height
+        for j in (i - height, i + height,
+                  i - 1 if y > 0 else -1, i + 1 if y < height - 1 else -1):
+            if 0 <= j < n and passable[j] and not seen[j]:
+                seen[j] = 1
+                stack.append(j)
+    return seen
+
+
+def validate_level(level: Tuple[str, int, int, bytes]) -> Dict:
+    name, width, height, data = level
+    n = width * height
+    row = {'level': name, 'width': width, 'height': height,
+           'hard_wall': data.count(HARD), 'soft_wall': data.count(SOFT),
+           'green_land': data.count(GREEN), 'empty': data.count(EMPTY),
+           'tank': data.count(TANK)}
+    errors = list()
+    data_map = DataMap.from_bytes(width, height, data)
+    if row['empty'] == n:
+        errors.append('empty')
+    elif not data_map.is_connected():
+        errors.append('not connected')
+
+    spawn = [x * height + y for x, y in data_map.spawn_cells()]
+    tanks = [i for i in range(n) if data[i] == TANK]
+    # 坦克放在最后一行或最后一列会超出地图
+    if any(i >= n - height or i % height == height - 1 for i in tanks):
+        errors.append('tank out of bounds')
+    tank_cells = {j for i in tanks for j in (i, i + 1, i + height,
+                                             i + height + 1) if j < n}
+    if any(data[i] in (HARD, SOFT) for i in spawn) or \
+            tank_cells.intersection(spawn):
+        errors.append('spawn blocked')
+
+    # 软墙可以被打掉, 只有硬墙算阻挡
+    passable = bytes(v != HARD for v in data)
+    reach = flood(spawn[0], passable, width, height)
+    row['reachable_cells'] = sum(reach)
+    if any(not reach[i] for i in tanks):
+        errors.append('tank unreachable')
+
+    graph = data_map.nav((MapItem.hard_wall,))
+    row['footprint_cells'] = sum(graph.free)
+    row['footprint_reachable'] = graph.region_size(
+        *data_map.spawn_cells()[0])
+    if data_map.trapped_tanks():
+        errors.append('tank trapped')
+
+    row['ok'] = int(not errors)
+    row['errors'] = ';'.join(errors)
+    return row
+
+
+def validate(levels, jobs=1) -> List[Dict]:
+    if jobs > 1:
+        with Pool(jobs) as pool:
+            return pool.map(validate_level, levels, chunksize=64)
+    return [validate_level(level) for level in levels]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='check tank battle levels')
+    parser.add_argument('path', nargs='?', default='map.db',
+                        help='map.db or a level pack')
+    parser.add_argument('-o', '--output', default='-',
+                        help='csv file for the per level stats, - for stdout')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    levels = list(levelpack.iter_levels(args.path))
+    rows = validate(levels, jobs=args.jobs)
+    cost = time.perf_counter() - start
+
+    if args.output == '-':
+        writer = csv.DictWriter(sys.stdout, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    bad = [row for row in rows if not row['ok']]
+    for row in bad:
+        print('level {}: {}'.format(row['level'], row['errors']),
+              file=sys.stderr)
+    print('{} levels checked in {:.2f}s, {} failed'.format(
+        len(rows), cost, len(bad)), file=sys.stderr)
+    return 1 if bad else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())